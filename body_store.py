@@ -0,0 +1,259 @@
+import re
+import sqlite3
+import string
+import time
+import zlib
+
+# Number of characters of a compressed body that are kept uncompressed in the posts table as its preview
+PREVIEW_LENGTH = 80
+# Bodies are only compressed if that saves at least this many bytes, which covers the cost of their post_bodies row and
+# body index entry - most short bodies do not compress well enough to be worth it
+MIN_SAVINGS = 64
+# Bodies are compressed once and decompressed on every read, so the slowest (and best) level is used
+COMPRESSION_LEVEL = 9
+# Max number of terms that a word may be part of for the body index to be queried for it - the terms are ORed together
+# and such queries get slower much faster than the number of terms grows (a word that is part of thousands of terms is
+# found faster by decompressing every body)
+MAX_INDEX_TERMS = 1000
+# Every printable ASCII character that is not a letter or digit is part of a token (see index_terms) - the body index
+# is given the terms one after the other separated by spaces, so its tokenizer must only split them on the spaces
+INDEX_TOKENCHARS = string.punctuation
+
+# ASCII control characters that str.split does not split on - the tokenizer of the body index does
+_CONTROL = re.compile('[\x00-\x08\x0e-\x1b\x7f]')
+
+
+def compress(body):
+    """
+    :return: body compressed as a raw deflate stream (without the zlib header and checksum, which would add 6 bytes to
+             each body)
+    """
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -15)
+    return compressor.compress(body.encode()) + compressor.flush()
+
+
+def decompress(blob):
+    """
+    :return: the body that blob was compressed from (None if blob is None)
+    """
+    if blob is None:
+        return None
+    return zlib.decompress(blob, -15).decode()
+
+
+def make_preview(body, length=PREVIEW_LENGTH):
+    """
+    :return: the first length characters of body, cut at the last whitespace in them if there is one in their second
+             half - always a prefix of body, so a keyword found in the preview is also found in the body
+    """
+    if len(body) <= length:
+        return body
+    cut = max(body.rfind(' ', 0, length + 1), body.rfind('\n', 0, length + 1))
+    return body[:cut] if cut >= length // 2 else body[:length]
+
+
+def index_terms(text):
+    """
+    Splits text into the terms that the body index holds. A term is a maximal run of characters that are not whitespace
+    (or ASCII control characters), with its ASCII letters lower cased, so any keyword (or word of a phrase) found in a
+    body is part of one of its terms - and a body that has a term containing a keyword that is a single term is a body
+    that the keyword is found in.
+    :return: the set of the terms of text
+    """
+    if _CONTROL.search(text) is not None:
+        text = _CONTROL.sub(' ', text)
+    # Only ASCII letters are case-folded, as is done by sqlite's lower() function - bytes.lower only folds ASCII letters
+    # (and the bytes of multi-byte UTF-8 characters are never ASCII), which is much faster than str.translate
+    return set(text.encode().lower().decode().split())
+
+
+def terms_filter_sql(schema, param, fallback):
+    """
+    :param schema: the schema of the database that the body index belongs to
+    :param param: name of the parameter holding a word (folded as by index_terms) that a term must contain
+    :param fallback: sql condition to use instead of querying the body index if more than MAX_INDEX_TERMS terms
+                     contain the word
+    :return: sql condition over the post_bodies table (aliased b) that is true for the bodies that have a term
+             containing the word
+    """
+    terms = 'from ' + schema + '.post_body_terms where instr(term, :' + param + ') > 0'
+    quoted = '\'"\' || replace(term, \'"\', \'""\') || \'"\''
+    return '(case (select min(count(*), ' + str(MAX_INDEX_TERMS + 1) + ') ' + terms + ') when 0 then 0 ' \
+           'when ' + str(MAX_INDEX_TERMS + 1) + ' then ' + fallback + ' ' \
+           'else b.body_id in (select rowid from ' + schema + '.post_body_index where post_body_index match ' \
+           '(select group_concat(' + quoted + ', \' OR \') ' + terms + ')) end)'
+
+
+def full_body_sql(alias, schema='main'):
+    """
+    :param alias: the alias of the posts table in the query that the expression is to be used in
+    :param schema: the schema of the database that the posts table belongs to
+    :return: sql expression giving the full (decompressed) body of a post
+    """
+    return 'ifnull(decompress_body((select b.body from ' + schema + '.post_bodies b where b.post_id=' + alias + \
+           '.post_id)), ' + alias + '.body)'
+
+
+def preview_sql(alias, schema='main'):
+    """
+    :param alias: the alias of the posts table in the query that the expression is to be used in
+    :param schema: the schema of the database that the posts table belongs to
+    :return: sql expression giving the body of a post as it is shown in lists of posts - the preview of a compressed
+             body followed by "..."
+    """
+    return alias + '.body || case when exists (select 1 from ' + schema + '.post_bodies b ' \
+           'where b.post_id=' + alias + '.post_id) then \'...\' else \'\' end'
+
+
+class BodyStore:
+    """
+    Class handling the optional compressed storage of post bodies. A compressed body is held in the post_bodies table
+    while the posts table only holds its first few characters (its preview), so that lists of posts are shown without
+    decompressing anything and scans of the posts table read far fewer pages. Bodies that are not worth compressing
+    (and all bodies while compression is disabled) are kept in the posts table as they are, so both kinds of posts can
+    be found in the same database.
+
+    As compressed bodies can not be searched by sql, the terms of each of them are held in a contentless FTS5 index
+    (post_body_index, keyed by the body_id of the body) and its vocabulary in the post_body_terms table. A keyword is
+    searched for by looking up the terms that contain it in the vocabulary and then the bodies that have any of those
+    terms in the index - only a phrase has to be checked for in the decompressed bodies that have terms containing each
+    of its words (see search_query._compile_term).
+
+    Triggers (see DBManager._create_post_bodies) drop the compressed body of a post whose body is updated or which is
+    deleted by other programs, which leaves its terms in the index - as body_ids are never reused, these terms can only
+    match a body that no longer exists. The terms of a body are removed from the index by unindex, which must be called
+    before the body is dropped.
+    """
+
+    def __init__(self, connection):
+        """
+        Initializes an instance of this class and registers the decompress_body sql function on connection.
+        :param connection: connection to the database
+        """
+        self.connection = connection
+        connection.create_function('decompress_body', 1, decompress, deterministic=True)
+        row = connection.execute('select preview_length from body_compression;').fetchone()
+        # None while new and edited bodies are not compressed
+        self.preview_length = None if row is None else row[0]
+
+    def prepare(self, body, preview_length=None):
+        """
+        Compresses body if compression is enabled and it saves enough space.
+        :param body: the body of a post that is being added or edited
+        :param preview_length: length of the preview to keep (defaults to that of the database)
+        :return: tuple of what is to be stored in the body column of the posts table and the compressed body (None if
+                 the body is not to be compressed)
+        """
+        preview_length = self.preview_length if preview_length is None else preview_length
+        if body is None or preview_length is None or len(body) <= preview_length:
+            return body, None
+        preview = make_preview(body, preview_length)
+        blob = compress(body)
+        if len(blob) + len(preview.encode()) + MIN_SAVINGS > len(body.encode()):
+            return body, None
+        return preview, blob
+
+    def store(self, rows):
+        """
+        Adds compressed bodies to the post_bodies table and their terms to the body index. Must be called after the
+        posts rows (holding the previews) have been written. Does not commit.
+        :param rows: list of (post_id, body, compressed body) tuples
+        """
+        # The body_ids are assigned here rather than by sqlite (one at a time) so that the bodies are inserted in bulk
+        query = 'select ifnull((select seq from sqlite_sequence where name=\'post_bodies\'), 0) + 1;'
+        first_id = self.connection.execute(query).fetchone()[0]
+        self.connection.executemany('insert into post_bodies (body_id, post_id, body) values (?, ?, ?);',
+                                    ((first_id + i, post_id, blob) for i, (post_id, _, blob) in enumerate(rows)))
+        terms = [(first_id + i, index_terms(body)) for i, (_, body, _) in enumerate(rows)]
+        self._index(terms, 'insert into post_body_index (rowid, body) values (?, ?);')
+        self.connection.executemany('insert or ignore into post_body_terms (term) values (?);',
+                                    ((term,) for term in set().union(*(post_terms for _, post_terms in terms))))
+
+    def unindex(self, post_ids):
+        """
+        Removes the terms of the compressed bodies of posts from the body index. Must be called before the compressed
+        bodies are dropped (e.g. by updating the bodies of the posts). Does not commit.
+        :param post_ids: the post_ids of the posts (posts whose bodies are not compressed are ignored)
+        """
+        query = 'select body_id, body from post_bodies where post_id=?;'
+        terms = []
+        for post_id in post_ids:
+            row = self.connection.execute(query, (post_id,)).fetchone()
+            if row is not None:
+                terms.append((row[0], index_terms(decompress(row[1]))))
+        # A contentless index can only remove the terms of a row if it is given them again
+        self._index(terms, 'insert into post_body_index (post_body_index, rowid, body) values (\'delete\', ?, ?);')
+
+    def _index(self, terms, statement):
+        """
+        Runs statement (an insert into or delete from the body index) for each body.
+        :param terms: list of (body_id, set of the terms of the body) tuples - the index only records which terms each
+                      body has (detail=none), not where, so the order that they are given in does not matter
+        """
+        self.connection.executemany(statement, ((body_id, ' '.join(body_terms)) for body_id, body_terms in terms))
+
+    def _body_bytes(self):
+        """
+        :return: tuple of the number of bytes held by the body column of the posts table and by the post_bodies table
+        """
+        query = 'select (select ifnull(sum(length(cast(body as blob))), 0) from posts), ' \
+                '(select ifnull(sum(length(body)), 0) from post_bodies);'
+        return self.connection.execute(query).fetchone()
+
+    def enable(self, preview_length=PREVIEW_LENGTH):
+        """
+        Switches the database to compressed body storage - the bodies of existing posts that are worth compressing are
+        compressed, as are those of the posts that are added or edited from then on (by any DBManager). Runs in a
+        single transaction.
+        :param preview_length: number of characters of each compressed body to keep as its preview
+        :return: tuple of the number of bodies compressed, the number of bytes of body data before and after, and the
+                 number of seconds taken
+        """
+        start = time.perf_counter()
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute('begin immediate;')
+            before = sum(self._body_bytes())
+            query = 'select post_id, body from posts where length(body)>:preview_length ' \
+                    'and post_id not in (select post_id from post_bodies);'
+            rows = []
+            for post_id, body in cursor.execute(query, {'preview_length': preview_length}).fetchall():
+                preview, blob = self.prepare(body, preview_length)
+                if blob is not None:
+                    rows.append((post_id, body, blob, preview))
+            cursor.executemany('update posts set body=? where post_id=?;',
+                               ((preview, post_id) for post_id, _, _, preview in rows))
+            self.store([row[:3] for row in rows])
+            cursor.execute('delete from body_compression;')
+            cursor.execute('insert into body_compression (preview_length) values (?);', (preview_length,))
+            after = sum(self._body_bytes())
+            self.connection.commit()
+        except sqlite3.Error:
+            self.connection.rollback()
+            raise
+        self.preview_length = preview_length
+        return len(rows), before, after, time.perf_counter() - start
+
+    def disable(self):
+        """
+        Switches the database back to storing bodies uncompressed in the posts table - every compressed body is
+        decompressed and the body index is emptied. Runs in a single transaction.
+        :return: tuple of the number of bodies decompressed and the number of seconds taken
+        """
+        start = time.perf_counter()
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute('begin immediate;')
+            rows = cursor.execute('select post_id, body from post_bodies;').fetchall()
+            # Updating the body of a post drops its compressed body (see DBManager._create_post_bodies)
+            cursor.executemany('update posts set body=? where post_id=?;',
+                               ((decompress(blob), post_id) for post_id, blob in rows))
+            cursor.execute('insert into post_body_index (post_body_index) values (\'delete-all\');')
+            cursor.execute('delete from post_body_terms;')
+            cursor.execute('delete from body_compression;')
+            self.connection.commit()
+        except sqlite3.Error:
+            self.connection.rollback()
+            raise
+        self.preview_length = None
+        return len(rows), time.perf_counter() - start
@@ -0,0 +1,112 @@
+from collections import namedtuple
+
+# A write to a row of one of the tracked tables - key is the id (pid, uid, or bname) of the post, user, or badge that
+# the row belongs to and op is one of 'insert', 'update', or 'delete'
+Change = namedtuple('Change', ['seq', 'table', 'key', 'op'])
+
+
+class ChangelogCompactedError(Exception):
+    """
+    Raised when changes are read from a cursor that is behind the oldest change left in the changelog, i.e. some of the
+    changes that the consumer has not read yet have been compacted - the consumer has to rebuild from the tables.
+    """
+    pass
+
+
+class Changelog:
+    """
+    Class for reading the changelog table, which is filled by triggers on the tracked tables with a row for each
+    inserted, updated, or deleted row (see DBManager._create_changelog). Each change has a sequence number that is
+    greater than those of all the changes made before it, so a consumer (e.g. a cache or an index derived from the
+    tables) only needs to remember the sequence number of the last change it has read - its cursor - to catch up with
+    the changes made since, rather than rescanning the tables. Consumers can save their cursor in the database so that
+    compaction only removes the changes that every one of them has read.
+    """
+
+    # The tables whose writes are logged, mapped to the column holding the key that is logged for each of their rows
+    TRACKED_TABLES = {'users': 'uid', 'privileged': 'uid', 'badges': 'bname', 'ubadges': 'uid', 'posts': 'pid',
+                      'questions': 'pid', 'answers': 'pid', 'votes': 'pid', 'tags': 'pid'}
+
+    def __init__(self, connection):
+        """
+        Initializes an instance of this class.
+        :param connection: connection to the database
+        """
+        self.connection = connection
+
+    def latest_seq(self):
+        """
+        :return: the sequence number of the last change that has been logged (0 if there have been none) - a consumer
+                 that reads the tables in the same transaction is up to date as of this change
+        """
+        query = 'select seq from sqlite_sequence where name=\'changelog\';'
+        row = self.connection.execute(query).fetchone()
+        return 0 if row is None else row[0]
+
+    def read(self, cursor, limit=None, tables=None):
+        """
+        Reads the changes made after the change with sequence number cursor, in the order they were made.
+        :param cursor: sequence number of the last change that the consumer has read (0 to read from the start)
+        :param limit: max number of changes to read (optional parameter)
+        :param tables: only changes to these tables are read (optional parameter)
+        :return: list of Changes - the seq of the last one is the consumer's new cursor
+        """
+        query = 'select min(seq) from changelog;'
+        oldest = self.connection.execute(query).fetchone()[0]
+        # Sequence numbers are consecutive, so a gap between the cursor and the oldest change left means that changes
+        # have been compacted before the consumer read them
+        if (oldest if oldest is not None else self.latest_seq() + 1) > cursor + 1:
+            raise ChangelogCompactedError('changes after {} have been compacted'.format(cursor))
+        params = {'cursor': cursor, 'limit': -1 if limit is None else limit}
+        table_filter = ''
+        if tables is not None:
+            table_filter = ' and tbl in (' + ', '.join(':t{}'.format(i) for i in range(len(tables))) + ')'
+            params.update(('t{}'.format(i), table) for i, table in enumerate(tables))
+        query = 'select seq, tbl, key, op from changelog where seq>:cursor' + table_filter + ' ' \
+                'order by seq limit :limit;'
+        return [Change(*row) for row in self.connection.execute(query, params).fetchall()]
+
+    def get_cursor(self, consumer):
+        """
+        Gets the cursor that consumer last saved.
+        :param consumer: name of the consumer
+        :return: the saved cursor, or None if consumer has not saved one
+        """
+        query = 'select seq from changelog_consumers where consumer=:consumer;'
+        row = self.connection.execute(query, {'consumer': consumer}).fetchone()
+        return None if row is None else row[0]
+
+    def save_cursor(self, consumer, cursor):
+        """
+        Saves the cursor of consumer so that the changes it has not read yet are not compacted.
+        :param consumer: name of the consumer
+        :param cursor: sequence number of the last change that the consumer has read
+        """
+        insertion = 'insert or replace into changelog_consumers values (:consumer, :cursor);'
+        self.connection.execute(insertion, {'consumer': consumer, 'cursor': cursor})
+        self.connection.commit()
+
+    def remove_consumer(self, consumer):
+        """
+        Removes the saved cursor of consumer so that it no longer holds back compaction.
+        :param consumer: name of the consumer
+        """
+        self.connection.execute('delete from changelog_consumers where consumer=:consumer;', {'consumer': consumer})
+        self.connection.commit()
+
+    def compact(self, keep=10000):
+        """
+        Deletes the changes that every consumer with a saved cursor has read, apart from the last keep changes (which
+        are kept for consumers that do not save their cursor, such as in-memory indexes).
+        :param keep: number of the most recent changes that are always kept
+        :return: the number of changes that were deleted
+        """
+        query = 'select min(seq) from changelog_consumers;'
+        oldest_cursor = self.connection.execute(query).fetchone()[0]
+        through = self.latest_seq() - keep
+        if oldest_cursor is not None:
+            through = min(through, oldest_cursor)
+        num_deleted = self.connection.execute('delete from changelog where seq<=:through;',
+                                              {'through': through}).rowcount
+        self.connection.commit()
+        return num_deleted
@@ -1,6 +1,20 @@
 import sqlite3
 import string
 import random
+import sys
+from collections import namedtuple
+
+from body_store import INDEX_TOKENCHARS, PREVIEW_LENGTH, BodyStore, full_body_sql, preview_sql
+from changelog import Changelog
+from existence_filter import ExistenceFilter
+from search_index import SearchIndex
+from search_query import SearchQuery, ascii_lower, parse_search_query
+from vote_queue import VoteQueue
+
+# The outcome of a bulk moderation operation (see DBManager.bulk_add_tag, bulk_give_badge, and bulk_update_posts) -
+# applied and skipped list the pids (or uids, for badges) that the operation was and was not applied to, not_found the
+# given pids that match no post, and archived the given pids of archived (read-only) posts
+BulkResult = namedtuple('BulkResult', ['applied', 'skipped', 'not_found', 'archived'])
 
 
 class DBManager:
@@ -8,14 +22,393 @@ class DBManager:
     Class handling the interaction between python and the sqlite database this program is running on.
     """
 
-    def __init__(self, db_path):
+    # Tables whose rows are moved to the archive database when posts are archived - post_bodies comes before posts as
+    # deleting a post deletes its compressed body
+    ARCHIVED_TABLES = ('post_bodies', 'posts', 'questions', 'answers', 'votes', 'tags')
+    # The reputation of a user is derived from the columns of their user_stats row (see get_user_stats)
+    REPUTATION = 'votes_received + 10 * num_accepted + 5 * num_badges'
+
+    def __init__(self, db_path, archive_path=None, upgrade_schema=True):
         """
         Connects to the database at db_path.
         :param db_path: path to the database this program is to run on
+        :param archive_path: path to the database that old posts are archived in (optional parameter) - it is attached
+                             to the connection as the archive schema and created if it does not already exist
+        :param upgrade_schema: whether to bring the schemas of the database and archive up to date - only to be turned
+                               off when another DBManager of this process has already done so (see clone)
         """
         assert db_path.endswith('.db'), 'invalid file type - please specify the path to a database'
+        self.db_path = db_path
+        self.archive_path = archive_path
+        self.vote_queue = None
+        self.search_index = None
+        self.existence_filter = None
         self.connection = sqlite3.connect(db_path)
         self.cursor = self.connection.cursor()
+        if upgrade_schema:
+            self._upgrade_schema()
+        self.changelog = Changelog(self.connection)
+        self.body_store = BodyStore(self.connection)
+        self.has_archive = False
+        if archive_path is not None:
+            assert archive_path.endswith('.db'), 'invalid file type - please specify the path to an archive database'
+            self.cursor.execute('attach database :archive_path as archive;', {'archive_path': archive_path})
+            if upgrade_schema:
+                self._create_archive_schema()
+            self.has_archive = True
+
+    def _upgrade_schema(self):
+        """
+        Brings the database up to date with the auxiliary tables and indexes that this program maintains on top of the
+        schema in prj-tables.sql. The version of the schema is tracked using sqlite's user_version pragma so that each
+        upgrade is only ever applied once to a given database. The pending upgrades are applied in a single transaction
+        that takes the write lock before the version is read (again), so that when several processes open an old
+        database at once one of them upgrades it while the others wait for it and then find it up to date.
+        """
+        upgrades = [self._create_user_stats, self._create_thread_index, self._create_search_indexes,
+                    self._create_post_edits, self._create_surrogate_keys, self._create_changelog,
+                    self._create_post_bodies]
+        if self.cursor.execute('pragma user_version;').fetchone()[0] == len(upgrades):
+            return
+        self.cursor.execute('begin immediate;')
+        try:
+            version = self.cursor.execute('pragma user_version;').fetchone()[0]
+            for i in range(version, len(upgrades)):
+                upgrades[i]()
+            self.cursor.execute('pragma user_version={};'.format(len(upgrades)))
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+
+    def _create_user_stats(self):
+        """
+        Creates the user_stats table, which holds per-user aggregates that are maintained on each write so that a users
+        profile can be looked up with a single primary key probe, and populates it from the data already in the
+        database. The uid column holds lower cased uids as all uid matches are case-insensitive - they are lower cased
+        by sqlite's lower (or search_query.ascii_lower, which folds in the same way), which only folds ASCII letters.
+        """
+        creation = 'create table if not exists user_stats (' \
+                   'uid text primary key, ' \
+                   'num_posts int not null default 0, ' \
+                   'num_questions int not null default 0, ' \
+                   'num_answers int not null default 0, ' \
+                   'votes_received int not null default 0, ' \
+                   'num_badges int not null default 0, ' \
+                   'num_accepted int not null default 0);'
+        self.cursor.execute(creation)
+        users = 'select lower(uid) as uid from users union select lower(poster) from posts where poster is not null'
+        questions = 'select lower(p.poster) as uid, count(*) as num_questions ' \
+                    'from posts p, questions q where q.pid=p.pid group by lower(p.poster)'
+        answers = 'select lower(p.poster) as uid, count(*) as num_answers ' \
+                  'from posts p, answers a where a.pid=p.pid group by lower(p.poster)'
+        posts = 'select lower(poster) as uid, count(*) as num_posts from posts group by lower(poster)'
+        votes = 'select lower(p.poster) as uid, count(*) as votes_received ' \
+                'from posts p, votes v where v.pid=p.pid group by lower(p.poster)'
+        badges = 'select lower(uid) as uid, count(*) as num_badges from ubadges group by lower(uid)'
+        accepted = 'select lower(p.poster) as uid, count(*) as num_accepted ' \
+                   'from posts p, questions q where q.theaid=p.pid group by lower(p.poster)'
+        insertion = 'insert or replace into user_stats ' \
+                    'select uid, ifnull(num_posts, 0), ifnull(num_questions, 0), ifnull(num_answers, 0), ' \
+                    'ifnull(votes_received, 0), ifnull(num_badges, 0), ifnull(num_accepted, 0) ' \
+                    'from (' + users + ') left outer join (' + posts + ') using (uid) ' \
+                    'left outer join (' + questions + ') using (uid) ' \
+                    'left outer join (' + answers + ') using (uid) ' \
+                    'left outer join (' + votes + ') using (uid) ' \
+                    'left outer join (' + badges + ') using (uid) ' \
+                    'left outer join (' + accepted + ') using (uid);'
+        self.cursor.execute(insertion)
+
+    def _create_thread_index(self):
+        """
+        Creates an index on the qid column of the answers table so that the answers of a question can be found without
+        scanning the answers table.
+        """
+        self.cursor.execute('create index if not exists answers_qid_idx on answers (qid);')
+
+    def _create_search_indexes(self):
+        """
+        Creates the indexes on the posts table that the date range and poster filters of searches are served by. The
+        poster index is case-insensitive as all uid matches are.
+        """
+        self.cursor.execute('create index if not exists posts_pdate_idx on posts (pdate);')
+        self.cursor.execute('create index if not exists posts_poster_pdate_idx '
+                            'on posts (poster collate nocase, pdate);')
+
+    def _create_post_edits(self):
+        """
+        Creates the post_edits table, which logs the pid of each post whose title or body is updated or which is
+        deleted (e.g. archived), along with the triggers that fill it, so that the search index (see search_index.py)
+        can tell which of its posts have changed.
+        """
+        creation = 'create table if not exists post_edits (' \
+                   'seq integer primary key, ' \
+                   'pid text);'
+        self.cursor.execute(creation)
+        self.cursor.execute('create trigger if not exists posts_update_log after update of title, body on posts '
+                            'begin insert into post_edits (pid) values (new.pid); end;')
+        self.cursor.execute('create trigger if not exists posts_delete_log after delete on posts '
+                            'begin insert into post_edits (pid) values (old.pid); end;')
+
+    def _create_surrogate_keys(self):
+        """
+        Gives each user and post an integer key (user_id and post_id, which are aliases of the rowid) and adds columns
+        holding these keys to each table that refers to a user or a post, so that joins compare integers rather than
+        case-folded char(4) ids and the indexes they use are smaller. The uid and pid columns are kept (uniquely
+        indexed) as the public ids that users enter and see. Post ids are never reused (so that archived posts keep
+        theirs). Triggers fill in the integer keys of rows that are added without them, e.g. by other programs.
+        """
+        definitions = [
+            ('users', '(user_id integer primary key, uid char(4) unique, name text, pwd text, city text, crdate date)'),
+            ('privileged', '(user_id integer primary key, uid char(4) unique, foreign key (user_id) references users)'),
+            ('ubadges', '(user_id integer, uid char(4), bdate date, bname text, primary key (user_id, bdate), '
+                        'foreign key (user_id) references users, foreign key (bname) references badges)'),
+            ('posts', '(post_id integer primary key autoincrement, pid char(4) unique, pdate date, title text, '
+                      'body text, poster char(4), foreign key (poster) references users (uid))'),
+            ('tags', '(post_id integer, pid char(4), tag text, primary key (post_id, tag), '
+                     'foreign key (post_id) references posts)'),
+            ('votes', '(post_id integer, user_id integer, pid char(4), vno int, vdate text, uid char(4), '
+                      'primary key (post_id, vno), foreign key (post_id) references posts, '
+                      'foreign key (user_id) references users)'),
+            ('questions', '(post_id integer primary key, pid char(4) unique, theaid char(4), accepted_id integer, '
+                          'foreign key (post_id) references posts, foreign key (accepted_id) references answers)'),
+            ('answers', '(post_id integer primary key, pid char(4) unique, qid char(4), question_id integer, '
+                        'foreign key (post_id) references posts, foreign key (question_id) references questions)')
+        ]
+        fills = self._surrogate_key_fills('main', 'rowid', 'main.users_new')
+        fills.update({
+            'users': 'select rowid, uid, name, pwd, city, crdate from main.users',
+            # Rows of users that do not exist can not be given a user_id (their primary key) - see _keep_orphans
+            'privileged': 'select u.user_id, p.uid from main.privileged p, main.users_new u where u.uid=p.uid',
+            'ubadges': 'select (select user_id from main.users_new u where u.uid=b.uid), uid, bdate, bname '
+                       'from main.ubadges b'
+        })
+        orphans = self._surrogate_key_orphans('main')
+        orphans['privileged'] = 'not exists (select 1 from main.users u where u.uid=privileged.uid)'
+        self._keep_orphans('main', orphans)
+        self._rebuild_tables('main', definitions, fills)
+        self.cursor.execute('create index users_uid_nocase_idx on users (uid collate nocase);')
+        self.cursor.execute('create index posts_pid_nocase_idx on posts (pid collate nocase);')
+        self.cursor.execute('create index answers_question_idx on answers (question_id);')
+        self.cursor.execute('create index votes_user_idx on votes (user_id, post_id);')
+        # The indexes and triggers of the old tables were dropped along with them
+        self._create_search_indexes()
+        self._create_post_edits()
+        post_id = '(select post_id from posts where pid=new.pid)'
+        user_id = '(select user_id from users where uid=new.uid)'
+        triggers = [
+            ('votes', 'new.post_id is null or new.user_id is null',
+             'update votes set post_id=' + post_id + ', user_id=' + user_id + ' where rowid=new.rowid'),
+            ('tags', 'new.post_id is null', 'update tags set post_id=' + post_id + ' where rowid=new.rowid'),
+            ('ubadges', 'new.user_id is null', 'update ubadges set user_id=' + user_id + ' where rowid=new.rowid'),
+            # The post_id of questions and answers is assigned by sqlite when it is left out
+            ('questions', 'new.post_id is not ' + post_id + ' or (new.accepted_id is null and new.theaid is not null)',
+             'update questions set post_id=' + post_id + ', '
+             'accepted_id=(select post_id from posts where pid=new.theaid) where post_id=new.post_id'),
+            ('answers', 'new.post_id is not ' + post_id + ' or new.question_id is null',
+             'update answers set post_id=' + post_id + ', '
+             'question_id=(select post_id from posts where pid=new.qid) where post_id=new.post_id')
+        ]
+        for table, condition, update in triggers:
+            self.cursor.execute('create trigger ' + table + '_fill_keys after insert on ' + table + ' '
+                                'when ' + condition + ' begin ' + update + '; end;')
+        self.cursor.execute('create trigger questions_fill_accepted_id after update of theaid on questions '
+                            'when new.accepted_id is not (select post_id from posts where pid=new.theaid) '
+                            'begin update questions set accepted_id=(select post_id from posts where pid=new.theaid) '
+                            'where post_id=new.post_id; end;')
+
+    def _create_changelog(self):
+        """
+        Creates the changelog table along with the triggers that log each insert, update, and delete of a row of the
+        tracked tables (see changelog.Changelog), and the changelog_consumers table that consumers save their cursors
+        in. The seq column is autoincremented so that the sequence numbers of changes are never reused, even once older
+        changes have been compacted. The changelog replaces the post_edits table (which only logged edits of posts).
+        """
+        self.cursor.execute('drop trigger if exists posts_update_log;')
+        self.cursor.execute('drop trigger if exists posts_delete_log;')
+        self.cursor.execute('drop table if exists post_edits;')
+        creation = 'create table if not exists changelog (' \
+                   'seq integer primary key autoincrement, ' \
+                   'tbl text not null, ' \
+                   'key text, ' \
+                   'op text not null);'
+        self.cursor.execute(creation)
+        creation = 'create table if not exists changelog_consumers (' \
+                   'consumer text primary key, ' \
+                   'seq integer not null);'
+        self.cursor.execute(creation)
+        for table, key in Changelog.TRACKED_TABLES.items():
+            for op, row in (('insert', 'new'), ('update', 'new'), ('delete', 'old')):
+                self.cursor.execute('create trigger if not exists ' + table + '_' + op + '_log '
+                                    'after ' + op + ' on ' + table + ' '
+                                    'begin insert into changelog (tbl, key, op) '
+                                    'values (\'' + table + '\', ' + row + '.' + key + ', \'' + op + '\'); end;')
+
+    def _create_post_bodies(self):
+        """
+        Creates the tables of the optional compressed storage of post bodies (see body_store.BodyStore), which stay
+        empty until it is enabled: post_bodies holds the compressed bodies, post_body_index (a contentless FTS5 index,
+        which stores no text) the terms of each of them under its body_id (which is never reused), post_body_terms the
+        vocabulary of the index, and body_compression the preview length while compression is enabled. The index is
+        given the terms of a body separated by spaces, so its tokenizer only splits on whitespace. Triggers drop the
+        compressed body of a post when its body is updated or it is deleted, so that other programs that only know of
+        the posts table can not leave a stale body behind.
+        """
+        creation = 'create table if not exists post_bodies (' \
+                   'body_id integer primary key autoincrement, ' \
+                   'post_id integer unique not null, ' \
+                   'body blob not null, ' \
+                   'foreign key (post_id) references posts);'
+        self.cursor.execute(creation)
+        self.cursor.execute('create table if not exists post_body_terms (term text primary key) without rowid;')
+        self.cursor.execute('create table if not exists body_compression (preview_length integer not null);')
+        tokenchars = '\'' + INDEX_TOKENCHARS.replace('\'', '\'\'') + '\''
+        self.cursor.execute('create virtual table if not exists post_body_index using fts5(body, content=\'\', '
+                            'detail=none, columnsize=0, tokenize="ascii tokenchars ' + tokenchars.replace('"', '""') +
+                            '");')
+        for event in ('update of body', 'delete'):
+            self.cursor.execute('create trigger if not exists posts_' + event.split()[0] + '_body '
+                                'after ' + event + ' on posts '
+                                'begin delete from post_bodies where post_id=old.post_id; end;')
+
+    def _surrogate_key_fills(self, schema, post_id, users):
+        """
+        Gets the selections that fill the rebuilt posts, tags, votes, questions, and answers tables of schema (see
+        _rebuild_tables) with the rows of the old tables along with their integer keys.
+        :param schema: the schema of the database (i.e. 'main' or 'archive') that the tables are in
+        :param post_id: expression giving the post_id of each row of the old posts table in terms of its rowid
+        :param users: the users table that the user_ids of votes are looked up in
+        :return: dictionary mapping each table to its selection
+        """
+        posts = schema + '.posts_new'
+        return {
+            'posts': 'select ' + post_id + ', pid, pdate, title, body, poster from ' + schema + '.posts',
+            'tags': 'select (select post_id from ' + posts + ' p where p.pid=t.pid), pid, tag '
+                    'from ' + schema + '.tags t',
+            'votes': 'select (select post_id from ' + posts + ' p where p.pid=v.pid), '
+                     '(select user_id from ' + users + ' u where u.uid=v.uid), pid, vno, vdate, uid '
+                     'from ' + schema + '.votes v',
+            # Questions and answers without a post are left out as post_id is their primary key (see _keep_orphans)
+            'questions': 'select p.post_id, q.pid, q.theaid, (select post_id from ' + posts + ' where pid=q.theaid) '
+                         'from ' + schema + '.questions q, ' + posts + ' p where p.pid=q.pid',
+            'answers': 'select p.post_id, a.pid, a.qid, (select post_id from ' + posts + ' where pid=a.qid) '
+                       'from ' + schema + '.answers a, ' + posts + ' p where p.pid=a.pid'
+        }
+
+    def _surrogate_key_orphans(self, schema):
+        """
+        Gets the conditions selecting the rows of the questions and answers tables of schema that have no post, which
+        can not be given a post_id (their primary key) - see _keep_orphans.
+        :param schema: the schema of the database (i.e. 'main' or 'archive') that the tables are in
+        :return: dictionary mapping each table to its condition
+        """
+        return {table: 'not exists (select 1 from ' + schema + '.posts p where p.pid=' + table + '.pid)'
+                for table in ('questions', 'answers')}
+
+    def _keep_orphans(self, schema, orphans):
+        """
+        Copies the rows of tables of schema that are about to be rebuilt without them (as they refer to a user or post
+        that does not exist) into <table>_orphans tables, so that no data is lost by the rebuild, and reports how many
+        rows were set aside on stderr. Does not commit.
+        :param schema: the schema of the database (i.e. 'main' or 'archive') that the tables are in
+        :param orphans: dictionary mapping each table to the condition selecting the rows that the rebuild drops
+        """
+        for table, condition in orphans.items():
+            count = self.cursor.execute('select count(*) from ' + schema + '.' + table + ' where ' + condition + ';')
+            num_orphans = count.fetchone()[0]
+            if num_orphans == 0:
+                continue
+            self.cursor.execute('create table ' + schema + '.' + table + '_orphans as '
+                                'select * from ' + schema + '.' + table + ' where ' + condition + ';')
+            sys.stderr.write('PageBook: adding integer keys set aside {} row(s) of {}.{} that refer to a user or post '
+                             'that does not exist - they were moved into {}.{}_orphans\n'
+                             .format(num_orphans, schema, table, schema, table))
+        sys.stderr.flush()
+
+    def _rebuild_tables(self, schema, definitions, fills):
+        """
+        Replaces tables of schema with tables with new definitions that are filled from the old ones. All of the new
+        tables are created (under temporary names) and filled before any of the old tables are dropped, so that the
+        selections can refer to the old tables as well as to the new tables created before them. Does not commit.
+        :param schema: the schema of the database (i.e. 'main' or 'archive') that the tables are in
+        :param definitions: list of tuples (table, definition) in the order that the new tables are to be filled - the
+                            definition is the part of the create table statement following the name of the table
+        :param fills: dictionary mapping each table to the selection that fills its new table
+        """
+        for table, definition in definitions:
+            self.cursor.execute('create table ' + schema + '.' + table + '_new ' + definition + ';')
+            self.cursor.execute('insert into ' + schema + '.' + table + '_new ' + fills[table] + ';')
+        for table, _ in definitions:
+            self.cursor.execute('drop table ' + schema + '.' + table + ';')
+        for table, _ in definitions:
+            self.cursor.execute('alter table ' + schema + '.' + table + '_new rename to ' + table + ';')
+
+    def _create_archive_schema(self):
+        """
+        Creates the tables (and their indexes) that posts are archived into in the attached archive database if they do
+        not already exist. Their definitions are copied from the main database so that rows can be moved between the
+        two as is. Archives created before posts were given integer keys are first rebuilt with the new definitions -
+        their posts are given negative post_ids so that they can not clash with those of the posts archived later. This
+        is done in a single transaction that takes the write lock first (see _upgrade_schema).
+        """
+        self.cursor.execute('begin immediate;')
+        try:
+            self._upgrade_archive_schema()
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+
+    def _upgrade_archive_schema(self):
+        """
+        Creates or rebuilds the tables of the archive database (see _create_archive_schema). Does not commit.
+        """
+        columns = [column[1] for column in self.cursor.execute('pragma archive.table_info(posts);').fetchall()]
+        if len(columns) > 0 and 'post_id' not in columns:
+            query = 'select name, sql from main.sqlite_master where type=\'table\' and name=:table;'
+            fills = self._surrogate_key_fills('archive', '-rowid', 'main.users')
+            definitions = []
+            # Such archives predate compressed bodies - the post_bodies table is created along with the other new tables
+            for table in (table for table in self.ARCHIVED_TABLES if table in fills):
+                _, sql = self.cursor.execute(query, {'table': table}).fetchone()
+                definitions.append((table, sql[sql.index('('):]))
+            self._keep_orphans('archive', self._surrogate_key_orphans('archive'))
+            self._rebuild_tables('archive', definitions, fills)
+        query = 'select type, name, sql from main.sqlite_master ' \
+                'where tbl_name in (' + ', '.join('\'' + table + '\'' for table in self.ARCHIVED_TABLES) + ') ' \
+                'and type in (\'table\', \'index\') and sql is not null order by type desc;'
+        for object_type, name, sql in self.cursor.execute(query).fetchall():
+            # The sql of each table and index starts with "CREATE TABLE name" or "CREATE INDEX name"
+            prefix = 'create {} '.format(object_type)
+            creation = prefix + 'if not exists archive.' + sql[len(prefix):].lstrip()
+            self.cursor.execute(creation)
+
+    def _update_user_stats(self, uid, **increments):
+        """
+        Increments the columns of the user_stats row of the user identified by uid by the amounts passed as keyword
+        arguments (e.g. num_posts=1). The row is created first if it does not already exist. Does not commit, so that
+        the update is part of the same transaction as the write that caused it.
+        :param uid: uid of the user to update the stats of (case-insensitive)
+        :param increments: mapping of user_stats column names to the (possibly negative) amounts to add to them
+        """
+        if uid is None:
+            return
+        self.cursor.execute('insert or ignore into user_stats (uid) values (:uid);', {'uid': ascii_lower(uid)})
+        if len(increments) == 0:
+            return
+        assignments = ', '.join('{0}={0}+:{0}'.format(column) for column in increments)
+        update = 'update user_stats set ' + assignments + ' where uid=:uid;'
+        self.cursor.execute(update, dict(increments, uid=ascii_lower(uid)))
+
+    def _get_poster(self, pid):
+        """
+        Gets the uid of the user that posted the post identified by pid.
+        :param pid: pid of post to get the poster of (case-insensitive)
+        :return: uid of the poster of the post identified by pid or None if there is no such post
+        """
+        query = 'select poster from posts where pid=:pid collate nocase;'
+        row = self.cursor.execute(query, {'pid': pid}).fetchone()
+        return None if row is None else row[0]
 
     def _generate_id(self, length):
         """
@@ -28,85 +421,92 @@ class DBManager:
         _id = _id.join(random_chars)
         return _id
 
-    def _post_is_question(self, pid):
+    def _post_is_question(self, pid, schema='main'):
         """
         Checks if the pid passed to this method as a parameter is a question.
         :param pid: pid of to check if in questions table
+        :param schema: the schema of the database (i.e. 'main' or 'archive') to check the questions table of
         :return: boolean value corresponding to whether pid is in the questions tables or not
         """
-        post_is_question_query = 'select * from questions where lower(pid)=:pid;'
-        self.cursor.execute(post_is_question_query, {'pid': pid.lower()})
+        post_is_question_query = 'select q.pid from ' + schema + '.posts p, ' + schema + '.questions q ' \
+                                 'where p.pid=:pid collate nocase and q.post_id=p.post_id;'
+        self.cursor.execute(post_is_question_query, {'pid': pid})
         return False if self.cursor.fetchone() is None else True
 
-    def _post_is_answer(self, pid):
+    def _post_is_answer(self, pid, schema='main'):
         """
         Checks if the pid passed to this method as a parameter is an answer.
         :param pid: pid of to check if in answers table
+        :param schema: the schema of the database (i.e. 'main' or 'archive') to check the answers table of
         :return: boolean value corresponding to whether pid is in the answers tables or not
         """
-        post_is_answer_query = 'select * from answers where lower(pid)=:pid;'
-        self.cursor.execute(post_is_answer_query, {'pid': pid.lower()})
+        post_is_answer_query = 'select a.pid from ' + schema + '.posts p, ' + schema + '.answers a ' \
+                               'where p.pid=:pid collate nocase and a.post_id=p.post_id;'
+        self.cursor.execute(post_is_answer_query, {'pid': pid})
         return False if self.cursor.fetchone() is None else True
 
-    def _get_question_info(self, pid):
+    def _poster_reputation_sql(self, alias):
+        """
+        :param alias: the alias of the posts table in the query that the expression is to be used in
+        :return: sql expression giving the reputation of the poster of a post (0 if they have no stats) - a primary key
+                 probe of the user_stats table, which is only held by the main database
+        """
+        return 'ifnull((select ' + self.REPUTATION + ' from main.user_stats s ' \
+               'where s.uid=lower(' + alias + '.poster)), 0)'
+
+    def _get_question_info(self, pid, schema='main'):
         """
         Gets all the columns of the posts table as well as the number of votes and answers that the question identified
-        by pid has.
-        :param pid: pid to get pid, pdate, title, body, poster, num_answers, and num_votes for
-        :return: tuple corresponding to the pid, pdate, title, body, poster, num_answers, and num_votes of the question
-                 identified by pid
-        """
-        num_votes_query = 'select p.pid, ifnull(count(v.pid), 0) as num_votes ' \
-                          'from posts p, votes v ' \
-                          'where lower(p.pid)=:pid and v.pid=p.pid group by (p.pid)'
-        num_ans_query = 'select p.pid, ifnull(count(a.pid), 0) as num_answers ' \
-                        'from posts p, answers a ' \
-                        'where lower(p.pid)=:pid and a.qid=p.pid group by (p.pid)'
-        num_votes_and_questions_a = 'select pid, num_votes, num_answers ' \
-                                    'from (' + num_votes_query + ') left outer join (' + num_ans_query + ') using (pid)'
-        num_votes_and_questions_b = 'select pid, num_votes, num_answers ' \
-                                    'from (' + num_ans_query + ') left outer join (' + num_votes_query + ') using (pid)'
-        # Need to do a full join in order to cover all the possible cases
-        num_votes_and_questions = num_votes_and_questions_a + ' union ' + num_votes_and_questions_b
-        question_info_query = 'select p.pid, p.pdate, p.title, p.body, p.poster from posts p where lower(p.pid)=:pid'
-        query = 'select pid, pdate, title, body, poster, ifnull(num_answers, 0), ifnull(num_votes, 0) ' \
-                'from (' + question_info_query + ') left outer join (' + num_votes_and_questions + ') using (pid);'
-        self.cursor.execute(query, {'pid': pid.lower()})
+        by pid has and the reputation of its poster. A compressed body is only given as its preview (see get_post_body).
+        :param pid: pid to get pid, pdate, title, body, poster, num_answers, num_votes, and poster_reputation for
+        :param schema: the schema of the database (i.e. 'main' or 'archive') that the question is stored in
+        :return: tuple corresponding to the pid, pdate, title, body, poster, num_answers, num_votes, and
+                 poster_reputation of the question identified by pid
+        """
+        # The answers and votes of the question are counted using the answers_question_idx and votes primary key indexes
+        num_answers = '(select count(*) from ' + schema + '.answers a where a.question_id=p.post_id)'
+        num_votes = '(select count(*) from ' + schema + '.votes v where v.post_id=p.post_id)'
+        body = preview_sql('p', schema)
+        query = 'select p.pid, p.pdate, p.title, ' + body + ', p.poster, ' + num_answers + ', ' + num_votes + ', ' \
+                + self._poster_reputation_sql('p') + ' from ' + schema + '.posts p where p.pid=:pid collate nocase;'
+        self.cursor.execute(query, {'pid': pid})
         return self.cursor.fetchone()
 
-    def _get_answer_info(self, pid):
+    def _get_answer_info(self, pid, schema='main'):
         """
-        Gets all the columns of the posts table as well as the number of votes that the answer identified by pid has.
-        :param pid: pid to get pid, pdate, title, body, poster, and num_votes for
-        :return: tuple corresponding to the pid, pdate, title, body, poster, and num_votes of the answer with
-                 identified by pid
+        Gets all the columns of the posts table as well as the number of votes that the answer identified by pid has and
+        the reputation of its poster. A compressed body is only given as its preview (see get_post_body).
+        :param pid: pid to get pid, pdate, title, body, poster, num_votes, and poster_reputation for
+        :param schema: the schema of the database (i.e. 'main' or 'archive') that the answer is stored in
+        :return: tuple corresponding to the pid, pdate, title, body, poster, num_votes, and poster_reputation of the
+                 answer with identified by pid
         """
-        num_votes_query = 'select p.pid, ifnull(count(v.pid), 0) as num_votes ' \
-                          'from posts p, votes v ' \
-                          'where lower(p.pid)=:pid and v.pid=p.pid group by (p.pid)'
-        answer_info_query = 'select p.pid, p.pdate, p.title, p.body, p.poster from posts p where lower(p.pid)=:pid'
-        query = 'select pid, pdate, title, body, poster, ifnull(num_votes, 0) ' \
-                'from (' + answer_info_query + ') left outer join (' + num_votes_query + ') using (pid);'
-        self.cursor.execute(query, {'pid': pid.lower()})
+        num_votes = '(select count(*) from ' + schema + '.votes v where v.post_id=p.post_id)'
+        query = 'select p.pid, p.pdate, p.title, ' + preview_sql('p', schema) + ', p.poster, ' + num_votes + ', ' \
+                + self._poster_reputation_sql('p') + ' from ' + schema + '.posts p where p.pid=:pid collate nocase;'
+        self.cursor.execute(query, {'pid': pid})
         return self.cursor.fetchone()
 
     def _get_printable_post_info(self, sorted_pids):
         """
         Gets the pid, pdate, title, body, poster, num_answers (only in the case that the post of relevance is a
-        question), and num_votes for each post identified by the pids in sorted_pids. Returns a list of these tuples.
-        :param sorted_pids: List of tuples (pid, # of keywords matched) where the pids correspond to posts in the posts
-                            table that matched at least one of the searched keywords, sorted in order from
-                            pids corresponding to posts that matched the largest number of keywords first
+        question), num_votes, and poster_reputation for each post identified by the pids in sorted_pids. Returns a list
+        of these tuples.
+        :param sorted_pids: List of tuples (pid, # of keywords matched) or (pid, # of keywords matched, schema) where
+                            the pids correspond to posts in the posts table (of the main database unless a schema is
+                            given) that matched at least one of the searched keywords, sorted in order from pids
+                            corresponding to posts that matched the largest number of keywords first
         :return: List of the tuples corresponding to the info retreived from the database by either
                  _get_question_info(..) or _get_answer_info(..)
         """
         printable_post_info = []
         for i in range(len(sorted_pids)):
             post_pid = sorted_pids[i][0]
-            if self._post_is_question(post_pid):
-                printable_post_info.append(self._get_question_info(post_pid))
-            elif self._post_is_answer(post_pid):
-                printable_post_info.append(self._get_answer_info(post_pid))
+            schema = sorted_pids[i][2] if len(sorted_pids[i]) > 2 else 'main'
+            if self._post_is_question(post_pid, schema):
+                printable_post_info.append(self._get_question_info(post_pid, schema))
+            elif self._post_is_answer(post_pid, schema):
+                printable_post_info.append(self._get_answer_info(post_pid, schema))
         return printable_post_info
 
     def pid_exists(self, pid_to_check):
@@ -115,9 +515,14 @@ class DBManager:
         :param pid_to_check: pid to check whether it already exists
         :return: boolean value corresponding to whether or not pid_to_check already exists (True if already exists)
         """
-        query = 'select * from posts where lower(posts.pid)=:pid_to_check;'
-        self.cursor.execute(query, {'pid_to_check': pid_to_check.lower()})
-        return False if self.cursor.fetchone() is None else True
+        if self.existence_filter is not None and not self.existence_filter.may_contain('pid', pid_to_check):
+            return False
+        query = 'select * from posts where pid=:pid_to_check collate nocase;'
+        self.cursor.execute(query, {'pid_to_check': pid_to_check})
+        exists = self.cursor.fetchone() is not None or self.post_is_archived(pid_to_check)
+        if self.existence_filter is not None:
+            self.existence_filter.confirm('pid', exists)
+        return exists
 
     def uid_exists(self, uid_to_check):
         """
@@ -126,9 +531,14 @@ class DBManager:
         :return: a boolean value representing whether or not there is a user in the database who has a user id equal
                  to login_uid (case-insensitive)
         """
-        query = 'select * from users where lower(uid)=:uid_to_check;'
-        self.cursor.execute(query, {'uid_to_check': uid_to_check.lower()})
-        return False if self.cursor.fetchone() is None else True
+        if self.existence_filter is not None and not self.existence_filter.may_contain('uid', uid_to_check):
+            return False
+        query = 'select * from users where uid=:uid_to_check collate nocase;'
+        self.cursor.execute(query, {'uid_to_check': uid_to_check})
+        exists = self.cursor.fetchone() is not None
+        if self.existence_filter is not None:
+            self.existence_filter.confirm('uid', exists)
+        return exists
 
     def valid_login(self, login_uid, login_pwd):
         """
@@ -139,8 +549,8 @@ class DBManager:
         :return: a boolean value representing whether or not there is a user in the database who has a user id equal
                  to login_uid (case-insensitive) and a password equal to login_pwd (case-sensitive)
         """
-        query = 'select * from users where lower(uid)=:login_uid and pwd=:login_pwd;'
-        self.cursor.execute(query, {'login_uid': login_uid.lower(), 'login_pwd': login_pwd})
+        query = 'select * from users where uid=:login_uid collate nocase and pwd=:login_pwd;'
+        self.cursor.execute(query, {'login_uid': login_uid, 'login_pwd': login_pwd})
         return False if self.cursor.fetchone() is None else True
 
     def get_uid_from_table(self, uid):
@@ -149,8 +559,8 @@ class DBManager:
         :param uid: uid to get proper uid of from users table (case as registered)
         :return: uid from users table corresponding to uid
         """
-        query = 'select uid from users where lower(uid)=:uid;'
-        self.cursor.execute(query, {'uid': uid.lower()})
+        query = 'select uid from users where uid=:uid collate nocase;'
+        self.cursor.execute(query, {'uid': uid})
         return self.cursor.fetchone()[0]
 
     def add_user(self, new_uid, name, pwd, city):
@@ -161,9 +571,13 @@ class DBManager:
         :param pwd: password of new user
         :param city: city of new user
         """
-        insertion = 'insert into users values (:new_uid, :name, :pwd, :city, date(\'now\', \'localtime\'));'
+        insertion = 'insert into users (uid, name, pwd, city, crdate) ' \
+                    'values (:new_uid, :name, :pwd, :city, date(\'now\', \'localtime\'));'
         self.cursor.execute(insertion, {'new_uid': new_uid, 'name': name, 'pwd': pwd, 'city': city})
+        self._update_user_stats(new_uid)
         self.connection.commit()
+        if self.existence_filter is not None:
+            self.existence_filter.add('uid', new_uid)
 
     def new_post(self, new_title, new_body, poster, is_an_answer=False, associated_question=None):
         """
@@ -183,54 +597,174 @@ class DBManager:
         while not unique:
             new_pid = self._generate_id(4)
             unique = not self.pid_exists(new_pid)
-        insertion = 'insert into posts values (:new_pid, date(\'now\', \'localtime\'), :title, :body, :poster);'
+        body, compressed_body = self.body_store.prepare(new_body)
+        insertion = 'insert into posts (pid, pdate, title, body, poster) ' \
+                    'values (:new_pid, date(\'now\', \'localtime\'), :title, :body, :poster);'
         self.cursor.execute(
-            insertion, {'new_pid': new_pid, 'title': new_title, 'body': new_body, 'poster': poster}
+            insertion, {'new_pid': new_pid, 'title': new_title, 'body': body, 'poster': poster}
         )
+        new_post_id = self.cursor.lastrowid
+        if compressed_body is not None:
+            self.body_store.store([(new_post_id, new_body, compressed_body)])
         if not is_an_answer:
-            insertion = 'insert into questions (pid) values (:new_pid);'
-            self.cursor.execute(insertion, {'new_pid': new_pid})
+            insertion = 'insert into questions (post_id, pid) values (:new_post_id, :new_pid);'
+            self.cursor.execute(insertion, {'new_post_id': new_post_id, 'new_pid': new_pid})
+            self._update_user_stats(poster, num_posts=1, num_questions=1)
         else:
-            insertion = 'insert into answers values (:new_pid, :qid);'
-            self.cursor.execute(insertion, {'new_pid': new_pid, 'qid': associated_question})
+            insertion = 'insert into answers (post_id, pid, qid, question_id) ' \
+                        'values (:new_post_id, :new_pid, :qid, (select post_id from posts where pid=:qid));'
+            self.cursor.execute(insertion, {'new_post_id': new_post_id, 'new_pid': new_pid, 'qid': associated_question})
+            self._update_user_stats(poster, num_posts=1, num_answers=1)
         self.connection.commit()
+        if self.existence_filter is not None:
+            self.existence_filter.add('pid', new_pid)
+
+    def rank_search(self, search_query, include_archive=None, date_from=None, date_to=None, poster=None):
+        """
+        Searches the posts table of the database. Finds all posts that match search_query - by default (i.e. when
+        keywords are simply listed one after the other) these are the posts that contain at least one keyword in either
+        their title, body, or tag fields (see search_query.parse_search_query for the full syntax). The query is
+        compiled into a single sql query so that the filtering and ranking of the posts are done by the database. The
+        date range and poster filters are served by the indexes on the posts table so only the posts that pass them
+        are matched against the keywords. Only the pids are retrieved so that the posts can be hydrated a page at a
+        time (see hydrate_posts).
+        :param search_query: a SearchQuery or the search string to parse into one (ideally represents the search string
+                             enterred by the user at the search screen)
+        :param include_archive: whether archived posts should also be searched - if not specified archived posts are
+                                only searched when search_query includes in:archive (ignored if there is no archive)
+        :param date_from: only posts posted on or after this date (YYYY-MM-DD) are retrieved (optional parameter)
+        :param date_to: only posts posted on or before this date (YYYY-MM-DD) are retrieved (optional parameter)
+        :param poster: only posts posted by the user with this uid (case-insensitive) are retrieved (optional parameter)
+        :return: a list of tuples (pid, # of terms matched, schema) of the posts that match search_query, sorted by the
+                 number of terms of search_query matched in descending order
+        """
+        if not isinstance(search_query, SearchQuery):
+            search_query = parse_search_query(search_query)
+        if include_archive is None:
+            include_archive = 'archive' in search_query.options
+        schemas = ['main', 'archive'] if include_archive and self.has_archive else ['main']
+        if self.search_index is not None and schemas == ['main']:
+            return self.search_index.rank(search_query, date_from, date_to, poster)
+        filters = ''
+        if poster is not None:
+            filters += 'p.poster=:poster collate nocase and '
+        if date_from is not None:
+            filters += 'p.pdate>=:date_from and '
+        if date_to is not None:
+            filters += 'p.pdate<=:date_to and '
+        searches = []
+        params = {}
+        for schema in schemas:
+            # Terms are given the same parameters in each schema, apart from those that only the main schema uses
+            condition, score, schema_params = search_query.to_sql('p', schema)
+            params.update(schema_params)
+            searches.append('select p.pid, ' + score + ' as score, \'' + schema + '\', p.pdate as pdate '
+                            'from ' + schema + '.posts p '
+                            'where ' + filters + condition)
+        params.update({'poster': poster, 'date_from': date_from, 'date_to': date_to})
+        search = 'select * from (' + ' union all '.join(searches) + ') order by score desc, pdate desc;'
+        self.cursor.execute(search, params)
+        return [row[:3] for row in self.cursor.fetchall()]
 
-    def execute_search(self, keywords_to_search):
-        """
-        Searches the posts table of the database. Retrieves all posts that contain at least one keyword from the list
-        keywords_to_search in either their title, body, or tag fields.
-        :param keywords_to_search: list of keywords to search (ideally represents the space separated keywords enterred
-                                   by the user at the search screen)
-        :return: a list corresponding to the pids of the posts that contain at least one keyword from the list
-                 keywords_to_search in either their title, body, or tag fields, sorted by the number of keywords
-                 matched in descending order.
-        """
-        search_results = {}
-        search = 'select p.pid ' \
-                 'from posts p ' \
-                 'where lower(p.title) like :keyword or lower(p.body) like :keyword or exists(' \
-                 'select pid from tags t where t.pid=p.pid and lower(t.tag) like :keyword);'
-        for keyword in keywords_to_search:
-            self.cursor.execute(search, {'keyword': '%' + keyword.lower() + '%'})
-            posts = self.cursor.fetchall()
-            for i in range(len(posts)):
-                post = posts[i][0]
-                if post in search_results:
-                    search_results[post] += 1
-                else:
-                    search_results[post] = 1
-        return self._get_printable_post_info(sorted(search_results.items(), key=lambda x: x[1], reverse=True))
+    def hydrate_posts(self, ranked_pids):
+        """
+        Gets the details of the posts of a page of search results.
+        :param ranked_pids: list of tuples (pid, # of terms matched, schema) as returned by rank_search
+        :return: list of the tuples corresponding to the data-fields of the posts (see _get_printable_post_info)
+        """
+        if self.search_index is not None and all(len(ranked) < 3 or ranked[2] == 'main' for ranked in ranked_pids):
+            posts = self.search_index.hydrate(ranked_pids)
+            # The snapshot only holds the posts, so the reputations of their posters are read with a single query
+            posters = sorted({ascii_lower(post[4]) for post in posts if post[4] is not None})
+            query = 'select uid, ' + self.REPUTATION + ' from user_stats ' \
+                    'where uid in (' + ', '.join('?' * len(posters)) + ');'
+            reputations = dict(self.cursor.execute(query, posters).fetchall())
+            return [post + (reputations.get(None if post[4] is None else ascii_lower(post[4]), 0),) for post in posts]
+        return self._get_printable_post_info(ranked_pids)
+
+    def execute_search(self, search_query, include_archive=None, date_from=None, date_to=None, poster=None):
+        """
+        Searches the posts table of the database and hydrates every matching post (see rank_search for the
+        parameters).
+        :return: a list corresponding to the pids of the posts that match search_query, sorted by the number of terms
+                 of search_query matched in descending order.
+        """
+        return self.hydrate_posts(self.rank_search(search_query, include_archive, date_from, date_to, poster))
+
+    def get_thread(self, qid, page=0, page_size=5):
+        """
+        Gets the question identified by qid along with one page of its answers, the number of votes each of them has,
+        and which answer (if any) is the accepted answer, using a single query. Answers are ordered with the accepted
+        answer first, followed by the rest of the answers from most to least votes.
+        :param qid: pid of the question to get the thread of (case-insensitive)
+        :param page: the page of answers to get (starting from 0)
+        :param page_size: the number of answers on each page
+        :return: tuple consisting of a tuple corresponding to the pid, pdate, title, body, poster, num_answers,
+                 num_votes, and poster_reputation of the question (None if there is no question identified by qid) and
+                 a list of tuples corresponding to the pid, pdate, title, body, poster, num_votes, poster_reputation,
+                 and is_accepted of each answer on the requested page
+        """
+        num_votes = '(select count(*) from votes v where v.post_id=p.post_id)'
+        body = full_body_sql('p')
+        reputation = self._poster_reputation_sql('p')
+        # The question is looked up by its pid using the posts_pid_nocase_idx index - the last column is the number of
+        # answers of the question and whether each answer is the accepted answer
+        question = 'select q.post_id, q.accepted_id from posts qp, questions q ' \
+                   'where qp.pid=:qid collate nocase and q.post_id=qp.post_id'
+        question_query = 'select 0 as is_answer, p.pid, p.pdate, p.title, ' + body + ', p.poster, ' \
+                         + num_votes + ' as num_votes, ' + reputation + ', ' \
+                         '(select count(*) from answers a where a.question_id=q.post_id) as extra ' \
+                         'from (' + question + ') q, posts p where p.post_id=q.post_id'
+        answers_query = 'select 1 as is_answer, p.pid, p.pdate, p.title, ' + body + ', p.poster, ' \
+                        + num_votes + ' as num_votes, ' + reputation + ', ' \
+                        'ifnull(p.post_id=q.accepted_id, 0) as extra ' \
+                        'from (' + question + ') q, answers a, posts p ' \
+                        'where a.question_id=q.post_id and p.post_id=a.post_id ' \
+                        'order by extra desc, num_votes desc, p.pdate, p.pid ' \
+                        'limit :limit offset :offset'
+        # The order of the rows of a union is only guaranteed by an order by on the union itself
+        query = 'select * from (' + question_query + ') union all select * from (' + answers_query + ') ' \
+                'order by is_answer, extra desc, num_votes desc, pdate, pid;'
+        self.cursor.execute(query, {'qid': qid, 'limit': page_size, 'offset': page * page_size})
+        question = None
+        answers = []
+        for is_answer, pid, pdate, title, body, poster, votes, reputation, extra in self.cursor.fetchall():
+            if is_answer:
+                answers.append((pid, pdate, title, body, poster, votes, reputation, bool(extra)))
+            else:
+                question = (pid, pdate, title, body, poster, extra, votes, reputation)
+        return question, answers
+
+    def get_post_body(self, pid):
+        """
+        Gets the full body of a post - lists of posts (such as search results) only hold the preview of a compressed
+        body, which is decompressed here.
+        :param pid: pid of the post (case-insensitive), which may be archived
+        :return: the body of the post identified by pid or None if there is no such post
+        """
+        for schema in ['main', 'archive'] if self.has_archive else ['main']:
+            query = 'select ' + full_body_sql('p', schema) + ' from ' + schema + '.posts p ' \
+                    'where p.pid=:pid collate nocase;'
+            row = self.cursor.execute(query, {'pid': pid}).fetchone()
+            if row is not None:
+                return row[0]
+        return None
 
     def get_vote_eligibility(self, uid, pid):
         """
-        Checks if a user has already voted on a post or not.
+        Checks if a user has already voted on a post or not (including votes that are queued but not yet flushed if the
+        vote queue is enabled).
         :param uid: uid of user to check whether they have already voted on the post identified by pid
         :param pid: pid of post to check
         :return: boolean value corresponding to whether the user identified by uid has already voted on post pid (True
                  if they have not yet, False otherwise)
         """
-        query = 'select * from votes where lower(pid)=:pid and lower(uid)=:uid;'
-        self.cursor.execute(query, {'pid': pid.lower(), 'uid': uid.lower()})
+        if self.vote_queue is not None and self.vote_queue.has_pending_vote(pid, uid):
+            return False
+        query = 'select * from posts p, users u, votes v ' \
+                'where p.pid=:pid collate nocase and u.uid=:uid collate nocase ' \
+                'and v.post_id=p.post_id and v.user_id=u.user_id;'
+        self.cursor.execute(query, {'pid': pid, 'uid': uid})
         return True if self.cursor.fetchone() is None else False
 
     def check_privilege(self, uid):
@@ -239,23 +773,82 @@ class DBManager:
         :param uid: uid of user to check if privileged
         :return: boolean value corresponding to whether the user identified by uid is a privileged user (True if so)
         """
-        query = 'select * from privileged where lower(uid)=:uid;'
-        self.cursor.execute(query, {'uid': uid.lower()})
+        query = 'select * from users u, privileged p where u.uid=:uid collate nocase and p.user_id=u.user_id;'
+        self.cursor.execute(query, {'uid': uid})
         return False if self.cursor.fetchone() is None else True
 
+    def enable_vote_queue(self, journal_path, batch_size=500, flush_interval=1.0, fsync=False):
+        """
+        Enables the write-behind vote queue (see vote_queue.VoteQueue) - from then on add_vote queues votes which are
+        flushed to the database in batches by a background thread with its own connection. Any votes left in the
+        journal by a previous run are flushed.
+        :param journal_path: path to the journal file that queued votes are appended to
+        :param batch_size: number of queued votes that triggers a flush before flush_interval has elapsed
+        :param flush_interval: max number of seconds that a vote is queued for before it is flushed
+        :param fsync: whether each journal append should be synced to disk
+        """
+        self.vote_queue = VoteQueue(self.clone, journal_path, batch_size, flush_interval, fsync)
+
+    def add_votes(self, votes):
+        """
+        Adds a batch of votes in a single transaction. Votes on posts that do not exist and votes from users who have
+        already voted on the post (either previously or earlier in the batch) are skipped so that adding the same batch
+        more than once has no further effect.
+        :param votes: list of tuples (pid, uid, vdate) - pids are matched as stored in the posts table
+        :return: the number of votes that were added
+        """
+        try:
+            self.cursor.execute('begin immediate;')
+            self.cursor.execute('create temp table if not exists pending_votes (pid text, uid text, vdate text);')
+            self.cursor.execute('delete from temp.pending_votes;')
+            self.cursor.executemany('insert into temp.pending_votes values (?, ?, ?);', votes)
+            query = 'select pv.pid, pv.uid, pv.vdate, p.poster, p.post_id, u.user_id ' \
+                    'from temp.pending_votes pv join posts p on p.pid=pv.pid ' \
+                    'left outer join users u on u.uid=pv.uid collate nocase ' \
+                    'where not exists (select * from votes v where v.post_id=p.post_id and v.user_id=u.user_id) ' \
+                    'order by pv.rowid;'
+            new_votes = []
+            seen = set()
+            votes_received = {}
+            for pid, uid, vdate, poster, post_id, user_id in self.cursor.execute(query).fetchall():
+                if (pid, ascii_lower(uid)) in seen:
+                    continue
+                seen.add((pid, ascii_lower(uid)))
+                new_votes.append({'pid': pid, 'uid': uid, 'vdate': vdate, 'post_id': post_id, 'user_id': user_id})
+                if poster is not None:
+                    votes_received[ascii_lower(poster)] = votes_received.get(ascii_lower(poster), 0) + 1
+            # The vno of each vote is generated as it is inserted so that votes on the same post get consecutive vnos
+            insertion = 'insert into votes (post_id, user_id, pid, vno, vdate, uid) ' \
+                        'values (:post_id, :user_id, :pid, ' \
+                        '(select ifnull(max(vno), 0) + 1 from votes where post_id=:post_id), :vdate, :uid);'
+            self.cursor.executemany(insertion, new_votes)
+            for poster in votes_received:
+                self._update_user_stats(poster, votes_received=votes_received[poster])
+            self.cursor.execute('delete from temp.pending_votes;')
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        return len(new_votes)
+
     def add_vote(self, pid, current_user):
         """
-        Adds a vote from the user identified by current_user to the post identified by pid.
+        Adds a vote from the user identified by current_user to the post identified by pid. If the vote queue is enabled
+        the vote is queued and written to the database by the next flush.
         :param pid: pid of post to add a vote to
         :param current_user: uid of user who is adding a vote
         """
-        # Generates a vno by adding 1 to the current max vno associated with the post
-        query = 'select ifnull(max(vno), 0) from votes where lower(pid)=:pid;'
-        self.cursor.execute(query, {'pid': pid.lower()})
-        highest_current_vno = self.cursor.fetchone()[0]
-        new_vno = highest_current_vno + 1
-        insertion = 'insert into votes values (:pid, :vno, date(\'now\', \'localtime\'), :current_user);'
-        self.cursor.execute(insertion, {'pid': pid, 'vno': new_vno, 'current_user': current_user})
+        if self.vote_queue is not None:
+            self.vote_queue.enqueue(pid, current_user)
+            return
+        # Generates a vno by adding 1 to the current max vno associated with the post (within the insertion, so that
+        # concurrent votes on the same post can not be given the same vno)
+        insertion = 'insert into votes (post_id, user_id, pid, vno, vdate, uid) ' \
+                    'select p.post_id, (select user_id from users where uid=:current_user collate nocase), :pid, ' \
+                    '(select ifnull(max(vno), 0) + 1 from votes v where v.post_id=p.post_id), ' \
+                    'date(\'now\', \'localtime\'), :current_user from posts p where p.pid=:pid collate nocase;'
+        self.cursor.execute(insertion, {'pid': pid, 'current_user': current_user})
+        self._update_user_stats(self._get_poster(pid), votes_received=1)
         self.connection.commit()
 
     def check_for_accepted_answer(self, pid):
@@ -265,8 +858,9 @@ class DBManager:
         :return: boolean value corresponding to whether the question linked to the answer identified by pid has
                  an accepted answer (True if so, False otherwise)
         """
-        query = 'select q.theaid from questions q where q.pid=(select a.qid from answers a where lower(a.pid)=:pid);'
-        self.cursor.execute(query, {'pid': pid.lower()})
+        query = 'select q.theaid from posts p, answers a, questions q ' \
+                'where p.pid=:pid collate nocase and a.post_id=p.post_id and q.post_id=a.question_id;'
+        self.cursor.execute(query, {'pid': pid})
         return False if self.cursor.fetchone()[0] is None else True
 
     def update_accepted_answer(self, pid_of_new_answer):
@@ -275,10 +869,17 @@ class DBManager:
         identified by pid_of_new_answer.
         :param pid_of_new_answer: pid of answer to set as the accepted answer to the question it is linked to
         """
-        query = 'select qid from answers where lower(pid)=:pid_of_new_answer;'
-        qid = self.cursor.execute(query, {'pid_of_new_answer': pid_of_new_answer.lower()}).fetchone()[0]
-        update = 'update questions set theaid=:pid_of_new_answer where pid=:qid;'
-        self.cursor.execute(update, {'pid_of_new_answer': pid_of_new_answer, 'qid': qid})
+        query = 'select a.post_id, a.question_id, q.theaid from posts p, answers a, questions q ' \
+                'where p.pid=:pid_of_new_answer collate nocase and a.post_id=p.post_id and q.post_id=a.question_id;'
+        answer_id, question_id, old_answer = \
+            self.cursor.execute(query, {'pid_of_new_answer': pid_of_new_answer}).fetchone()
+        update = 'update questions set theaid=:pid_of_new_answer, accepted_id=:answer_id where post_id=:question_id;'
+        self.cursor.execute(update, {'pid_of_new_answer': pid_of_new_answer, 'answer_id': answer_id,
+                                     'question_id': question_id})
+        if old_answer is None or old_answer.lower() != pid_of_new_answer.lower():
+            if old_answer is not None:
+                self._update_user_stats(self._get_poster(old_answer), num_accepted=-1)
+            self._update_user_stats(self._get_poster(pid_of_new_answer), num_accepted=1)
         self.connection.commit()
 
     def check_badge_eligibility(self, poster):
@@ -289,8 +890,9 @@ class DBManager:
         :return: boolean value corresponding to whether the user identified by poster has already received a
                  badge on the current date (False if so, True otherwise)
         """
-        query = 'select * from ubadges where lower(uid)=:poster and bdate=date(\'now\', \'localtime\');'
-        self.cursor.execute(query, {'poster': poster.lower()})
+        query = 'select * from users u, ubadges b ' \
+                'where u.uid=:poster collate nocase and b.user_id=u.user_id and b.bdate=date(\'now\', \'localtime\');'
+        self.cursor.execute(query, {'poster': poster})
         return True if self.cursor.fetchone() is None else False
 
     def get_existing_badges(self):
@@ -316,8 +918,11 @@ class DBManager:
         """
         query = 'select bname from badges where lower(bname)=:name;'
         bname = self.cursor.execute(query, {'name': name.lower()}).fetchone()[0]
-        insertion = 'insert into ubadges values (:uid, date(\'now\', \'localtime\'), :name);'
+        insertion = 'insert into ubadges (user_id, uid, bdate, bname) ' \
+                    'values ((select user_id from users where uid=:uid collate nocase), :uid, ' \
+                    'date(\'now\', \'localtime\'), :name);'
         self.cursor.execute(insertion, {'uid': uid, 'name': bname})
+        self._update_user_stats(uid, num_badges=1)
         self.connection.commit()
 
     def add_tag_to_post(self, pid, tag_name):
@@ -329,11 +934,13 @@ class DBManager:
                  name that has been given to the post identified by pid this function returns False, otherwise it
                  returns True after successfully adding the tag
         """
-        query = 'select * from tags where lower(pid)=:pid and lower(tag)=:tag_name;'
-        self.cursor.execute(query, {'pid': pid.lower(), 'tag_name': tag_name.lower()})
+        query = 'select * from posts p, tags t ' \
+                'where p.pid=:pid collate nocase and t.post_id=p.post_id and lower(t.tag)=:tag_name;'
+        self.cursor.execute(query, {'pid': pid, 'tag_name': tag_name.lower()})
         if len(self.cursor.fetchall()) >= 1:
             return False
-        insertion = 'insert into tags values (:pid, :tag_name);'
+        insertion = 'insert into tags (post_id, pid, tag) ' \
+                    'values ((select post_id from posts where pid=:pid collate nocase), :pid, :tag_name);'
         self.cursor.execute(insertion, {'pid': pid, 'tag_name': tag_name})
         self.connection.commit()
         return True
@@ -345,19 +952,280 @@ class DBManager:
         :param new_title: new title of post (if no value is passed the title field of the post will not be updated)
         :param new_body: new body of post (if no value is passed the body field of the post will not be updated)
         """
+        body = new_body
+        compressed_body = None
+        if new_body is not None:
+            query = 'select post_id from posts where pid=:pid collate nocase;'
+            post_ids = [post_id for post_id, in self.cursor.execute(query, {'pid': pid}).fetchall()]
+            # The terms of the old body are removed from the body index before the update drops it
+            self.body_store.unindex(post_ids)
+            body, compressed_body = self.body_store.prepare(new_body)
         if (new_title is not None) and (new_body is not None):
-            update = 'update posts set title=:new_title, body=:new_body where lower(pid)=:pid;'
-            self.cursor.execute(update, {'new_title': new_title, 'new_body': new_body, 'pid': pid.lower()})
+            update = 'update posts set title=:new_title, body=:new_body where pid=:pid collate nocase;'
+            self.cursor.execute(update, {'new_title': new_title, 'new_body': body, 'pid': pid})
         elif new_body is not None:
-            update = 'update posts set body=:new_body where lower(pid)=:pid;'
-            self.cursor.execute(update, {'new_body': new_body, 'pid': pid.lower()})
+            update = 'update posts set body=:new_body where pid=:pid collate nocase;'
+            self.cursor.execute(update, {'new_body': body, 'pid': pid})
         else:
-            update = 'update posts set title=:new_title where lower(pid)=:pid;'
-            self.cursor.execute(update, {'new_title': new_title, 'pid': pid.lower()})
+            update = 'update posts set title=:new_title where pid=:pid collate nocase;'
+            self.cursor.execute(update, {'new_title': new_title, 'pid': pid})
+        if compressed_body is not None:
+            self.body_store.store([(post_id, new_body, compressed_body) for post_id in post_ids])
         self.connection.commit()
 
+    def _stage_bulk_pids(self, pids):
+        """
+        Loads pids into the temp.bulk_pids table, which bulk operations join against so that all of the pids are
+        validated with a few queries rather than a few queries each. Must be called within the transaction of the
+        operation.
+        :param pids: the pids that the operation is to be applied to (case-insensitive, duplicates are ignored)
+        :return: tuple of the list of (post_id, pid, poster) tuples of the posts that the pids identify (in the order
+                 that they were added), the list of the pids that match no post, and the list of the pids of archived
+                 posts
+        """
+        self.cursor.execute('create temp table if not exists bulk_pids (pid text);')
+        self.cursor.execute('delete from temp.bulk_pids;')
+        self.cursor.executemany('insert into temp.bulk_pids values (?);', ((pid,) for pid in pids))
+        query = 'select distinct p.post_id, p.pid, p.poster from temp.bulk_pids b ' \
+                'join posts p on p.pid=b.pid collate nocase order by p.post_id;'
+        posts = self.cursor.execute(query).fetchall()
+        query = 'select b.pid from temp.bulk_pids b ' \
+                'where not exists (select * from posts p where p.pid=b.pid collate nocase) order by b.rowid;'
+        missing = self.cursor.execute(query).fetchall()
+        archived = set()
+        if self.has_archive and len(missing) > 0:
+            query = 'select b.pid from temp.bulk_pids b ' \
+                    'where exists (select * from archive.posts p where p.pid=b.pid collate nocase);'
+            archived = set(pid for pid, in self.cursor.execute(query).fetchall())
+        return posts, [pid for pid, in missing if pid not in archived], [pid for pid, in missing if pid in archived]
+
+    def _run_bulk_operation(self, pids, operation):
+        """
+        Runs a bulk operation on the posts identified by pids in a single transaction, which is rolled back if the
+        operation fails in any way (so that the write lock is never left held).
+        :param pids: the pids that the operation is to be applied to
+        :param operation: function taking the list of (post_id, pid, poster) tuples of the posts that the pids identify
+                          and returning the lists of what it was and was not applied to
+        :return: the BulkResult of the operation
+        """
+        try:
+            self.cursor.execute('begin immediate;')
+            posts, not_found, archived = self._stage_bulk_pids(pids)
+            applied, skipped = operation(posts)
+            self.cursor.execute('delete from temp.bulk_pids;')
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        return BulkResult(applied, skipped, not_found, archived)
+
+    def bulk_add_tag(self, pids, tag_name):
+        """
+        Adds a tag with name tag_name to each of the posts identified by pids that does not already have a tag with the
+        same name (case-insensitive), in a single transaction.
+        :param pids: the pids of the posts to tag
+        :param tag_name: name of the new tag
+        :return: a BulkResult - applied lists the pids of the posts that were tagged and skipped those of the posts
+                 that already had the tag
+        """
+        def add_tags(posts):
+            query = 'select distinct t.post_id from temp.bulk_pids b join posts p on p.pid=b.pid collate nocase ' \
+                    'join tags t on t.post_id=p.post_id where lower(t.tag)=:tag_name;'
+            tagged = set(post_id for post_id, in self.cursor.execute(query, {'tag_name': tag_name.lower()}))
+            new_tags = [(post_id, pid, tag_name) for post_id, pid, _ in posts if post_id not in tagged]
+            self.cursor.executemany('insert into tags (post_id, pid, tag) values (?, ?, ?);', new_tags)
+            return [pid for _, pid, _ in new_tags], [pid for post_id, pid, _ in posts if post_id in tagged]
+        return self._run_bulk_operation(pids, add_tags)
+
+    def bulk_give_badge(self, pids, name):
+        """
+        Gives the badge with name (case-insensitive) to each of the posters of the posts identified by pids that has not
+        already received a badge on the current date (see check_badge_eligibility), in a single transaction. Each poster
+        is given the badge once, however many of their posts are given.
+        :param pids: the pids of the posts whose posters are to be given the badge
+        :param name: name of the badge to give
+        :return: a BulkResult - applied lists the uids of the users that were given the badge and skipped those of the
+                 users that had already received a badge on the current date
+        """
+        query = 'select bname from badges where lower(bname)=:name;'
+        row = self.cursor.execute(query, {'name': name.lower()}).fetchone()
+        if row is None:
+            raise ValueError('there is no badge named "{}"'.format(name))
+        bname = row[0]
+
+        def give_badges(posts):
+            query = 'select u.user_id, u.uid, exists (select * from ubadges ub ' \
+                    'where ub.user_id=u.user_id and ub.bdate=date(\'now\', \'localtime\')) ' \
+                    'from users u where u.user_id in (select pu.user_id from temp.bulk_pids b ' \
+                    'join posts p on p.pid=b.pid collate nocase join users pu on pu.uid=p.poster collate nocase) ' \
+                    'order by u.user_id;'
+            recipients = self.cursor.execute(query).fetchall()
+            new_badges = [(user_id, uid, bname) for user_id, uid, has_badge in recipients if not has_badge]
+            insertion = 'insert into ubadges (user_id, uid, bdate, bname) ' \
+                        'values (?, ?, date(\'now\', \'localtime\'), ?);'
+            self.cursor.executemany(insertion, new_badges)
+            uids = [(ascii_lower(uid),) for _, uid, _ in new_badges]
+            self.cursor.executemany('insert or ignore into user_stats (uid) values (?);', uids)
+            self.cursor.executemany('update user_stats set num_badges=num_badges+1 where uid=?;', uids)
+            return [uid for _, uid, _ in new_badges], [uid for _, uid, has_badge in recipients if has_badge]
+        return self._run_bulk_operation(pids, give_badges)
+
+    def bulk_update_posts(self, pids, new_title=None, new_body=None):
+        """
+        Updates the title and/or body of each of the posts identified by pids, in a single transaction.
+        :param pids: the pids of the posts to update
+        :param new_title: new title of the posts (if no value is passed the titles of the posts will not be updated)
+        :param new_body: new body of the posts (if no value is passed the bodies of the posts will not be updated)
+        :return: a BulkResult - applied lists the pids of the posts that were updated (skipped is always empty)
+        :raise ValueError: if neither a new title nor a new body is given
+        """
+        if new_title is None and new_body is None:
+            raise ValueError('a new title and/or body must be given to update posts')
+        assignments = ', '.join(column + '=:' + column for column, value in
+                                (('title', new_title), ('body', new_body)) if value is not None)
+        # The new body is compressed once for all of the posts
+        body, compressed_body = self.body_store.prepare(new_body)
+
+        def update_posts(posts):
+            post_ids = [post_id for post_id, _, _ in posts]
+            if new_body is not None:
+                self.body_store.unindex(post_ids)
+            update = 'update posts set ' + assignments + ' where post_id=:post_id;'
+            self.cursor.executemany(update, ({'title': new_title, 'body': body, 'post_id': post_id}
+                                             for post_id in post_ids))
+            if compressed_body is not None:
+                self.body_store.store([(post_id, new_body, compressed_body) for post_id in post_ids])
+            return [pid for _, pid, _ in posts], []
+        return self._run_bulk_operation(pids, update_posts)
+
+    def post_is_archived(self, pid):
+        """
+        Checks if the post identified by pid has been moved to the archive database. Archived posts are read-only.
+        :param pid: pid of post to check (case-insensitive)
+        :return: boolean value corresponding to whether the post identified by pid is archived (False if there is no
+                 archive)
+        """
+        if not self.has_archive:
+            return False
+        query = 'select * from archive.posts where pid=:pid collate nocase;'
+        self.cursor.execute(query, {'pid': pid})
+        return False if self.cursor.fetchone() is None else True
+
+    def archive_posts(self, cutoff_date):
+        """
+        Moves the questions that were posted before cutoff_date, along with all of their answers and the votes and tags
+        of each of these posts, from the main database to the archive database in a single transaction (or, if a
+        transaction is already open on the connection, as a part of it that is undone on failure). This keeps the tables
+        of the main database (which are all that is searched by default) small. Stats in the user_stats table still
+        count archived posts.
+        :param cutoff_date: date (YYYY-MM-DD) - questions posted before this date are archived
+        :return: the number of posts that were archived
+        """
+        assert self.has_archive, 'an archive database must be specified to archive posts'
+        old_questions = 'select q.post_id from questions q, posts p where p.post_id=q.post_id and p.pdate<:cutoff_date'
+        selection = 'create temp table archived_pids as ' + old_questions + ' ' \
+                    'union select a.post_id from answers a where a.question_id in (' + old_questions + ');'
+        in_selection = ' where post_id in (select post_id from temp.archived_pids);'
+        own_transaction = not self.connection.in_transaction
+        if own_transaction:
+            self.cursor.execute('begin immediate;')
+        else:
+            self.cursor.execute('savepoint archive_posts;')
+        try:
+            self.cursor.execute(selection, {'cutoff_date': cutoff_date})
+            # Archived bodies are kept compressed but are only searched by decompressing them
+            self.body_store.unindex([post_id for post_id, in
+                                     self.cursor.execute('select post_id from temp.archived_pids;').fetchall()])
+            for table in self.ARCHIVED_TABLES:
+                self.cursor.execute('insert into archive.' + table + ' select * from main.' + table + in_selection)
+                self.cursor.execute('delete from main.' + table + in_selection)
+            num_archived = self.cursor.execute('select count(*) from temp.archived_pids;').fetchone()[0]
+            self.cursor.execute('drop table temp.archived_pids;')
+            if own_transaction:
+                self.connection.commit()
+            else:
+                self.cursor.execute('release archive_posts;')
+        except Exception:
+            if own_transaction:
+                self.connection.rollback()
+            else:
+                self.cursor.execute('rollback to archive_posts;')
+                self.cursor.execute('release archive_posts;')
+            raise
+        return num_archived
+
+    def get_user_stats(self, uid):
+        """
+        Gets the profile stats of the user identified by uid. These are maintained on each write so this is a single
+        primary key lookup rather than an aggregation over the posts, votes, ubadges, and questions tables. The
+        reputation of a user is derived from the other stats as the number of votes received plus 10 for each accepted
+        answer and 5 for each badge.
+        :param uid: uid of user to get the stats of (case-insensitive)
+        :return: tuple corresponding to the num_posts, num_questions, num_answers, votes_received, num_badges,
+                 num_accepted, and reputation of the user identified by uid or None if the user has no stats
+        """
+        query = 'select num_posts, num_questions, num_answers, votes_received, num_badges, num_accepted, ' \
+                + self.REPUTATION + ' from user_stats where uid=:uid;'
+        self.cursor.execute(query, {'uid': ascii_lower(uid)})
+        return self.cursor.fetchone()
+
+    def enable_search_index(self):
+        """
+        Enables the in-memory search index (see search_index.SearchIndex, requires numpy) - from then on searches of the
+        main database are evaluated against a snapshot of the posts that is refreshed before each search rather than by
+        the database. Searches that include the archive are still made by the database.
+        :return: the SearchIndex
+        """
+        self.search_index = SearchIndex(self.connection)
+        return self.search_index
+
+    def enable_existence_filter(self, error_rate=0.01):
+        """
+        Enables the existence filter (see existence_filter.ExistenceFilter) - from then on pid_exists and uid_exists
+        only query the database for the pids and uids that the filter can not rule out.
+        :param error_rate: false positive rate of the filter when it is full
+        :return: the ExistenceFilter
+        """
+        self.existence_filter = ExistenceFilter(self.connection, self.db_path, self.has_archive, error_rate)
+        return self.existence_filter
+
+    def enable_body_compression(self, preview_length=PREVIEW_LENGTH):
+        """
+        Switches the database to compressed body storage (see body_store.BodyStore) - the bodies of the existing posts
+        that are worth compressing are compressed in a single transaction, as are those of the posts that are added or
+        edited from then on. The setting is stored in the database so it only needs to be done once. The pages that are
+        freed are only returned to the file system by VACUUM (or incremental vacuum, see maintenance.Maintenance).
+        :param preview_length: number of characters of each compressed body that are kept as its preview
+        :return: tuple of the number of bodies compressed, the number of bytes of body data before and after, and the
+                 number of seconds taken
+        """
+        return self.body_store.enable(preview_length)
+
+    def disable_body_compression(self):
+        """
+        Switches the database back to storing bodies uncompressed in the posts table, decompressing every compressed
+        body in a single transaction.
+        :return: tuple of the number of bodies decompressed and the number of seconds taken
+        """
+        return self.body_store.disable()
+
+    def clone(self):
+        """
+        Opens a new database manager on the same database (and archive) with its own connection, e.g. for use by a
+        background thread as connections can not be shared between threads. The schemas are not checked for upgrades
+        as this database manager has already brought them up to date.
+        :return: the new DBManager
+        """
+        return DBManager(self.db_path, self.archive_path, upgrade_schema=False)
+
     def close_connection(self):
         """
-        Closes the connection with the database.
+        Closes the connection with the database (after flushing any queued votes if the vote queue is enabled and
+        running PRAGMA optimize).
         """
+        if self.vote_queue is not None:
+            self.vote_queue.close()
+            self.vote_queue = None
+        # Lets sqlite refresh the query planner statistics that the queries run on this connection would benefit from
+        self.cursor.execute('pragma optimize;')
         self.connection.close()
@@ -0,0 +1,277 @@
+import math
+import os
+import time
+from collections import Counter
+
+from changelog import Changelog, ChangelogCompactedError
+
+
+class BloomFilter:
+    """
+    Class representing a Bloom filter of strings - a bit array that a string is added to by setting the bits at
+    num_hashes positions derived from its hash. A string that has been added is always reported as possibly present,
+    while a string that has not been added is reported as possibly present (a false positive) with a probability that
+    grows with the number of strings added - error_rate once capacity strings have been added.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        """
+        Initializes an empty filter sized for capacity strings.
+        :param capacity: number of strings that the filter is sized for
+        :param error_rate: false positive rate of the filter once it holds capacity strings
+        """
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        self.num_bits = max(8, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / self.capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _hashes(self, key):
+        """
+        :return: the position of the first bit of key and the step between the positions of its bits, derived from the
+                 two halves of its hash (double hashing) - python's string hash is randomized per process, which is fine
+                 as the filter is never persisted
+        """
+        key_hash = hash(key) & 0xFFFFFFFFFFFFFFFF
+        return key_hash & 0xFFFFFFFF, (key_hash >> 32) | 1
+
+    def add(self, key):
+        """
+        Adds key to the filter (count is only incremented if key was not possibly present already).
+        :param key: string to add
+        """
+        if key not in self:
+            self.update([key])
+
+    def update(self, keys):
+        """
+        Adds keys (which must be distinct and not already in the filter) to the filter.
+        :param keys: list of strings to add
+        """
+        bits, num_bits, num_hashes = self.bits, self.num_bits, self.num_hashes
+        for key in keys:
+            position, step = self._hashes(key)
+            for _ in range(num_hashes):
+                position %= num_bits
+                bits[position >> 3] |= 1 << (position & 7)
+                position += step
+        self.count += len(keys)
+
+    def __contains__(self, key):
+        bits, num_bits = self.bits, self.num_bits
+        position, step = self._hashes(key)
+        for _ in range(self.num_hashes):
+            position %= num_bits
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+            position += step
+        return True
+
+    def false_positive_rate(self):
+        """
+        :return: the expected probability that a string that has not been added is reported as possibly present, given
+                 the number of strings added so far
+        """
+        return (1 - math.exp(-self.num_hashes * self.count / self.num_bits)) ** self.num_hashes
+
+
+class ExistenceFilter:
+    """
+    Class holding Bloom filters of the pids of the posts (including archived posts) and the uids of the users, so that
+    checking whether a pid or uid exists (which most checks, such as those of newly generated pids and of uids chosen
+    at sign up, do not) can usually be answered without querying the tables. Keys are lower cased as pids and uids are
+    matched case-insensitively (str.lower folds at least the characters that sqlite's nocase collation does, so keys
+    that sqlite considers equal always hit the same bits).
+
+    The filters are built when the filter is created and the pids and uids added through the DBManager are added to
+    them. Before a check is answered negatively the filters are brought up to date with the posts and users that other
+    connections have added, by reading the inserts logged in the changelog (see changelog.Changelog). The database is
+    only queried for this if the database file or its write-ahead log has been modified since the last refresh - or
+    was modified so shortly before it that a later write could have left the same modification time (as git does
+    for racily clean files) - and then the changelog is only read if pragma data_version shows that another
+    connection has committed. Deleted keys are never removed, which only makes them false positives.
+    """
+
+    # Number of seconds that a file must have been left unmodified for before a refresh for its modification time to be
+    # trusted to change on the next write (covers coarse file system timestamps)
+    RACY_SECONDS = 2
+
+    # The tables whose inserts are added to the filters, mapped to the filter that they are added to
+    TRACKED_TABLES = {'posts': 'pid', 'users': 'uid'}
+
+    def __init__(self, connection, db_path, has_archive=False, error_rate=0.01):
+        """
+        Initializes an instance of this class and builds the filters.
+        :param connection: connection to the database - it must only be used by the thread that uses the filter
+        :param db_path: path to the database (its modification time tells whether it may have changed)
+        :param has_archive: whether the archive database is attached to connection (its pids are added to the filter)
+        :param error_rate: false positive rate of the filters when they are full (they are sized for twice the number of
+                           keys in the database and rebuilt when they fill up)
+        """
+        self.connection = connection
+        self.db_path = db_path
+        self.has_archive = has_archive
+        self.error_rate = error_rate
+        self.changelog = Changelog(connection)
+        # Number of checks made, checks answered without querying the tables, and checks that the filter let through
+        # but the tables did not confirm, per filter
+        self.num_checks = Counter()
+        self.num_negatives = Counter()
+        self.num_false_positives = Counter()
+        self.build_seconds = 0
+        self.build()
+
+    def build(self):
+        """
+        Builds the filters from scratch from the keys in the tables, read in a single read transaction.
+        """
+        start = time.perf_counter()
+        self._watch_files()
+        self.file_state = self._file_state()
+        cursor = self.connection.cursor()
+        own_transaction = not self.connection.in_transaction
+        if own_transaction:
+            cursor.execute('begin;')
+        try:
+            self.data_version = cursor.execute('pragma data_version;').fetchone()[0]
+            self.changelog_cursor = self.changelog.latest_seq()
+            query = 'select pid from posts' + (' union all select pid from archive.posts' if self.has_archive else '')
+            pids = cursor.execute(query + ';').fetchall()
+            uids = cursor.execute('select uid from users;').fetchall()
+        finally:
+            if own_transaction:
+                cursor.execute('commit;')
+        self.filters = {'pid': self._filter_of(pids), 'uid': self._filter_of(uids)}
+        self.build_seconds = time.perf_counter() - start
+
+    def _filter_of(self, rows):
+        """
+        :param rows: rows holding a single key each
+        :return: a BloomFilter holding the lower cased keys, sized for twice their number
+        """
+        bloom = BloomFilter(max(1024, 2 * len(rows)), self.error_rate)
+        bloom.update(list(set(key.lower() for key, in rows if key is not None)))
+        return bloom
+
+    def _file_state(self):
+        """
+        :return: tuple of the time and the (modification time, size, inode) of the database file and, if the database
+                 is in WAL mode, its write-ahead log (None for a file that does not exist)
+        """
+        states = []
+        for path in self.paths:
+            try:
+                stat = os.stat(path)
+                states.append((stat.st_mtime_ns, stat.st_size, stat.st_ino))
+            except FileNotFoundError:
+                states.append(None)
+        return time.time_ns(), tuple(states)
+
+    def _watch_files(self):
+        """
+        Sets the files whose modification tells that the database may have changed - commits only write to the
+        write-ahead log in WAL mode (switching the journal mode writes to the database file itself).
+        """
+        journal_mode = self.connection.execute('pragma journal_mode;').fetchone()[0]
+        self.paths = (self.db_path, self.db_path + '-wal') if journal_mode.lower() == 'wal' else (self.db_path,)
+
+    def _may_be_stale(self):
+        """
+        :return: whether another connection may have committed since the last refresh (False is definite)
+        """
+        checked_at, states = self.file_state
+        now, current = self._file_state()
+        if current != states:
+            return True
+        racy_before = checked_at - self.RACY_SECONDS * 10 ** 9
+        return any(state is not None and state[0] >= racy_before for state in states)
+
+    def refresh(self):
+        """
+        Adds the pids and uids inserted by other connections since the last refresh to the filters. The filters are
+        rebuilt if changes have been compacted before they were read or if a filter has filled up.
+        :return: whether any keys were added
+        """
+        if not self._may_be_stale():
+            return False
+        self._watch_files()
+        self.file_state = self._file_state()
+        version = self.connection.execute('pragma data_version;').fetchone()[0]
+        if version == self.data_version:
+            return False
+        self.data_version = version
+        try:
+            log = self.changelog.read(self.changelog_cursor, tables=tuple(self.TRACKED_TABLES))
+        except ChangelogCompactedError:
+            self.build()
+            return True
+        for change in log:
+            if change.op == 'insert' and change.key is not None:
+                self.filters[self.TRACKED_TABLES[change.table]].add(change.key.lower())
+        if len(log) > 0:
+            self.changelog_cursor = log[-1].seq
+        if any(bloom.count > bloom.capacity for bloom in self.filters.values()):
+            self.build()
+        return len(log) > 0
+
+    def add(self, kind, key):
+        """
+        Adds a key that has been inserted through this filter's connection to its filter.
+        :param kind: 'pid' or 'uid'
+        :param key: the pid or uid that was inserted
+        """
+        bloom = self.filters[kind]
+        bloom.add(key.lower())
+        if bloom.count > bloom.capacity:
+            self.build()
+
+    def may_contain(self, kind, key):
+        """
+        Checks whether key may exist - a False answer is definite, a True answer must be confirmed by querying the
+        tables (and the result passed to confirm).
+        :param kind: 'pid' or 'uid'
+        :param key: the pid or uid to check (case-insensitive)
+        :return: False if key definitely does not exist, True if it may exist
+        """
+        self.num_checks[kind] += 1
+        key = key.lower()
+        if key in self.filters[kind]:
+            return True
+        # Only a negative answer needs the filters to be up to date, a positive one is confirmed by the tables anyway
+        if self.refresh() and key in self.filters[kind]:
+            return True
+        self.num_negatives[kind] += 1
+        return False
+
+    def confirm(self, kind, exists):
+        """
+        Records the result of the query that confirmed a True answer of may_contain.
+        :param kind: 'pid' or 'uid'
+        :param exists: whether the key was found in the tables
+        """
+        if not exists:
+            self.num_false_positives[kind] += 1
+
+    def memory_usage(self):
+        """
+        :return: list of (filter, number of bytes used by its bit array) tuples
+        """
+        return [(kind + 's', len(bloom.bits)) for kind, bloom in sorted(self.filters.items())]
+
+    def report(self):
+        """
+        :return: string describing the size, memory footprint, and expected and observed false positive rates of the
+                 filters, and how many checks they answered without querying the tables
+        """
+        lines = ['existence filter: built in {:.3f}s'.format(self.build_seconds)]
+        for kind, bloom in sorted(self.filters.items()):
+            misses = self.num_negatives[kind] + self.num_false_positives[kind]
+            observed = 'n/a' if misses == 0 else '{:.4%}'.format(self.num_false_positives[kind] / misses)
+            lines.append('\t{:<6}{:>9,} keys (capacity {:,}), {} hashes, {:>9,} bytes, expected false positive rate '
+                         '{:.4%}, observed {} ({:,} checks, {:,} answered without sql, {:,} false positives)'
+                         .format(kind + 's', bloom.count, bloom.capacity, bloom.num_hashes, len(bloom.bits),
+                                 bloom.false_positive_rate(), observed, self.num_checks[kind],
+                                 self.num_negatives[kind], self.num_false_positives[kind]))
+        lines.append('\ttotal {:,} bytes'.format(sum(num_bytes for _, num_bytes in self.memory_usage())))
+        return '\n'.join(lines)
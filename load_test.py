@@ -0,0 +1,300 @@
+import argparse
+import builtins
+import multiprocessing
+import random
+import re
+import sqlite3
+import time
+from collections import Counter, defaultdict
+from os import path
+
+import screens
+from prj import PageBook
+from search_query import STOPWORDS
+
+# The numbered entries of the search results and thread screens and of the post action menu
+ENTRY_PATTERN = re.compile(r'^\t\[(\d+)\] (.*)$', re.MULTILINE)
+
+
+class ScenarioError(Exception):
+    """
+    Raised when a screen does not show what a scenario expects it to (e.g. an input was rejected).
+    """
+    pass
+
+
+class _FrameCapture:
+    """
+    Text stream that the renderer writes frames to during a session instead of the terminal. Keeps the output written
+    since the last input so that a scenario can decide what to enter next.
+    """
+
+    def __init__(self):
+        self._writes = []
+
+    def write(self, text):
+        self._writes.append(text)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        """
+        :return: the output written since the last call (the screen cleared sequence is kept)
+        """
+        text = ''.join(self._writes)
+        self._writes = []
+        return text
+
+
+class Session:
+    """
+    Class representing one scripted PageBook session. The session stands in for the input builtin - each time PageBook
+    prompts for input the scenario is given the output shown since the last input and chooses what to enter. The time
+    between an input being entered and the next prompt (i.e. the time PageBook takes to respond to it, excluding any
+    think time) is recorded against the step of the scenario that the input belongs to.
+    """
+
+    def __init__(self, scenario, think_time=0):
+        """
+        Initializes an instance of this class.
+        :param scenario: function taking the session and returning a generator of (step, input) tuples - the output
+                         shown before each input is available as the frame attribute of the session
+        :param think_time: max number of seconds that the simulated user waits before entering each input (the actual
+                           wait is random)
+        """
+        self.frame = ''
+        self.think_time = think_time
+        self.latencies = defaultdict(list)
+        self._scenario = scenario(self)
+        self._capture = _FrameCapture()
+        self._step = None
+        self._entered_at = None
+
+    def _record(self):
+        """
+        Records the time since the last input was entered against the step that it belongs to.
+        """
+        if self._step is not None:
+            self.latencies[self._step].append(time.perf_counter() - self._entered_at)
+            self._step = None
+
+    def input(self, prompt=''):
+        """
+        Replaces the input builtin while the session is running.
+        :param prompt: ignored - the renderer writes its prompt as part of the frame
+        :return: the next input of the scenario
+        """
+        self._record()
+        self.frame = self._capture.take()
+        if 'invalid selection' in self.frame or 'try again' in self.frame:
+            raise ScenarioError('input was rejected: ' + self.frame.strip().splitlines()[-2])
+        try:
+            self._step, answer = next(self._scenario)
+        except StopIteration:
+            raise ScenarioError('scenario ended before the session did')
+        if self.think_time > 0:
+            time.sleep(random.uniform(0, self.think_time))
+        self._entered_at = time.perf_counter()
+        return answer
+
+    def run(self, db_path):
+        """
+        Runs PageBook on the database at db_path until the scenario exits it.
+        :param db_path: path to the database to run the session against
+        """
+        real_input = builtins.input
+        builtins.input = self.input
+        screens.renderer.stream = self._capture
+        page_book = None
+        try:
+            self._step = 'open'
+            self._entered_at = time.perf_counter()
+            page_book = PageBook(db_path, transition_delay=0)
+            page_book.run()
+            self._record()
+        except Exception:
+            if page_book is not None:
+                # Leaves no transaction open on the database behind the failed session
+                page_book.db_manager.connection.rollback()
+                page_book.db_manager.connection.close()
+            raise
+        finally:
+            builtins.input = real_input
+
+
+def browse_scenario(users, keywords, num_searches, tag_probability=0.3):
+    """
+    Creates the scenario of a user that logs in and then repeatedly searches, pages through the results, opens one of
+    the matching posts, and votes on it (or tags it, if the user is privileged and the post can not be voted on or
+    sometimes otherwise) or views its answers, before exiting.
+    :param users: list of tuples (uid, pwd, privileged) of the users to pick from
+    :param keywords: list of the keywords to search with
+    :param num_searches: number of searches to make
+    :param tag_probability: probability that a privileged user tags a post rather than voting on it
+    :return: function that takes a Session and returns the generator of its inputs
+    """
+
+    def scenario(session):
+        uid, pwd, privileged = random.choice(users)
+        yield 'start', '1'
+        yield 'login uid', uid
+        yield 'login', pwd
+        for _ in range(num_searches):
+            yield 'main menu', '2'
+            yield 'search query', ' '.join(random.sample(keywords, min(len(keywords), random.randint(1, 3))))
+            yield 'search dates', ''
+            yield 'search', ''
+            if 'No posts matched' in session.frame:
+                yield 'return', ''
+                continue
+            while '[b] See more matches' in session.frame and random.random() < 0.5:
+                yield 'next page', 'b'
+            entries = [number for number, _ in ENTRY_PATTERN.findall(session.frame)]
+            if len(entries) == 0:
+                raise ScenarioError('no search results shown')
+            yield 'open post', random.choice(entries)
+            actions = dict((action, number) for number, action in ENTRY_PATTERN.findall(session.frame))
+            if 'View the answers' in actions and random.random() < 0.3:
+                yield 'thread', actions['View the answers']
+                while '[b] See more answers' in session.frame and random.random() < 0.5:
+                    yield 'thread page', 'b'
+                yield 'return', 'a'
+            elif 'Add a tag' in actions and ('Vote on the post' not in actions or random.random() < tag_probability):
+                yield 'tag prompt', actions['Add a tag']
+                yield 'tag', 'load{}'.format(random.randint(0, 999))
+                yield 'return', ''
+            elif 'Vote on the post' in actions:
+                yield 'vote', actions['Vote on the post']
+                yield 'return', ''
+            elif 'Post an answer' in actions:
+                # The post action screen has no return option when there are actions, so an answer is started and
+                # then discarded
+                yield 'answer prompt', actions['Post an answer']
+                yield 'answer title', 'load test'
+                yield 'answer body', 'load test'
+                yield 'return', 'n'
+            else:
+                yield 'return', ''
+        yield 'exit', '5'
+
+    return scenario
+
+
+def _run_worker(db_path, num_sessions, users, keywords, num_searches, think_time, seed):
+    """
+    Runs num_sessions sessions one after the other in a worker process.
+    :return: tuple consisting of the latencies of each step (dictionary of lists), the number of sessions completed,
+             and a Counter of the errors that ended the other sessions
+    """
+    random.seed(seed)
+    latencies = defaultdict(list)
+    errors = Counter()
+    completed = 0
+    for _ in range(num_sessions):
+        session = Session(browse_scenario(users, keywords, num_searches), think_time)
+        try:
+            session.run(db_path)
+            completed += 1
+        except sqlite3.Error as e:
+            errors['{} - {}'.format(type(e).__name__, e)] += 1
+        except ScenarioError as e:
+            errors['scenario - {}'.format(e)] += 1
+        for step, times in session.latencies.items():
+            latencies[step].extend(times)
+    return dict(latencies), completed, errors
+
+
+def _percentile(sorted_values, percent):
+    """
+    :return: the value at percent (nearest rank) of sorted_values
+    """
+    index = max(0, int(round(percent / 100 * len(sorted_values))) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def load_session_data(db_path, num_keywords=50):
+    """
+    Gets the users that the sessions log in as and the keywords that they search with from the database.
+    :param db_path: path to the database
+    :param num_keywords: max number of the most common words of post titles to search with
+    :return: tuple consisting of a list of tuples (uid, pwd, privileged) and a list of keywords
+    """
+    connection = sqlite3.connect(db_path)
+    try:
+        users = connection.execute('select u.uid, u.pwd, p.uid is not null from users u '
+                                   'left outer join privileged p on lower(p.uid)=lower(u.uid) '
+                                   'where u.pwd is not null;').fetchall()
+        words = Counter()
+        for title, in connection.execute('select title from posts;'):
+            words.update(word for word in re.findall(r'\w+', (title or '').lower())
+                         if len(word) > 2 and word not in STOPWORDS)
+    finally:
+        connection.close()
+    return users, [word for word, _ in words.most_common(num_keywords)]
+
+
+def format_results(latencies, completed, errors, seconds):
+    """
+    Formats the results of a load test so that they can be printed.
+    :param latencies: dictionary mapping each step to the list of its latencies (in seconds)
+    :param completed: number of sessions that were completed
+    :param errors: Counter of the errors that ended sessions
+    :param seconds: wall clock time that the load test took
+    :return: string with a line of latency percentiles (in milliseconds) per step followed by the throughput and the
+             errors
+    """
+    lines = ['{:<14}{:>8}{:>10}{:>10}{:>10}{:>10}'.format('step', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')]
+    num_steps = 0
+    for step in sorted(latencies, key=lambda step: -len(latencies[step])):
+        values = sorted(latencies[step])
+        num_steps += len(values)
+        lines.append('{:<14}{:>8}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}'
+                     .format(step, len(values), _percentile(values, 50) * 1000, _percentile(values, 90) * 1000,
+                             _percentile(values, 99) * 1000, values[-1] * 1000))
+    lines.append('\n{} sessions completed, {} failed in {:.2f}s'.format(completed, sum(errors.values()), seconds))
+    lines.append('throughput: {:.1f} steps/s, {:.2f} sessions/s'.format(num_steps / seconds, completed / seconds))
+    num_locked = sum(count for error, count in errors.items() if 'database is locked' in error)
+    lines.append('lock contention errors (database is locked): {}'.format(num_locked))
+    for error, count in errors.most_common():
+        lines.append('\t{:>6}  {}'.format(count, error))
+    return '\n'.join(lines)
+
+
+def main():
+    """
+    Runs scripted PageBook sessions in parallel processes against one database and prints the results.
+    """
+    parser = argparse.ArgumentParser(description='Runs many scripted PageBook sessions (login, search, paging, voting, '
+                                                 'and tagging) in parallel processes against the database at '
+                                                 'PATH_TO_DATABASE and reports the latency of each step. Sessions '
+                                                 'write to the database so run this on a copy.')
+    parser.add_argument('db_path', metavar='PATH_TO_DATABASE', help='path to the database to run the sessions against')
+    parser.add_argument('--workers', type=int, default=4, help='number of parallel processes (default 4)')
+    parser.add_argument('--sessions', type=int, default=25, help='number of sessions per process (default 25)')
+    parser.add_argument('--searches', type=int, default=5, help='number of searches per session (default 5)')
+    parser.add_argument('--think-time', type=float, default=0, metavar='SECONDS',
+                        help='max number of seconds that a simulated user waits before each input (default 0)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random scenarios (default 0)')
+    args = parser.parse_args()
+    assert path.exists(args.db_path), 'path does not exist - please specify a valid path'
+    users, keywords = load_session_data(args.db_path)
+    assert len(users) > 0 and len(keywords) > 0, 'the database must have users and posts to run sessions with'
+    latencies = defaultdict(list)
+    completed = 0
+    errors = Counter()
+    start = time.perf_counter()
+    with multiprocessing.Pool(args.workers) as pool:
+        results = pool.starmap(_run_worker, [(args.db_path, args.sessions, users, keywords, args.searches,
+                                              args.think_time, args.seed + i) for i in range(args.workers)])
+    seconds = time.perf_counter() - start
+    for worker_latencies, worker_completed, worker_errors in results:
+        for step, times in worker_latencies.items():
+            latencies[step].extend(times)
+        completed += worker_completed
+        errors.update(worker_errors)
+    print(format_results(latencies, completed, errors, seconds))
+
+
+if __name__ == '__main__':
+    main()
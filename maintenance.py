@@ -0,0 +1,200 @@
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from changelog import Changelog
+
+
+class Maintenance:
+    """
+    Class handling the routine maintenance of the database - refreshing the statistics used by the query planner,
+    compacting the changelog, reclaiming free pages, checkpointing the write-ahead log, and checking the integrity of
+    the database. Each run reports what it did and how long each task took.
+    """
+
+    def __init__(self, db_path, vacuum_pages=1000, changelog_keep=10000):
+        """
+        Initializes an instance of this class.
+        :param db_path: path to the database to maintain
+        :param vacuum_pages: max number of free pages to reclaim per run (0 reclaims all of them)
+        :param changelog_keep: number of the most recent changes that are kept when the changelog is compacted
+        """
+        self.db_path = db_path
+        self.vacuum_pages = vacuum_pages
+        self.changelog_keep = changelog_keep
+
+    def _optimize(self, cursor):
+        """
+        Runs ANALYZE if the database has never been analyzed and PRAGMA optimize (which only re-analyzes the tables
+        whose statistics are out of date) otherwise.
+        :param cursor: cursor of the connection to the database
+        :return: description of what was done
+        """
+        query = 'select * from sqlite_master where name=\'sqlite_stat1\';'
+        if cursor.execute(query).fetchone() is None:
+            cursor.execute('analyze;')
+            return 'analyzed all tables'
+        cursor.execute('pragma analysis_limit=400;')
+        cursor.execute('pragma optimize;')
+        return 'ran pragma optimize'
+
+    def _compact_changelog(self, cursor):
+        """
+        Deletes the changes in the changelog that every consumer that saves its cursor has read (see
+        changelog.Changelog.compact).
+        :param cursor: cursor of the connection to the database
+        :return: description of what was done
+        """
+        if cursor.execute('select * from sqlite_master where name=\'changelog\';').fetchone() is None:
+            return 'skipped - the database has no changelog yet'
+        num_deleted = Changelog(cursor.connection).compact(self.changelog_keep)
+        num_left = cursor.execute('select count(*) from changelog;').fetchone()[0]
+        return 'deleted {} changes, {} left'.format(num_deleted, num_left)
+
+    def _incremental_vacuum(self, cursor):
+        """
+        Reclaims up to vacuum_pages free pages (e.g. pages freed by edits and archiving) from the database file. Only
+        possible if the database uses incremental auto-vacuum (see enable_incremental_vacuum).
+        :param cursor: cursor of the connection to the database
+        :return: description of what was done
+        """
+        if cursor.execute('pragma auto_vacuum;').fetchone()[0] != 2:
+            free_pages = cursor.execute('pragma freelist_count;').fetchone()[0]
+            return 'skipped - incremental auto-vacuum is not enabled ({} free pages)'.format(free_pages)
+        before = cursor.execute('pragma freelist_count;').fetchone()[0]
+        # Each step of the pragma frees a single page so it has to be run as a script for it to step to completion
+        cursor.executescript('pragma incremental_vacuum({});'.format(self.vacuum_pages))
+        after = cursor.execute('pragma freelist_count;').fetchone()[0]
+        page_size = cursor.execute('pragma page_size;').fetchone()[0]
+        return 'reclaimed {} pages ({} bytes), {} free pages left'.format(before - after, (before - after) * page_size,
+                                                                          after)
+
+    def _checkpoint(self, cursor):
+        """
+        Checkpoints the write-ahead log into the database and truncates it. Only applies to databases in WAL mode.
+        :param cursor: cursor of the connection to the database
+        :return: description of what was done
+        """
+        if cursor.execute('pragma journal_mode;').fetchone()[0].lower() != 'wal':
+            return 'skipped - the database is not in WAL mode'
+        busy, log_frames, checkpointed_frames = cursor.execute('pragma wal_checkpoint(truncate);').fetchone()
+        if busy:
+            return 'incomplete - the database was busy ({} of {} frames checkpointed)'.format(checkpointed_frames,
+                                                                                             log_frames)
+        return 'checkpointed {} frames'.format(checkpointed_frames)
+
+    def _quick_check(self, cursor):
+        """
+        Runs a quick integrity check of the database.
+        :param cursor: cursor of the connection to the database
+        :return: description of the result of the check
+        """
+        results = [row[0] for row in cursor.execute('pragma quick_check(10);').fetchall()]
+        if results == ['ok']:
+            return 'ok'
+        return 'FAILED - ' + '; '.join(results)
+
+    def run(self):
+        """
+        Runs each of the maintenance tasks on a new connection to the database.
+        :return: list of tuples (task, seconds taken, description of what was done) - a task that fails is reported
+                 with its error rather than stopping the rest of the tasks
+        """
+        tasks = [('optimize', self._optimize), ('changelog compaction', self._compact_changelog),
+                 ('incremental vacuum', self._incremental_vacuum),
+                 ('wal checkpoint', self._checkpoint), ('quick check', self._quick_check)]
+        report = []
+        connection = sqlite3.connect(self.db_path, isolation_level=None)
+        try:
+            cursor = connection.cursor()
+            for name, task in tasks:
+                start = time.perf_counter()
+                try:
+                    result = task(cursor)
+                except sqlite3.Error as e:
+                    result = 'error - {}'.format(e)
+                report.append((name, time.perf_counter() - start, result))
+        finally:
+            connection.close()
+        return report
+
+    def enable_incremental_vacuum(self):
+        """
+        Switches the database to incremental auto-vacuum so that free pages can be reclaimed by each run. This rebuilds
+        the database (VACUUM) so it only needs to be done once and should be done while no one else is using it.
+        :return: the number of seconds that the rebuild took
+        """
+        start = time.perf_counter()
+        connection = sqlite3.connect(self.db_path, isolation_level=None)
+        try:
+            connection.execute('pragma auto_vacuum=incremental;')
+            connection.execute('vacuum;')
+        finally:
+            connection.close()
+        return time.perf_counter() - start
+
+
+def format_report(report):
+    """
+    Formats a maintenance report so that it can be printed or logged.
+    :param report: list of tuples (task, seconds taken, description of what was done) as returned by Maintenance.run
+    :return: string with a line for each task and a final line with the total time taken
+    """
+    lines = ['[{}] maintenance'.format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'))]
+    for name, seconds, result in report:
+        lines.append('\t{:<20}{:>9.3f}s\t{}'.format(name, seconds, result))
+    lines.append('\t{:<20}{:>9.3f}s'.format('total', sum(seconds for _, seconds, _ in report)))
+    return '\n'.join(lines)
+
+
+class MaintenanceScheduler:
+    """
+    Class that runs maintenance in a background thread every interval seconds. If an idle check is given, a due run is
+    put off until the program is idle (e.g. while a user is reading a screen) so that it does not compete with them.
+    """
+
+    def __init__(self, maintenance, interval, is_idle=None, log_path=None):
+        """
+        Initializes an instance of this class.
+        :param maintenance: the Maintenance to run
+        :param interval: number of seconds between runs
+        :param is_idle: function returning whether the program is currently idle (optional parameter)
+        :param log_path: path to a file that the report of each run is appended to (optional parameter)
+        """
+        self.maintenance = maintenance
+        self.interval = interval
+        self.is_idle = is_idle
+        self.log_path = log_path
+        self.reports = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='maintenance', daemon=True)
+
+    def start(self):
+        """
+        Starts the background thread.
+        """
+        self._thread.start()
+
+    def _run(self):
+        """
+        Waits for interval seconds (and then for the program to become idle) before each run until stopped.
+        """
+        while not self._stop.wait(self.interval):
+            while self.is_idle is not None and not self.is_idle():
+                if self._stop.wait(1):
+                    return
+            report = self.maintenance.run()
+            # Only the most recent reports are kept in memory
+            self.reports = self.reports[-9:] + [report]
+            if self.log_path is not None:
+                with open(self.log_path, 'a') as log:
+                    log.write(format_report(report) + '\n')
+
+    def stop(self):
+        """
+        Stops the background thread (waiting for a run in progress to finish).
+        """
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
@@ -0,0 +1,100 @@
+import threading
+
+
+class PagePrefetcher:
+    """
+    Class that hydrates the pages of a ranked list of search results on a background thread with its own connection,
+    so that the next page can be loaded while the user is reading the current one and handed over as soon as it is
+    asked for.
+    """
+
+    def __init__(self, connect, ranked_pids, page_size=5):
+        """
+        Initializes an instance of this class and starts the background thread.
+        :param connect: function returning a new database manager (providing hydrate_posts and close_connection) - it is
+                        called by the background thread so that it has its own connection
+        :param ranked_pids: list of tuples (pid, # of terms matched, schema) as returned by DBManager.rank_search
+        :param page_size: number of posts per page
+        """
+        self.ranked_pids = ranked_pids
+        self.page_size = page_size
+        self.num_pages = (len(ranked_pids) + page_size - 1) // page_size
+        self._connect = connect
+        self._requested = []
+        self._pages = {}
+        self._failed = False
+        self._cancelled = False
+        self._lock = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='page-prefetch', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        """
+        Hydrates the requested pages in the order they were requested until cancelled. If anything fails (e.g. the
+        connection) then the pages are left for the caller to hydrate - any error is caught so that get_page is never
+        left waiting for a page that will not be hydrated.
+        """
+        try:
+            db_manager = self._connect()
+        except Exception:
+            self._fail()
+            return
+        try:
+            while True:
+                with self._lock:
+                    while len(self._requested) == 0 and not self._cancelled:
+                        self._lock.wait()
+                    if self._cancelled:
+                        return
+                    page = self._requested.pop(0)
+                first = page * self.page_size
+                posts = db_manager.hydrate_posts(self.ranked_pids[first:first + self.page_size])
+                with self._lock:
+                    self._pages[page] = posts
+                    self._lock.notify_all()
+        except Exception:
+            self._fail()
+        finally:
+            db_manager.close_connection()
+
+    def _fail(self):
+        """
+        Stops hydrating pages and wakes up the callers waiting for pages, which then hydrate them themselves.
+        """
+        with self._lock:
+            self._failed = True
+            self._lock.notify_all()
+
+    def prefetch(self, page):
+        """
+        Requests that page be hydrated in the background (ignored if there is no such page or it has already been
+        requested).
+        :param page: the number of the page to hydrate (starting at 0)
+        """
+        with self._lock:
+            if 0 <= page < self.num_pages and page not in self._pages and page not in self._requested:
+                self._requested.append(page)
+                self._lock.notify_all()
+
+    def get_page(self, page):
+        """
+        Gets the hydrated posts of page, waiting for it to be hydrated if it has not been yet.
+        :param page: the number of the page to get (starting at 0)
+        :return: the list of the tuples corresponding to the data-fields of the posts of page, or None if the background
+                 thread could not hydrate it (in which case the caller should hydrate it itself)
+        """
+        self.prefetch(page)
+        with self._lock:
+            while page not in self._pages and not self._failed and not self._cancelled:
+                self._lock.wait()
+            return self._pages.pop(page, None)
+
+    def close(self):
+        """
+        Cancels any pages that have not been hydrated yet and stops the background thread (waiting for the page being
+        hydrated, if any, to finish so that the thread's connection is closed).
+        """
+        with self._lock:
+            self._cancelled = True
+            self._lock.notify_all()
+        self._thread.join()
@@ -1,3 +1,14 @@
+drop table if exists changelog_consumers;
+drop table if exists changelog;
+drop table if exists post_body_index;
+drop table if exists post_body_terms;
+drop table if exists body_compression;
+drop table if exists post_bodies;
+drop table if exists post_edits;
+drop table if exists user_stats;
+drop table if exists answers_orphans;
+drop table if exists questions_orphans;
+drop table if exists privileged_orphans;
 drop table if exists answers;
 drop table if exists questions;
 drop table if exists votes;
@@ -9,6 +20,8 @@ drop table if exists privileged;
 drop table if exists users;
 
 PRAGMA foreign_keys = ON;
+-- PageBook adds its auxiliary tables and integer keys on top of this schema when it first opens the database
+PRAGMA user_version = 0;
 
 create table users (
   uid		char(4),
@@ -1,8 +1,12 @@
-import sys
+import argparse
 from os import path
 
 from screens import *
+from body_store import PREVIEW_LENGTH
 from db_manager import *
+from maintenance import Maintenance, MaintenanceScheduler, format_report
+from profiling import ScreenProfiler
+from search_query import STOPWORDS, SearchNormalizer
 
 
 class PageBook:
@@ -10,14 +14,55 @@ class PageBook:
     Runs the program.
     """
 
-    def __init__(self, db_path):
+    def __init__(self, db_path, transition_delay=0.5, archive_path=None, vote_journal_path=None,
+                 vote_flush_interval=1.0, maintenance_interval=None, maintenance_log_path=None,
+                 search_normalizer=None, search_index=False, existence_filter=False, profiler=None):
         """
         Gets a connection to the database at db_path and initializes so this program can be run.
         :param db_path: command line argument specifying the path to the database this program is to run on
+        :param transition_delay: number of seconds that messages shown before a screen transition are displayed for
+        :param archive_path: path to the database that old posts are archived in (optional parameter)
+        :param vote_journal_path: path to the journal of the write-behind vote queue - the queue is only enabled if this
+                                  is specified (optional parameter)
+        :param vote_flush_interval: max number of seconds that a vote is queued for before it is flushed
+        :param maintenance_interval: number of seconds between runs of database maintenance, which are made in the
+                                     background while the user is idle - maintenance is only run if this is specified
+                                     (optional parameter)
+        :param maintenance_log_path: path to a file that the report of each maintenance run is appended to (optional
+                                     parameter)
+        :param search_normalizer: the SearchNormalizer that the keywords of searches are normalized by (by default
+                                  stopwords and keywords shorter than 2 characters are dropped)
+        :param search_index: whether searches should be evaluated against an in-memory search index rather than by the
+                             database (requires numpy)
+        :param existence_filter: whether checks of whether pids and uids exist should be answered by an in-memory Bloom
+                                 filter where possible rather than by the database
+        :param profiler: the ScreenProfiler that the screens and the SQL they run are timed by - its summary is dumped
+                         when the program exits (optional parameter)
         """
+        renderer.transition_delay = transition_delay
         self.current_user = None
         self.running = True
-        self.db_manager = DBManager(db_path)
+        self.search_normalizer = search_normalizer
+        self.db_manager = DBManager(db_path, archive_path)
+        self.profiler = profiler
+        if profiler is not None:
+            # Instrumented before the search index holds on to the connection so that its queries are timed too
+            profiler.instrument(self.db_manager)
+            profiler.install_signal_handler()
+            BaseScreen.profiler = profiler
+        if search_index:
+            self.db_manager.enable_search_index()
+        if existence_filter:
+            self.db_manager.enable_existence_filter()
+        if vote_journal_path is not None:
+            self.db_manager.enable_vote_queue(vote_journal_path, flush_interval=vote_flush_interval)
+        self.maintenance_scheduler = None
+        if maintenance_interval is not None:
+            # Users that have been sitting at a prompt for a few seconds are most likely reading the screen
+            self.maintenance_scheduler = MaintenanceScheduler(Maintenance(db_path), maintenance_interval,
+                                                              lambda: renderer.idle_time() >= 5,
+                                                              maintenance_log_path)
+            self.maintenance_scheduler.start()
 
     def _run_login(self):
         """
@@ -39,6 +84,19 @@ class PageBook:
             self.running = False
             return None
 
+    def _run_post_action(self, post):
+        """
+        Runs the post action screen on post. If the user chooses to view the answers to the post (a question) they are
+        taken to the thread screen, from which they can select one of the answers to perform an action on.
+        :param post: a tuple corresponding to the data-fields of the post to perform an action on
+        """
+        post_action_screen = PostActionScreen(self.db_manager, self.current_user, post)
+        if post_action_screen.run() == 'view thread':
+            thread_screen = ThreadScreen(self.db_manager, post_action_screen.pid)
+            answer = thread_screen.run()
+            if answer != 'done':
+                self._run_post_action(answer)
+
     def run(self):
         """
         Runs the program.
@@ -55,30 +113,154 @@ class PageBook:
                 post_question_screen = PostQuestionScreen(self.current_user, self.db_manager)
                 post_question_screen.run()
             elif task == 'search':
-                search_screen = SearchScreen()
-                keywords_to_search = search_screen.run()
-                search_results_screen = SearchResultsScreen(self.db_manager, keywords_to_search)
+                search_screen = SearchScreen(self.search_normalizer)
+                search_query, search_filters = search_screen.run()
+                search_results_screen = SearchResultsScreen(self.db_manager, search_query, search_filters,
+                                                            self.current_user)
                 action = search_results_screen.run()
                 if action != 'done':
-                    post_action_screen = PostActionScreen(self.db_manager, self.current_user, action)
-                    post_action_screen.run()
+                    self._run_post_action(action)
+            elif task == 'profile':
+                profile_screen = ProfileScreen(self.current_user, self.db_manager)
+                profile_screen.run()
             elif task == 'logout':
                 self.current_user = None
             # Happens when task == 'exit'
             else:
                 self.running = False
+        if self.maintenance_scheduler is not None:
+            self.maintenance_scheduler.stop()
         self.db_manager.close_connection()
         clear_screen()
+        renderer.flush()
+        if self.profiler is not None:
+            self.profiler.dump()
 
 
 def main():
     """
     Runs PageBook.
     """
-    assert (len(sys.argv) == 2), 'please enter the correct number of arguments - this program should be run using ' \
-                                 '"python3 prj.py PATH_TO_DATABASE"'
-    assert path.exists(sys.argv[1]), 'path does not exist - please specify a valid path'
-    p = PageBook(sys.argv[1])
+    parser = argparse.ArgumentParser(description='Runs PageBook on the database at PATH_TO_DATABASE.')
+    parser.add_argument('db_path', metavar='PATH_TO_DATABASE', help='path to the database to run PageBook on')
+    parser.add_argument('--transition-delay', type=float, default=0.5, metavar='SECONDS',
+                        help='number of seconds that messages shown before a screen transition (such as a successful '
+                             'login) are displayed for - 0 makes transitions instant (default 0.5)')
+    parser.add_argument('--archive', metavar='PATH_TO_ARCHIVE',
+                        help='path to the database that old posts are archived in (created if it does not exist) - '
+                             'archived posts are only searched when a search includes in:archive')
+    parser.add_argument('--archive-before', metavar='YYYY-MM-DD',
+                        help='archive the questions posted before this date, along with their answers, votes, and '
+                             'tags, into the --archive database and then exit')
+    parser.add_argument('--vote-journal', metavar='PATH_TO_JOURNAL',
+                        help='enable the write-behind vote queue - votes are journaled to this file and written to the '
+                             'database in batches')
+    parser.add_argument('--vote-flush-interval', type=float, default=1.0, metavar='SECONDS',
+                        help='max number of seconds that a vote is queued for before it is written to the database '
+                             '(default 1.0)')
+    parser.add_argument('--maintenance', action='store_true',
+                        help='run database maintenance (ANALYZE/PRAGMA optimize, incremental vacuum, WAL checkpoint, '
+                             'and a quick integrity check), print what was done, and then exit')
+    parser.add_argument('--enable-incremental-vacuum', action='store_true',
+                        help='switch the database to incremental auto-vacuum (rebuilds the database once) so that '
+                             'maintenance can reclaim free pages, and then exit')
+    parser.add_argument('--compress-bodies', metavar='PREVIEW_LENGTH', type=int, nargs='?', const=PREVIEW_LENGTH,
+                        help='switch the database to compressed body storage - the bodies of existing posts (and of '
+                             'posts added or edited from then on) are compressed, keeping their first PREVIEW_LENGTH '
+                             'characters (default {}) as the preview shown in search results, and searched using an '
+                             'index - and then exit'.format(PREVIEW_LENGTH))
+    parser.add_argument('--decompress-bodies', action='store_true',
+                        help='switch the database back to storing the bodies of posts uncompressed and then exit')
+    parser.add_argument('--maintenance-interval', type=float, metavar='SECONDS',
+                        help='run database maintenance in the background every SECONDS seconds (while the user is '
+                             'idle)')
+    parser.add_argument('--maintenance-log', metavar='PATH_TO_LOG',
+                        help='append the report of each background maintenance run to this file')
+    parser.add_argument('--min-keyword-length', type=int, default=2, metavar='N',
+                        help='ignore search keywords shorter than N characters (default 2)')
+    parser.add_argument('--keep-stopwords', action='store_true',
+                        help='search for stopwords (such as "the" and "is") rather than ignoring them')
+    parser.add_argument('--stem-keywords', action='store_true',
+                        help='reduce search keywords to their stems (e.g. indexing to index) so that other forms of '
+                             'the words are also matched')
+    parser.add_argument('--search-index', action='store_true',
+                        help='evaluate searches against an in-memory index of the posts (built at startup and kept up '
+                             'to date before each search) rather than by the database - requires numpy')
+    parser.add_argument('--search-index-report', action='store_true',
+                        help='build the in-memory search index, print its size, build time, and memory footprint, and '
+                             'then exit')
+    parser.add_argument('--existence-filter', action='store_true',
+                        help='answer checks of whether pids and uids exist (e.g. of newly generated pids and of the '
+                             'uids entered at login and sign up) using an in-memory Bloom filter where possible rather '
+                             'than by the database')
+    parser.add_argument('--existence-filter-report', metavar='N', type=int, nargs='?', const=10000,
+                        help='build the existence filter, check N random pids and uids (default 10000) against it, '
+                             'print its size, memory footprint, and expected and observed false positive rates, and '
+                             'then exit')
+    parser.add_argument('--profile', action='store_true',
+                        help='time the setup and run of each screen (split into SQL, terminal output, and Python time) '
+                             'and dump latency histograms per screen at exit and on SIGUSR1')
+    parser.add_argument('--profile-screen', metavar='SCREEN',
+                        help='also profile the screen class SCREEN (e.g. SearchResultsScreen) - implies --profile')
+    parser.add_argument('--profile-mode', choices=('cprofile', 'sample'), default='cprofile',
+                        help='profile --profile-screen with cProfile or by sampling its stack every 5ms, which slows '
+                             'it down much less (default cprofile)')
+    parser.add_argument('--profile-log', metavar='PATH_TO_LOG',
+                        help='append the profiling summaries to this file rather than writing them to stderr - implies '
+                             '--profile')
+    args = parser.parse_args()
+    assert path.exists(args.db_path), 'path does not exist - please specify a valid path'
+    if args.enable_incremental_vacuum:
+        seconds = Maintenance(args.db_path).enable_incremental_vacuum()
+        print('Enabled incremental auto-vacuum ({:.3f}s)'.format(seconds))
+        return
+    if args.search_index_report:
+        db_manager = DBManager(args.db_path)
+        print(db_manager.enable_search_index().report())
+        db_manager.close_connection()
+        return
+    if args.existence_filter_report is not None:
+        db_manager = DBManager(args.db_path, args.archive)
+        existence_filter = db_manager.enable_existence_filter()
+        for _ in range(args.existence_filter_report):
+            db_manager.pid_exists(db_manager._generate_id(4))
+            db_manager.uid_exists(db_manager._generate_id(4))
+        print(existence_filter.report())
+        db_manager.close_connection()
+        return
+    if args.maintenance:
+        print(format_report(Maintenance(args.db_path).run()))
+        return
+    if args.compress_bodies is not None:
+        db_manager = DBManager(args.db_path)
+        num_compressed, before, after, seconds = db_manager.enable_body_compression(args.compress_bodies)
+        db_manager.close_connection()
+        print('Compressed {} bodies - body data went from {:,} to {:,} bytes ({:.3f}s). Run VACUUM (or maintenance '
+              'with incremental auto-vacuum enabled) to return the freed pages to the file system.'
+              .format(num_compressed, before, after, seconds))
+        return
+    if args.decompress_bodies:
+        db_manager = DBManager(args.db_path)
+        num_decompressed, seconds = db_manager.disable_body_compression()
+        db_manager.close_connection()
+        print('Decompressed {} bodies ({:.3f}s)'.format(num_decompressed, seconds))
+        return
+    if args.archive_before is not None:
+        assert args.archive is not None, 'please specify the archive database to archive posts into using --archive'
+        db_manager = DBManager(args.db_path, args.archive)
+        num_archived = db_manager.archive_posts(args.archive_before)
+        db_manager.close_connection()
+        print('Archived {} posts (the questions posted before {} and their answers) into {}'
+              .format(num_archived, args.archive_before, args.archive))
+        return
+    p = PageBook(args.db_path, transition_delay=args.transition_delay, archive_path=args.archive,
+                 vote_journal_path=args.vote_journal, vote_flush_interval=args.vote_flush_interval,
+                 maintenance_interval=args.maintenance_interval, maintenance_log_path=args.maintenance_log,
+                 search_normalizer=SearchNormalizer(frozenset() if args.keep_stopwords else STOPWORDS,
+                                                    args.min_keyword_length, args.stem_keywords),
+                 search_index=args.search_index, existence_filter=args.existence_filter,
+                 profiler=ScreenProfiler(renderer, args.profile_screen, args.profile_mode, log_path=args.profile_log)
+                 if args.profile or args.profile_screen is not None or args.profile_log is not None else None)
     p.run()
 
 
@@ -0,0 +1,361 @@
+import cProfile
+import io
+import pstats
+import signal
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+# Upper bounds (in milliseconds) of the buckets of the latency histograms - the last bucket holds everything above them
+HISTOGRAM_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+def _timed(profiler, background, method, *args):
+    """
+    Calls method with args and adds the time that it took to the SQL time of profiler.
+    :param background: whether method runs on a connection of a background thread (see ScreenProfiler.instrument)
+    :return: what method returned
+    """
+    start = time.perf_counter()
+    try:
+        return method(*args)
+    finally:
+        profiler.add_sql_seconds(time.perf_counter() - start, background)
+
+
+class _TimedCursor:
+    """
+    Proxy of a sqlite3 cursor that adds the time spent executing statements and fetching their rows to the SQL time of
+    a ScreenProfiler. Everything else is delegated to the cursor.
+    """
+
+    def __init__(self, cursor, profiler, background=False):
+        self._cursor = cursor
+        self._profiler = profiler
+        self._background = background
+
+    def execute(self, *args):
+        _timed(self._profiler, self._background, self._cursor.execute, *args)
+        return self
+
+    def executemany(self, *args):
+        _timed(self._profiler, self._background, self._cursor.executemany, *args)
+        return self
+
+    def executescript(self, *args):
+        _timed(self._profiler, self._background, self._cursor.executescript, *args)
+        return self
+
+    def fetchone(self):
+        return _timed(self._profiler, self._background, self._cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return _timed(self._profiler, self._background, self._cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return _timed(self._profiler, self._background, self._cursor.fetchall)
+
+    def __iter__(self):
+        row = self.fetchone()
+        while row is not None:
+            yield row
+            row = self.fetchone()
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _TimedConnection:
+    """
+    Proxy of a sqlite3 connection whose cursors are _TimedCursors and whose commits and rollbacks are added to the SQL
+    time of a ScreenProfiler. Everything else is delegated to the connection.
+    """
+
+    def __init__(self, connection, profiler, background=False):
+        self._connection = connection
+        self._profiler = profiler
+        self._background = background
+
+    def cursor(self, *args):
+        return _TimedCursor(self._connection.cursor(*args), self._profiler, self._background)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def executescript(self, *args):
+        return self.cursor().executescript(*args)
+
+    def commit(self):
+        _timed(self._profiler, self._background, self._connection.commit)
+
+    def rollback(self):
+        _timed(self._profiler, self._background, self._connection.rollback)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+class _ScreenStats:
+    """
+    Latency statistics of one phase (_setup or run) of one screen class. Latency is the time that the phase took apart
+    from the time spent waiting for the user (at prompts and during transitions), and is split into the time spent
+    running SQL, writing output to the terminal, and in Python (everything else).
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.sql = 0
+        self.output = 0
+        self.python = 0
+        self.histogram = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+
+    def add(self, latency, sql, output):
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+        self.sql += sql
+        self.output += output
+        self.python += max(latency - sql - output, 0)
+        milliseconds = latency * 1000
+        bucket = 0
+        while bucket < len(HISTOGRAM_BOUNDS) and milliseconds > HISTOGRAM_BOUNDS[bucket]:
+            bucket += 1
+        self.histogram[bucket] += 1
+
+    def percentile(self, p):
+        """
+        :param p: percentile between 0 and 100
+        :return: upper bound (in milliseconds) of the histogram bucket that the p-th percentile latency falls in, or
+                 None if it falls in the last (unbounded) bucket
+        """
+        target = self.count * p / 100
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+            if seen >= target and count > 0:
+                return HISTOGRAM_BOUNDS[bucket] if bucket < len(HISTOGRAM_BOUNDS) else None
+        return None
+
+
+class ScreenProfiler:
+    """
+    Opt-in instrumentation of the screens (see BaseScreen.profiler). Times the _setup and run methods of each screen
+    and keeps a latency histogram per screen class and method, with the latency split into SQL, terminal output, and
+    Python time, so that it can be told where the time of a slow screen goes. The calls of the methods of one chosen
+    screen class can also be captured by cProfile or by a sampling profiler (which samples the stack of the main thread
+    every sample_interval seconds and so slows the screen down much less). The summary is dumped by dump, e.g. at exit
+    or on SIGUSR1 (see install_signal_handler).
+    """
+
+    def __init__(self, renderer, profile_screen=None, mode='cprofile', sample_interval=0.005, log_path=None):
+        """
+        Initializes an instance of this class.
+        :param renderer: the Renderer that the screens write their output through - the time it spends waiting and
+                         writing output is excluded from / attributed within the latencies
+        :param profile_screen: name of the screen class (e.g. SearchResultsScreen) whose methods are profiled (optional
+                               parameter)
+        :param mode: 'cprofile' to profile the methods of profile_screen with cProfile or 'sample' to sample them
+        :param sample_interval: number of seconds between the samples taken in 'sample' mode
+        :param log_path: path to a file that summaries are appended to - summaries are written to stderr if this is not
+                         specified (optional parameter)
+        """
+        if mode not in ('cprofile', 'sample'):
+            raise ValueError('unknown profiling mode {!r}'.format(mode))
+        self.renderer = renderer
+        self.profile_screen = profile_screen
+        self.mode = mode
+        self.sample_interval = sample_interval
+        self.log_path = log_path
+        self.sql_seconds = 0
+        # SQL run by background threads, which is not part of the latency of any screen (see instrument)
+        self.background_sql_seconds = 0
+        self._background_lock = threading.Lock()
+        self.stats = defaultdict(_ScreenStats)
+        self._profile = cProfile.Profile() if mode == 'cprofile' else None
+        self._samples = Counter()
+        self._num_samples = 0
+        self._sampling = threading.Event()
+        self._sampler = None
+        self._main_thread_id = threading.main_thread().ident
+        self._depth = 0
+
+    def instrument(self, db_manager):
+        """
+        Replaces the connection and cursor of db_manager with proxies that time the SQL that they run. Must be called
+        before anything else (such as the search index or the vote queue) holds on to the connection or clones
+        db_manager. The connections of the database managers that db_manager.clone opens for background threads (such
+        as the page prefetcher and the vote queue) are timed as well, but separately - their SQL runs alongside the
+        screens rather than as part of them, so it is reported as a total instead of in the SQL share of any screen.
+        :param db_manager: the DBManager that the screens run their queries through
+        """
+        self._instrument_connection(db_manager, False)
+        clone = db_manager.clone
+
+        def instrumented_clone():
+            background_manager = clone()
+            self._instrument_connection(background_manager, True)
+            return background_manager
+        db_manager.clone = instrumented_clone
+
+    def _instrument_connection(self, db_manager, background):
+        """
+        Replaces the connection and cursor of db_manager (and of its components) with proxies timing their SQL.
+        :param background: whether the connection is used by a background thread rather than by the screens
+        """
+        db_manager.connection = _TimedConnection(db_manager.connection, self, background)
+        db_manager.cursor = db_manager.connection.cursor()
+        db_manager.changelog.connection = db_manager.connection
+        db_manager.body_store.connection = db_manager.connection
+
+    def add_sql_seconds(self, seconds, background=False):
+        """
+        Adds to the SQL time of the screens (which is only run by the main thread) or of the background threads.
+        :param seconds: number of seconds spent running SQL
+        :param background: whether the SQL was run on a connection of a background thread
+        """
+        if background:
+            with self._background_lock:
+                self.background_sql_seconds += seconds
+        else:
+            self.sql_seconds += seconds
+
+    def wrap(self, screen, phase, method):
+        """
+        :param screen: the screen that method is bound to
+        :param phase: name of the method ('_setup' or 'run')
+        :param method: the bound method to time
+        :return: a function that calls method and records its latency
+        """
+        key = (type(screen).__name__, phase)
+        profiled = key[0] == self.profile_screen
+
+        def timed(*args, **kwargs):
+            waiting, output, sql = self.renderer.waiting_seconds, self.renderer.output_seconds, self.sql_seconds
+            start = time.perf_counter()
+            if profiled:
+                self._start_profiling()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                if profiled:
+                    self._stop_profiling()
+                wall = time.perf_counter() - start
+                latency = max(wall - (self.renderer.waiting_seconds - waiting), 0)
+                self.stats[key].add(latency, self.sql_seconds - sql, self.renderer.output_seconds - output)
+        return timed
+
+    def _start_profiling(self):
+        self._depth += 1
+        if self._depth > 1:
+            return
+        if self.mode == 'cprofile':
+            self._profile.enable()
+            return
+        if self._sampler is None:
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+        self._sampling.set()
+
+    def _stop_profiling(self):
+        self._depth -= 1
+        if self._depth > 0:
+            return
+        if self.mode == 'cprofile':
+            self._profile.disable()
+        else:
+            self._sampling.clear()
+
+    def _sample(self):
+        """
+        Samples the stack of the main thread while a method of profile_screen is running and the user is not being
+        waited for. Runs in the background.
+        """
+        while True:
+            self._sampling.wait()
+            time.sleep(self.sample_interval)
+            if not self._sampling.is_set() or self.renderer.idle_time() > 0:
+                continue
+            frame = sys._current_frames().get(self._main_thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{}:{}:{}'.format(code.co_filename.rsplit('/', 1)[-1], code.co_name, frame.f_lineno))
+                frame = frame.f_back
+            self._samples[';'.join(reversed(stack))] += 1
+            self._num_samples += 1
+
+    def summary(self, top=25):
+        """
+        :param top: max number of functions / stacks of the profiled screen to list
+        :return: the latency statistics of each screen class and method as a printable string, followed by the profile
+                 of profile_screen (if any)
+        """
+        lines = ['PageBook screen profile ({})'.format(datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
+                 '{:<36}{:>7}{:>10}{:>10}{:>10}{:>10}{:>10}{:>9}{:>9}{:>9}'
+                 .format('screen', 'calls', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'sql %', 'out %',
+                         'py %')]
+        for (screen, phase), stats in sorted(self.stats.items(), key=lambda item: -item[1].total):
+            percentiles = [stats.percentile(p) for p in (50, 95, 99)]
+            lines.append('{:<36}{:>7}{:>10.2f}{:>10}{:>10}{:>10}{:>10.2f}{:>9.1f}{:>9.1f}{:>9.1f}'.format(
+                screen + '.' + phase, stats.count, stats.total / stats.count * 1000,
+                *('<=' + str(p) if p is not None else '>' + str(HISTOGRAM_BOUNDS[-1]) for p in percentiles),
+                stats.max * 1000, *(100 * part / stats.total if stats.total > 0 else 0
+                                    for part in (stats.sql, stats.output, stats.python))))
+        lines.append('SQL run by background threads (prefetching and the vote queue), not included above: {:.3f}s'
+                     .format(self.background_sql_seconds))
+        lines.append('\nLatency histograms (calls per bucket, upper bounds in ms):')
+        labels = ['<=' + str(bound) for bound in HISTOGRAM_BOUNDS] + ['>' + str(HISTOGRAM_BOUNDS[-1])]
+        for (screen, phase), stats in sorted(self.stats.items()):
+            buckets = ('{} {}'.format(label, count) for label, count in zip(labels, stats.histogram) if count > 0)
+            lines.append('  {}: {}'.format(screen + '.' + phase, ', '.join(buckets)))
+        if self.profile_screen is not None:
+            lines.append('\nProfile of {} ({}):'.format(self.profile_screen, self.mode))
+            if self.mode == 'cprofile':
+                stream = io.StringIO()
+                try:
+                    pstats.Stats(self._profile, stream=stream).sort_stats('cumulative').print_stats(top)
+                    lines.append(stream.getvalue().strip())
+                except TypeError:
+                    # pstats cannot load a profile that has not recorded any calls
+                    lines.append('no calls recorded')
+            else:
+                lines.append('{} samples every {}s - hottest stacks (outermost frame first):'
+                             .format(self._num_samples, self.sample_interval))
+                for stack, count in self._samples.most_common(top):
+                    lines.append('{:>6} {:>5.1f}%  {}'.format(count, 100 * count / self._num_samples, stack))
+                own = Counter()
+                for stack, count in self._samples.items():
+                    own[stack.rsplit(';', 1)[-1]] += count
+                lines.append('Hottest lines (samples in which they were running):')
+                for line, count in own.most_common(top):
+                    lines.append('{:>6} {:>5.1f}%  {}'.format(count, 100 * count / self._num_samples, line))
+        return '\n'.join(lines)
+
+    def dump(self):
+        """
+        Appends the summary to log_path, or writes it to stderr if log_path is not specified.
+        """
+        if self.log_path is None:
+            sys.stderr.write(self.summary() + '\n')
+            sys.stderr.flush()
+        else:
+            with open(self.log_path, 'a') as log:
+                log.write(self.summary() + '\n\n')
+
+    def install_signal_handler(self, signum=None):
+        """
+        Dumps the summary whenever the process receives signum (SIGUSR1 by default, on platforms that have it).
+        :param signum: the signal to dump the summary on (optional parameter)
+        """
+        if signum is None:
+            if not hasattr(signal, 'SIGUSR1'):
+                return
+            signum = signal.SIGUSR1
+        signal.signal(signum, lambda received, frame: self.dump())
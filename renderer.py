@@ -0,0 +1,91 @@
+import sys
+import time
+from time import sleep
+
+CLEAR_SEQUENCE = '\x1b[2J\x1b[H'
+
+
+class Renderer:
+    """
+    Class handling the output of the screens to the terminal. Output is composed into frames that are written to the
+    terminal in a single buffered write (the screen is cleared using an ANSI escape sequence rather than by running the
+    clear command in a subprocess) whenever the user is prompted for input or the output needs to be seen.
+    """
+
+    def __init__(self, stream=None, transition_delay=0.5):
+        """
+        Initializes an instance of this class.
+        :param stream: the text stream to write frames to (sys.stdout by default)
+        :param transition_delay: number of seconds that messages shown before a screen transition (such as a successful
+                                 login) are displayed for - 0 makes transitions instant
+        """
+        self.stream = sys.stdout if stream is None else stream
+        self.transition_delay = transition_delay
+        self._frame = []
+        self._waiting_since = None
+        # Running totals of the time spent writing frames and waiting (for input or during transitions), which are used
+        # to tell the time spent by the screens themselves apart (see profiling.ScreenProfiler)
+        self.output_seconds = 0
+        self.waiting_seconds = 0
+
+    def clear(self):
+        """
+        Starts a new frame that clears the screen when it is written. Any output of the previous frame that has not yet
+        been written is discarded as it would have been cleared immediately anyways.
+        """
+        self._frame = [CLEAR_SEQUENCE]
+
+    def print(self, *values, sep=' ', end='\n'):
+        """
+        Adds output to the current frame - takes the same arguments as the print builtin.
+        :param values: the values to output
+        :param sep: string inserted between values
+        :param end: string appended after the last value
+        """
+        self._frame.append(sep.join(str(value) for value in values) + end)
+
+    def flush(self):
+        """
+        Writes the current frame to the terminal in a single write.
+        """
+        start = time.perf_counter()
+        if len(self._frame) > 0:
+            self.stream.write(''.join(self._frame))
+            self._frame = []
+        self.stream.flush()
+        self.output_seconds += time.perf_counter() - start
+
+    def prompt(self, prompt='> '):
+        """
+        Writes the current frame (ending with prompt) to the terminal and then gets a line of input from the user.
+        :param prompt: the text to display before the users input
+        :return: the line of input entered by the user (without the trailing newline)
+        """
+        self._frame.append(prompt)
+        self.flush()
+        self._waiting_since = time.monotonic()
+        start = time.perf_counter()
+        try:
+            return input()
+        finally:
+            self._waiting_since = None
+            self.waiting_seconds += time.perf_counter() - start
+
+    def idle_time(self):
+        """
+        Gets how long the user has been idle for, i.e. how long the program has been waiting for their input.
+        :return: number of seconds that the current prompt has been waiting for input for (0 if not at a prompt)
+        """
+        waiting_since = self._waiting_since
+        return 0 if waiting_since is None else time.monotonic() - waiting_since
+
+    def pause(self):
+        """
+        Writes the current frame to the terminal and then waits for transition_delay seconds so that it can be read
+        before the screen changes.
+        """
+        self.flush()
+        if self.transition_delay > 0:
+            start = time.perf_counter()
+            sleep(self.transition_delay)
+            self.waiting_seconds += time.perf_counter() - start
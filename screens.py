@@ -1,12 +1,18 @@
-import os
-from time import sleep
+from datetime import datetime
+
+from prefetch import PagePrefetcher
+from renderer import Renderer
+from search_query import SearchNormalizer, SearchQueryError, parse_search_query
+
+# All of the screens write their output through this renderer
+renderer = Renderer()
 
 
 def clear_screen():
     """
-    Clears the current shell screen.
+    Clears the current shell screen - the screen is cleared when the next frame of output is written by the renderer.
     """
-    os.system('clear')
+    renderer.clear()
 
 
 def select_from_menu(valid_inputs):
@@ -18,19 +24,67 @@ def select_from_menu(valid_inputs):
     :param valid_inputs: list including all the inputs that should be considered valid
     :return: a string corresponding to the users valid selection
     """
-    selection = input('> ')
+    selection = renderer.prompt()
     while selection not in valid_inputs:
-        print('"{}" is an invalid selection, please enter a valid selection from the menu above.'
-              .format(selection))
-        selection = input('> ')
+        renderer.print('"{}" is an invalid selection, please enter a valid selection from the menu above.'
+                       .format(selection))
+        selection = renderer.prompt()
     return selection
 
 
+def select_badge(db_manager, recipient):
+    """
+    Lists the badges that exist and prompts the user for the name of the badge to give until they enter the name of one
+    of them (case-insensitive).
+    :param db_manager: sqlite database manager
+    :param recipient: description of who the badge is to be given to (shown in the prompt)
+    :return: the name of the badge that the user entered
+    """
+    bnames = [bname.lower() for bname in db_manager.get_existing_badges()]
+    renderer.print('\nThe names of the badges that currently exist are:')
+    for bname in bnames:
+        renderer.print('\t- {}'.format(bname))
+    renderer.print('\nPlease enter the name of the badge that you would like to give to {}:'.format(recipient))
+    badge_to_give = renderer.prompt()
+    while badge_to_give.lower() not in bnames:
+        renderer.print('"{}" is an invalid selection, please enter a valid selection from the menu above.'
+                       .format(badge_to_give))
+        badge_to_give = renderer.prompt()
+    return badge_to_give
+
+
+def get_post_edit():
+    """
+    Prompts the user to select whether to edit the title and/or the body of a post and to enter the new title and/or
+    body.
+    :return: tuple of the new title and the new body (None for a field that is not to be edited)
+    """
+    valid_inputs = ['1', '2', '3']
+    renderer.print('\nPlease select one of the following actions:\n'
+                   '\t[1] Edit the title of the post\n'
+                   '\t[2] Edit the body of the post\n'
+                   '\t[3] Edit the title and the body of the post')
+    selection = select_from_menu(valid_inputs)
+    new_title = None
+    new_body = None
+    if selection in ('1', '3'):
+        renderer.print('\nPlease enter the new title for the post:')
+        new_title = renderer.prompt()
+    if selection in ('2', '3'):
+        renderer.print('\nPlease enter the new body for the post:')
+        new_body = renderer.prompt()
+    return new_title, new_body
+
+
 class BaseScreen:
     """
     Base class representing a screen. Child classes must implement the _setup and run methods described below.
     """
 
+    # The ScreenProfiler that times the _setup and run methods of every screen - screens are only profiled if this is
+    # set (see PageBook)
+    profiler = None
+
     def __init__(self, current_uid=None, db_manager=None):
         """
         Clears the screen upon initialization and runs the child class' _setup method.
@@ -39,6 +93,9 @@ class BaseScreen:
         """
         self.current_user = None if current_uid is None else current_uid
         self.db_manager = None if db_manager is None else db_manager
+        if BaseScreen.profiler is not None:
+            self._setup = BaseScreen.profiler.wrap(self, '_setup', self._setup)
+            self.run = BaseScreen.profiler.wrap(self, 'run', self.run)
         clear_screen()
         self._setup()
 
@@ -68,26 +125,26 @@ class StartScreen(BaseScreen):
         """
         Prints out the screen title and the options supported by this screen.
         """
-        print('WELCOME TO___________________________________________________\n'
-              '                                                            /\n'
-              '       ____________________________________                /\n'
-              '      /  ___   /  ___   /  _______/  _____/               /\n'
-              '     /  /__/  /  /__/  /  / _____/  /__                  /\n'
-              '    /  ______/  ___   /  / /_   /  ___/                 /\n'
-              '   /  /     /  /  /  /  /___/  /  /____                /\n'
-              '  /__/     /__/__/__/_________/_______/____  ___      /\n'
-              '          /  __  / /  _____  /  ____   /  / /  /     /\n'
-              '         /  /_/ /_/  /   /  /  /   /  /  /_/  /_    /\n'
-              '        /  ___   /  /   /  /  /   /  /  ____   /   /\n'
-              '       /  /__/  /  /___/  /  /___/  /  /   /  /   /\n'
-              '      /________/_________/_________/__/   /__/   /\n'
-              '                                                /\n'
-              '_______________________________________________/\n'
-              '\n'
-              'Please select the type of user that you are:\n'
-              '\t[1] registered user\n'
-              '\t[2] unregistered user\n'
-              '\t[3] exit')
+        renderer.print('WELCOME TO___________________________________________________\n'
+                       '                                                            /\n'
+                       '       ____________________________________                /\n'
+                       '      /  ___   /  ___   /  _______/  _____/               /\n'
+                       '     /  /__/  /  /__/  /  / _____/  /__                  /\n'
+                       '    /  ______/  ___   /  / /_   /  ___/                 /\n'
+                       '   /  /     /  /  /  /  /___/  /  /____                /\n'
+                       '  /__/     /__/__/__/_________/_______/____  ___      /\n'
+                       '          /  __  / /  _____  /  ____   /  / /  /     /\n'
+                       '         /  /_/ /_/  /   /  /  /   /  /  /_/  /_    /\n'
+                       '        /  ___   /  /   /  /  /   /  /  ____   /   /\n'
+                       '       /  /__/  /  /___/  /  /___/  /  /   /  /   /\n'
+                       '      /________/_________/_________/__/   /__/   /\n'
+                       '                                                /\n'
+                       '_______________________________________________/\n'
+                       '\n'
+                       'Please select the type of user that you are:\n'
+                       '\t[1] registered user\n'
+                       '\t[2] unregistered user\n'
+                       '\t[3] exit')
 
     def run(self):
         """
@@ -115,26 +172,26 @@ class LoginScreen(BaseScreen):
         """
         Prints out the screen title.
         """
-        print('LOGIN')
+        renderer.print('LOGIN')
 
     def run(self):
         """
-        Carries out the login process. On successful login a message is displayed for 0.5 sec before the program
-        continues and the uid of the logged in user is returned.
+        Carries out the login process. On successful login a message is displayed briefly (see Renderer.pause) before
+        the program continues and the uid of the logged in user is returned.
         :return: the uid of the logged in user
         """
-        print('\nPlease enter your user id (max 4 characters):')
-        login_uid = input('> ')
+        renderer.print('\nPlease enter your user id (max 4 characters):')
+        login_uid = renderer.prompt()
         while (len(login_uid) > 4) or (not self.db_manager.uid_exists(login_uid)):
-            print('Invalid user id, try again:')
-            login_uid = input('> ')
-        print('\nPlease enter your password:')
-        login_pwd = input('> ')
+            renderer.print('Invalid user id, try again:')
+            login_uid = renderer.prompt()
+        renderer.print('\nPlease enter your password:')
+        login_pwd = renderer.prompt()
         while not self.db_manager.valid_login(login_uid, login_pwd):
-            print('Incorrect password, try again:')
-            login_pwd = input('> ')
-        print('\nLogin Successful')
-        sleep(0.5)
+            renderer.print('Incorrect password, try again:')
+            login_pwd = renderer.prompt()
+        renderer.print('\nLogin Successful')
+        renderer.pause()
         return self.db_manager.get_uid_from_table(login_uid)
 
 
@@ -154,28 +211,28 @@ class SignUpScreen(BaseScreen):
         """
         Prints out the screen title.
         """
-        print('SIGN UP')
+        renderer.print('SIGN UP')
 
     def run(self):
         """
-        Carries out the sign up process. On successful sign up a message is displayed for 0.5 sec before the program
-        continues, the user is logged in, and the uid of the new logged in user is returned.
+        Carries out the sign up process. On successful sign up a message is displayed briefly (see Renderer.pause)
+        before the program continues, the user is logged in, and the uid of the new logged in user is returned.
         :return: the uid of the logged in user
         """
-        print('\nPlease enter a user id that you would like to use (max 4 characters):')
-        new_uid = input('> ')
+        renderer.print('\nPlease enter a user id that you would like to use (max 4 characters):')
+        new_uid = renderer.prompt()
         while (len(new_uid) > 4) or (self.db_manager.uid_exists(new_uid)):
-            print('The entered user id either has more than 4 characters or already exists, try again:')
-            new_uid = input('> ')
-        print('\nPlease enter your name:')
-        name = input('> ')
-        print('\nPlease enter the name of the city you live in:')
-        city = input('> ')
-        print('\nPlease enter the password you would like to use:')
-        pwd = input('> ')
+            renderer.print('The entered user id either has more than 4 characters or already exists, try again:')
+            new_uid = renderer.prompt()
+        renderer.print('\nPlease enter your name:')
+        name = renderer.prompt()
+        renderer.print('\nPlease enter the name of the city you live in:')
+        city = renderer.prompt()
+        renderer.print('\nPlease enter the password you would like to use:')
+        pwd = renderer.prompt()
         self.db_manager.add_user(new_uid, name, pwd, city)
-        print('\nSign Up Successful - you will now be logged in')
-        sleep(0.5)
+        renderer.print('\nSign Up Successful - you will now be logged in')
+        renderer.pause()
         return new_uid
 
 
@@ -195,26 +252,66 @@ class MainMenuScreen(BaseScreen):
         """
         Prints out the screen title and the options supported by this screen.
         """
-        print('MAIN MENU\n'
-              '\n'
-              'Welcome {}!\n'
-              '\n'
-              'Please select the task that you would like to perform:\n'
-              '\t[1] Post a question\n'
-              '\t[2] Search for posts\n'
-              '\t[3] Logout\n'
-              '\t[4] Exit'.format(self.current_user))
+        renderer.print('MAIN MENU\n'
+                       '\n'
+                       'Welcome {}!\n'
+                       '\n'
+                       'Please select the task that you would like to perform:\n'
+                       '\t[1] Post a question\n'
+                       '\t[2] Search for posts\n'
+                       '\t[3] View your profile\n'
+                       '\t[4] Logout\n'
+                       '\t[5] Exit'.format(self.current_user))
 
     def run(self):
         """
         Gets the task that the user would like to perform and returns it.
         :return: a string representing the task the user would like to perform
         """
-        tasks = {'1': 'post question', '2': 'search', '3': 'logout', '4': 'exit'}
-        valid_inputs = ['1', '2', '3', '4']
+        tasks = {'1': 'post question', '2': 'search', '3': 'profile', '4': 'logout', '5': 'exit'}
+        valid_inputs = ['1', '2', '3', '4', '5']
         return tasks[select_from_menu(valid_inputs)]
 
 
+class ProfileScreen(BaseScreen):
+    """
+    Class representing the profile screen.
+    """
+
+    def __init__(self, current_uid, db_manager):
+        """
+        Initializes an instance of this class.
+        :param current_uid: the uid of the user that is currently logged in
+        :param db_manager: sqlite database manager
+        """
+        BaseScreen.__init__(self, current_uid=current_uid, db_manager=db_manager)
+
+    def _setup(self):
+        """
+        Prints out the screen title and the stats of the user that is currently logged in.
+        """
+        renderer.print('PROFILE')
+        stats = self.db_manager.get_user_stats(self.current_user)
+        if stats is None:
+            stats = (0, 0, 0, 0, 0, 0, 0)
+        num_posts, num_questions, num_answers, votes_received, num_badges, num_accepted, reputation = stats
+        renderer.print('\n{}\n'
+                       '\tREPUTATION: {}\n'
+                       '\tPOSTS: {}\t(QUESTIONS: {}\tANSWERS: {})\n'
+                       '\tVOTES RECEIVED: {}\n'
+                       '\tBADGES: {}\n'
+                       '\tACCEPTED ANSWERS: {}'
+                       .format(self.current_user, reputation, num_posts, num_questions, num_answers, votes_received,
+                               num_badges, num_accepted))
+
+    def run(self):
+        """
+        Waits for the user to return to the main menu.
+        """
+        renderer.print('\nPlease enter any key to return to the main menu:')
+        renderer.prompt()
+
+
 class PostQuestionScreen(BaseScreen):
     """
     Class representing the post question screen.
@@ -231,17 +328,17 @@ class PostQuestionScreen(BaseScreen):
         self.question_body = None
 
     def _setup(self):
-        print('POST QUESTION')
+        renderer.print('POST QUESTION')
 
     def _get_new_question_data(self):
         """
         Prompts the user to enter the title and body texts of the question they want to add and sets the
         question_title and question_body class attributes accordingly.
         """
-        print('\nPlease enter the title of your question:')
-        self.question_title = input('> ')
-        print('\nPlease enter the body of your question:')
-        self.question_body = input('> ')
+        renderer.print('\nPlease enter the title of your question:')
+        self.question_title = renderer.prompt()
+        renderer.print('\nPlease enter the body of your question:')
+        self.question_body = renderer.prompt()
 
     def run(self):
         """
@@ -252,18 +349,18 @@ class PostQuestionScreen(BaseScreen):
         valid_inputs = ['Y', 'y', 'E', 'e', 'N', 'n']
         while True:
             self._get_new_question_data()
-            print('\nQuestion Summary\nTitle: {}\nBody: {}\n'.format(self.question_title, self.question_body))
-            print('Please select one of the following actions:\n'
-                  '\t[Y/y] To confirm and post the question above\n'
-                  '\t[E/e] To re-enter the question title and body\n'
-                  '\t[N/n] To return to the main menu')
+            renderer.print('\nQuestion Summary\nTitle: {}\nBody: {}\n'.format(self.question_title, self.question_body))
+            renderer.print('Please select one of the following actions:\n'
+                           '\t[Y/y] To confirm and post the question above\n'
+                           '\t[E/e] To re-enter the question title and body\n'
+                           '\t[N/n] To return to the main menu')
             selection = select_from_menu(valid_inputs)
             if selection.lower() == 'y':
                 self.db_manager.new_post(self.question_title, self.question_body, self.current_user)
                 clear_screen()
-                print('POST QUESTION')
-                print('\nQuestion posted successfully - please enter any key to return to the main menu:')
-                input('> ')
+                renderer.print('POST QUESTION')
+                renderer.print('\nQuestion posted successfully - please enter any key to return to the main menu:')
+                renderer.prompt()
                 break
             elif selection.lower() == 'n':
                 break
@@ -274,28 +371,77 @@ class SearchScreen(BaseScreen):
     Class representing the search screen.
     """
 
-    def __init__(self):
+    def __init__(self, normalizer=None):
         """
         Initializes an instance of this class.
+        :param normalizer: the SearchNormalizer that searches are normalized by (by default stopwords and keywords
+                           shorter than 2 characters are dropped)
         """
         BaseScreen.__init__(self)
+        self.normalizer = SearchNormalizer() if normalizer is None else normalizer
         self.question_title = None
         self.question_body = None
 
     def _setup(self):
-        print('SEARCH')
+        renderer.print('SEARCH')
 
-    def run(self):
+    def _get_date_range(self):
         """
-        Prompts the user to enter one or more space seperated keywords.
-        :return: list consisting of each space seperated keyword as a seperate element.
+        Prompts the user to enter an optional date range (either end of which can be left open). The user is prompted
+        again until a valid date range is entered.
+        :return: tuple consisting of the first and last dates (YYYY-MM-DD) of the range, each of which is None if that
+                 end of the range was left open
         """
-        print('\nPlease enter a space separated list of keywords that you would like to search for:')
-        search_string = input('> ')
-        while search_string == '':
-            print('You must enter at least one keyword, try again:')
-            search_string = input('> ')
-        return search_string.split(' ')
+        renderer.print('\nOptionally, enter a date range to only search posts posted within it (FROM..TO, where each '
+                       'date is YYYY-MM-DD and either can be left out, e.g. 2020-10-01.. for posts posted on or since '
+                       'October 1st 2020), or leave blank to search posts from any date:')
+        while True:
+            date_range = renderer.prompt().strip()
+            if date_range == '':
+                return None, None
+            dates = [date.strip() for date in date_range.split('..')] if '..' in date_range else [date_range] * 2
+            try:
+                for date in dates:
+                    if date != '':
+                        datetime.strptime(date, '%Y-%m-%d')
+            except ValueError:
+                renderer.print('"{}" is not a valid date range, try again:'.format(date_range))
+                continue
+            if len(dates) != 2 or dates == ['', '']:
+                renderer.print('"{}" is not a valid date range, try again:'.format(date_range))
+                continue
+            return tuple(None if date == '' else date for date in dates)
+
+    def run(self):
+        """
+        Prompts the user to enter a search - one or more space seperated keywords or "quoted phrases", optionally
+        combined using AND, OR, NOT (or -), and parentheses, or restricted to a field using title:, body:, tag:, or
+        poster:. The user is prompted again until the search can be parsed. The keywords of the search are normalized
+        (see search_query.SearchNormalizer) and the user is shown the keywords that were ignored. Then prompts the user
+        to optionally restrict the search to a date range and to the posts of a single poster.
+        :return: tuple consisting of the SearchQuery corresponding to the search that the user entered and a dictionary
+                 of the filters (date_from, date_to, and poster) that the user entered (None for those left blank)
+        """
+        renderer.print('\nPlease enter a space separated list of keywords that you would like to search for:\n'
+                       '\t- posts matching any of the keywords are found, "quoted phrases" are matched as a whole\n'
+                       '\t- combine keywords using AND, OR, NOT (or -keyword), and parentheses\n'
+                       '\t- restrict a keyword to a field using title:, body:, tag:, or poster: (e.g. tag:sql)\n'
+                       '\t- add in:archive to also search archived posts')
+        while True:
+            search_string = renderer.prompt()
+            try:
+                search_query, dropped = self.normalizer.normalize(parse_search_query(search_string))
+                break
+            except SearchQueryError as e:
+                renderer.print('Invalid search ({}), try again:'.format(e))
+        if len(dropped) > 0:
+            renderer.print('\nIgnored keywords: {}'.format(', '.join('{} ({})'.format(term, reason)
+                                                                      for term, reason in dropped)))
+        date_from, date_to = self._get_date_range()
+        renderer.print('\nOptionally, enter the user id of a poster to only search their posts, or leave blank to '
+                       'search the posts of all users:')
+        poster = renderer.prompt().strip()
+        return search_query, {'date_from': date_from, 'date_to': date_to, 'poster': None if poster == '' else poster}
 
 
 class SearchResultsScreen(BaseScreen):
@@ -303,89 +449,293 @@ class SearchResultsScreen(BaseScreen):
     Class representing the search results screen.
     """
 
-    def __init__(self, db_manager, keywords_to_search):
+    def __init__(self, db_manager, search_query, search_filters=None, current_uid=None):
         """
         Initializes an instance of this class.
         :param db_manager: sqlite database manager
-        :param keywords_to_search: the search keywords specified by the user
-        """
-        self.keywords = keywords_to_search
-        self.sorted_search_matches = None
-        BaseScreen.__init__(self, db_manager=db_manager)
+        :param search_query: the SearchQuery specified by the user
+        :param search_filters: dictionary of the date_from, date_to, and poster filters specified by the user (optional
+                               parameter)
+        :param current_uid: the uid of the user that is currently logged in - privileged users can moderate several of
+                            the matches at once (optional parameter)
+        """
+        self.search_query = search_query
+        self.search_filters = {} if search_filters is None else search_filters
+        self.page_size = 5
+        self.ranked_matches = None
+        self.privileged = False
+        BaseScreen.__init__(self, current_uid=current_uid, db_manager=db_manager)
 
     def _setup(self):
-        print('SEARCH RESULTS')
-        self.sorted_search_matches = self.db_manager.execute_search(self.keywords)
+        renderer.print('SEARCH RESULTS')
+        self.ranked_matches = self.db_manager.rank_search(self.search_query, **self.search_filters)
+        self.privileged = self.current_user is not None and self.db_manager.check_privilege(self.current_user)
 
-    def _post_action_prompt(self, current_page, num_matches, page_upper_bound):
+    def _post_action_prompt(self, first, num_posts, has_next_page):
         """
         Prompts the user to select an action between returning to the main menu, seeing more matches (if there are more
-        than 5, and so on), and selecting a post to perform an action on. A max of 5 posts are displayed at once.
-        :param current_page: essentially the number of times the user has selected the see more matches action
-        :param num_matches: total number of posts that contained a least one keyword in either its title, body, or tag
-                            fields
-        :param page_upper_bound: highest numbered matching post that is to be displayed on this page
+        than 5, and so on), moderating several of the matches at once (privileged users only), and selecting a post to
+        perform an action on. A max of 5 posts are displayed at once.
+        :param first: number of matching posts that came before this page
+        :param num_posts: number of matching posts displayed on this page
+        :param has_next_page: whether there are more matching posts after this page
         :return: the action that the user selected - will either be a string if they have selected to return to the
-                 main menu or navigate to the next page or a tuple if they want to perform an action on a post
-        """
-        valid_inputs = [str(i) for i in range((current_page * 5) + 1, page_upper_bound + 1, 1)]
-        if num_matches == page_upper_bound:
-            valid_inputs += ['a']
-            print('\nPlease select the action that you would like to take:\n'
-                  '\t[a] Return to the main menu\n'
-                  '\t[#] Enter the number corresponding to the post that you would like to perform an action on')
-        else:
-            valid_inputs += ['a', 'b']
-            print('\nPlease select the action that you would like to take:\n'
-                  '\t[a] Return to the main menu\n'
-                  '\t[b] See more matches\n'
-                  '\t[#] Enter the number corresponding to the post that you would like to perform an action on')
+                 main menu, navigate to the next page, or moderate matches or the number of the post they want to
+                 perform an action on
+        """
+        valid_inputs = [str(i) for i in range(first + 1, first + num_posts + 1, 1)] + ['a']
+        options = '\nPlease select the action that you would like to take:\n\t[a] Return to the main menu\n'
+        if has_next_page:
+            valid_inputs += ['b']
+            options += '\t[b] See more matches\n'
+        if self.privileged:
+            valid_inputs += ['m']
+            options += '\t[m] Moderate several of the matches at once (add a tag, give a badge, or edit)\n'
+        renderer.print(options + '\t[#] Enter the number corresponding to the post that you would like to perform an '
+                                 'action on')
         selection = select_from_menu(valid_inputs)
         if selection == 'a':
             return 'main menu'
         elif selection == 'b':
             return 'next page'
+        elif selection == 'm':
+            return 'moderate'
         else:
             return selection
 
+    def _parse_selection(self, selection):
+        """
+        Parses the user's selection of matches to moderate.
+        :param selection: "all" or a comma separated list of match numbers and ranges of them (e.g. 1-20,25)
+        :return: sorted list of the selected match numbers, or None if selection is invalid
+        """
+        num_matches = len(self.ranked_matches)
+        if selection.lower() == 'all':
+            return list(range(1, num_matches + 1))
+        numbers = set()
+        for part in selection.split(','):
+            bounds = part.strip().split('-')
+            if len(bounds) > 2 or not all(bound.strip().isdigit() for bound in bounds):
+                return None
+            low, high = int(bounds[0]), int(bounds[-1])
+            if not 1 <= low <= high <= num_matches:
+                return None
+            numbers.update(range(low, high + 1))
+        return sorted(numbers)
+
+    def _print_bulk_result(self, result, applied, skipped):
+        """
+        Prints the outcome of a bulk moderation operation.
+        :param result: the BulkResult of the operation
+        :param applied: message describing what was done, formatted with the number of posts (or users) it was done to
+        :param skipped: message describing why posts (or users) were skipped, formatted with their number
+        """
+        renderer.print('\n' + applied.format(len(result.applied)))
+        if len(result.skipped) > 0:
+            renderer.print(skipped.format(len(result.skipped)))
+        if len(result.archived) > 0:
+            renderer.print('{} archived posts were skipped as archived posts are read-only'
+                           .format(len(result.archived)))
+        if len(result.not_found) > 0:
+            renderer.print('{} posts no longer exist: {}'.format(len(result.not_found), ', '.join(result.not_found)))
+
+    def _moderate(self):
+        """
+        Allows a privileged user to select several of the matches (by number, or all of them) and to add a tag to them,
+        give a badge to their posters, or edit their titles and/or bodies, in one operation (see
+        DBManager.bulk_add_tag, bulk_give_badge, and bulk_update_posts).
+        """
+        renderer.print('\nPlease enter the numbers of the matches that you would like to moderate, as a comma '
+                       'separated list of numbers and ranges (e.g. 1-20,25), or "all" for all {} matches:'
+                       .format(len(self.ranked_matches)))
+        selection = renderer.prompt().strip()
+        numbers = self._parse_selection(selection)
+        while numbers is None:
+            renderer.print('"{}" is not a valid selection, try again:'.format(selection))
+            selection = renderer.prompt().strip()
+            numbers = self._parse_selection(selection)
+        pids = [self.ranked_matches[number - 1][0] for number in numbers]
+        renderer.print('\nPlease select the action that you would like to take on the {} selected matches:\n'
+                       '\t[1] Add a tag\n'
+                       '\t[2] Give a badge to their posters\n'
+                       '\t[3] Edit them\n'
+                       '\t[4] Return to the main menu'.format(len(pids)))
+        selection = select_from_menu(['1', '2', '3', '4'])
+        if selection == '4':
+            return
+        if selection == '1':
+            renderer.print('\nPlease enter the name of the tag that you would like to add to the selected matches:')
+            tag_name = renderer.prompt()
+            summary = 'add the tag "{}" to {} posts'.format(tag_name, len(pids))
+        elif selection == '2':
+            badge_to_give = select_badge(self.db_manager, 'the posters of the selected matches')
+            summary = 'give the badge "{}" to the posters of {} posts'.format(badge_to_give, len(pids))
+        else:
+            new_title, new_body = get_post_edit()
+            summary = 'update the {} of {} posts'.format('body' if new_title is None else 'title' if new_body is None
+                                                         else 'title and body', len(pids))
+        renderer.print('\nPlease select one of the following actions:\n'
+                       '\t[Y/y] To confirm and {}\n'
+                       '\t[N/n] To return to the main menu without making any changes'.format(summary))
+        if select_from_menu(['Y', 'y', 'N', 'n']).lower() == 'n':
+            return
+        clear_screen()
+        renderer.print('SEARCH RESULTS')
+        if selection == '1':
+            self._print_bulk_result(self.db_manager.bulk_add_tag(pids, tag_name),
+                                    'Added the tag "{}" to {{}} posts'.format(tag_name),
+                                    '{} posts already had the tag')
+        elif selection == '2':
+            self._print_bulk_result(self.db_manager.bulk_give_badge(pids, badge_to_give),
+                                    'Gave the badge "{}" to {{}} users'.format(badge_to_give),
+                                    '{} users were skipped as they have already received a badge today')
+        else:
+            self._print_bulk_result(self.db_manager.bulk_update_posts(pids, new_title, new_body),
+                                    'Updated {} posts', '')
+        renderer.print('\nPlease enter any key to return to the main menu:')
+        renderer.prompt()
+
+    def _print_post(self, number, post):
+        """
+        Prints the details of one of the matching posts.
+        :param number: the number that the user enters to select the post
+        :param post: a tuple corresponding to the data-fields of the post
+        """
+        if len(post) == 8:
+            pid, pdate, title, body, poster, num_answers, num_votes, _ = post
+        else:
+            pid, pdate, title, body, poster, num_votes, _ = post
+        renderer.print('\n\t[{}] {}\n'
+                       '\t\t{}\n'
+                       '\t\tID: {}\tDATE: {}\tPOSTER: {}\tVOTES: {}'
+                       .format(number, title, body, pid, pdate, poster, num_votes))
+        if len(post) == 8:
+            renderer.print('\t\tANSWERS: {}'.format(num_answers))
+
     def run(self):
         """
         Displays the results of the search - a max of 5 matching posts are displayed per page. Allows the user to either
-        return to the main menu, navigate to the next page of matches and see up to the next 5 (if possible), or perform
-        an action on one of the displayed posts.
+        return to the main menu, navigate to the next page of matches and see up to the next 5 (if possible), moderate
+        several of the matches at once (privileged users only), or perform an action on one of the displayed posts.
+        Only the posts of the first page are hydrated up front - if there are more pages, each following page is
+        prefetched in the background (see prefetch.PagePrefetcher) while the user reads the current one.
         :return: a tuple corresponding to the data-fields of the selected post or 'done' if either no posts matched the
-                 keywords that were searched or if the user simply selected the return to main menu option
+                 search or if the user simply selected the return to main menu option
         """
-        if len(self.sorted_search_matches) == 0:
-            print('\nNo posts matched your search - please enter any key to return to the main menu:')
-            input('> ')
+        if len(self.ranked_matches) == 0:
+            renderer.print('\nNo posts matched your search - please enter any key to return to the main menu:')
+            renderer.prompt()
             return 'done'
-        num_matches = len(self.sorted_search_matches)
-        num_answers = 0
-        current_page = 0
-        for i in range(num_matches):
-            if len(self.sorted_search_matches[i]) == 7:
-                post_is_question = True
-                pid, pdate, title, body, poster, num_answers, num_votes = self.sorted_search_matches[i]
-            else:
-                post_is_question = False
-                pid, pdate, title, body, poster, num_votes = self.sorted_search_matches[i]
-            print('\n\t[{}] {}\n'
-                  '\t\t{}\n'
-                  '\t\tID: {}\tDATE: {}\tPOSTER: {}\tVOTES: {}'
-                  .format(i + 1, title, body, pid, pdate, poster, num_votes))
-            if post_is_question:
-                print('\t\tANSWERS: {}'.format(num_answers))
-            if (((i + 1) % 5 == 0) and (i != 0)) or (i == num_matches - 1):
-                action = self._post_action_prompt(current_page, num_matches, i + 1)
+        posts = self.db_manager.hydrate_posts(self.ranked_matches[:self.page_size])
+        num_pages = (len(self.ranked_matches) + self.page_size - 1) // self.page_size
+        # A single page of results has nothing to prefetch, so no thread (or connection) is started for it
+        prefetcher = None
+        if num_pages > 1:
+            prefetcher = PagePrefetcher(self.db_manager.clone, self.ranked_matches, self.page_size)
+        try:
+            current_page = 0
+            while True:
+                if prefetcher is not None:
+                    prefetcher.prefetch(current_page + 1)
+                first = current_page * self.page_size
+                for i in range(len(posts)):
+                    self._print_post(first + i + 1, posts[i])
+                action = self._post_action_prompt(first, len(posts), current_page + 1 < num_pages)
                 if action == 'main menu':
                     return 'done'
+                elif action == 'moderate':
+                    self._moderate()
+                    return 'done'
                 elif action == 'next page':
-                    clear_screen()
-                    print('SEARCH RESULTS')
                     current_page += 1
+                    posts = prefetcher.get_page(current_page)
+                    if posts is None:
+                        first = current_page * self.page_size
+                        posts = self.db_manager.hydrate_posts(self.ranked_matches[first:first + self.page_size])
+                    clear_screen()
+                    renderer.print('SEARCH RESULTS')
                 else:
-                    return self.sorted_search_matches[int(action) - 1]
+                    return posts[int(action) - first - 1]
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+
+
+class ThreadScreen(BaseScreen):
+    """
+    Class representing the thread screen.
+    """
+
+    def __init__(self, db_manager, qid):
+        """
+        Initializes an instance of this class.
+        :param db_manager: sqlite database manager
+        :param qid: the pid of the question whose thread is to be displayed
+        """
+        self.qid = qid
+        self.page_size = 5
+        self.question = None
+        self.answers = None
+        BaseScreen.__init__(self, db_manager=db_manager)
+
+    def _setup(self):
+        """
+        Loads the question along with the first page of its answers and prints the question.
+        """
+        self.question, self.answers = self.db_manager.get_thread(self.qid, 0, self.page_size)
+        self._print_question()
+
+    def _print_question(self):
+        """
+        Prints the screen title and the details of the question.
+        """
+        pid, pdate, title, body, poster, num_answers, num_votes, poster_reputation = self.question
+        renderer.print('THREAD')
+        renderer.print('\n{}\n'
+                       '\t{}\n'
+                       '\tID: {}\tDATE: {}\tPOSTER: {} (REPUTATION: {})\tVOTES: {}\n'
+                       '\tANSWERS: {}'
+                       .format(title, body, pid, pdate, poster, poster_reputation, num_votes, num_answers))
+
+    def run(self):
+        """
+        Displays the answers to the question - a max of 5 answers are displayed per page with the accepted answer
+        first. Allows the user to either return to the main menu, navigate to the next page of answers (if possible),
+        or perform an action on one of the displayed answers.
+        :return: a tuple corresponding to the data-fields of the selected answer or 'done' if the user selected the
+                 return to main menu option
+        """
+        num_answers = self.question[5]
+        current_page = 0
+        while True:
+            first = current_page * self.page_size
+            for i in range(len(self.answers)):
+                pid, pdate, title, body, poster, num_votes, poster_reputation, is_accepted = self.answers[i]
+                renderer.print('\n\t[{}] {}{}\n'
+                               '\t\t{}\n'
+                               '\t\tID: {}\tDATE: {}\tPOSTER: {} (REPUTATION: {})\tVOTES: {}'
+                               .format(first + i + 1, title, ' (ACCEPTED ANSWER)' if is_accepted else '', body, pid,
+                                       pdate, poster, poster_reputation, num_votes))
+            valid_inputs = [str(first + i + 1) for i in range(len(self.answers))] + ['a']
+            renderer.print('\nPlease select the action that you would like to take:\n'
+                           '\t[a] Return to the main menu')
+            if first + len(self.answers) < num_answers:
+                valid_inputs += ['b']
+                renderer.print('\t[b] See more answers')
+            if len(self.answers) > 0:
+                renderer.print('\t[#] Enter the number corresponding to the answer that you would like to perform an '
+                               'action on')
+            selection = select_from_menu(valid_inputs)
+            if selection == 'a':
+                return 'done'
+            elif selection == 'b':
+                current_page += 1
+                self.question, self.answers = self.db_manager.get_thread(self.qid, current_page, self.page_size)
+                clear_screen()
+                self._print_question()
+            else:
+                # Answers are passed on without the is_accepted flag so they have the same fields as search results
+                return self.answers[int(selection) - first - 1][:7]
 
 
 class PostActionScreen(BaseScreen):
@@ -400,65 +750,80 @@ class PostActionScreen(BaseScreen):
         :param current_uid: the uid of the user that is currently logged in
         :param post: a tuple corresponding to the data-fields of the selected post
         """
-        if len(post) == 7:
+        if len(post) == 8:
             # Means its a question
             self.post_is_question = True
-            self.pid, self.pdate, self.title, self.body, self.poster, self.num_answers, self.num_votes = post
+            (self.pid, self.pdate, self.title, self.body, self.poster, self.num_answers, self.num_votes,
+             self.poster_reputation) = post
         else:
             self.post_is_question = False
             self.num_answers = None
-            self.pid, self.pdate, self.title, self.body, self.poster, self.num_votes = post
+            self.pid, self.pdate, self.title, self.body, self.poster, self.num_votes, self.poster_reputation = post
         BaseScreen.__init__(self, db_manager=db_manager, current_uid=current_uid)
 
     def _setup(self):
         """
         Prints the details of the selected post
         """
-        print('POST ACTION')
-        print('\n{}\n'
-              '\t{}\n'
-              '\tID: {}\tDATE: {}\tPOSTER: {}\tVOTES: {}'
-              .format(self.title, self.body, self.pid, self.pdate, self.poster, self.num_votes))
+        renderer.print('POST ACTION')
+        # Search results only hold the preview of a compressed body
+        body = self.db_manager.get_post_body(self.pid)
+        if body is not None:
+            self.body = body
+        renderer.print('\n{}\n'
+                       '\t{}\n'
+                       '\tID: {}\tDATE: {}\tPOSTER: {} (REPUTATION: {})\tVOTES: {}'
+                       .format(self.title, self.body, self.pid, self.pdate, self.poster, self.poster_reputation,
+                               self.num_votes))
         if self.post_is_question:
-            print('\tANSWERS: {}'.format(self.num_answers))
+            renderer.print('\tANSWERS: {}'.format(self.num_answers))
 
     def _display_options(self):
         """
         Displays a list of actions that the user can take based on a number of factors. The actions are as
-        follows... Post an answer: available when the selected post is a question and to all users. Vote for a post:
+        follows... Post an answer: available when the selected post is a question and to all users. View the answers:
+        available when the selected post is a question that has at least one answer and to all users. Vote for a post:
         available when the user has not already voted on the selected post and to all users. Mark as accepted: only
         available to privileged users when the selected post is an answer. Give a badge to the poster: only available to
         privileged users when the poster has not already been given a badge on the current day. Add tags to the post:
-        only available to privileged users. Edit title and/or body of post: only available to privileged users.
+        only available to privileged users. Edit title and/or body of post: only available to privileged users. No
+        actions are available on archived posts.
         :return: a dictionary mapping the number to enter to trigger the corresponding action
         """
+        if self.db_manager.post_is_archived(self.pid):
+            renderer.print('\nThis post has been archived - archived posts are read-only.')
+            return {}
         privileged = self.db_manager.check_privilege(self.current_user)
         user_can_vote = self.db_manager.get_vote_eligibility(self.current_user, self.pid)
         poster_can_be_given_badge = self.db_manager.check_badge_eligibility(self.poster)
         choices = {}
         action_num = 1
-        print('\nPlease select the action you would like to take:')
+        renderer.print('\nPlease select the action you would like to take:')
         if self.post_is_question:
-            print('\t[{}] Post an answer'.format(action_num))
+            renderer.print('\t[{}] Post an answer'.format(action_num))
             choices[str(action_num)] = 'post answer'
             action_num += 1
+            if self.num_answers > 0:
+                renderer.print('\t[{}] View the answers'.format(action_num))
+                choices[str(action_num)] = 'view thread'
+                action_num += 1
         if user_can_vote:
-            print('\t[{}] Vote on the post'.format(action_num))
+            renderer.print('\t[{}] Vote on the post'.format(action_num))
             choices[str(action_num)] = 'add vote'
             action_num += 1
         if privileged:
             if not self.post_is_question:
-                print('\t[{}] Mark as the accepted answer'.format(action_num))
+                renderer.print('\t[{}] Mark as the accepted answer'.format(action_num))
                 choices[str(action_num)] = 'mark accepted'
                 action_num += 1
             if poster_can_be_given_badge:
-                print('\t[{}] Give a badge'.format(action_num))
+                renderer.print('\t[{}] Give a badge'.format(action_num))
                 choices[str(action_num)] = 'give badge'
                 action_num += 1
-            print('\t[{}] Add a tag'.format(action_num))
+            renderer.print('\t[{}] Add a tag'.format(action_num))
             choices[str(action_num)] = 'add tag'
             action_num += 1
-            print('\t[{}] Edit post'.format(action_num))
+            renderer.print('\t[{}] Edit post'.format(action_num))
             choices[str(action_num)] = 'edit'
         return choices
 
@@ -467,10 +832,10 @@ class PostActionScreen(BaseScreen):
         Prompts the user to enter the title and body texts of the answer they want to add.
         :return: tuple consisting of the title and body fields of the answer that they want to add
         """
-        print('\nPlease enter the title of your answer:')
-        answer_title = input('> ')
-        print('\nPlease enter the body of your answer:')
-        answer_body = input('> ')
+        renderer.print('\nPlease enter the title of your answer:')
+        answer_title = renderer.prompt()
+        renderer.print('\nPlease enter the body of your answer:')
+        answer_body = renderer.prompt()
         return answer_title, answer_body
 
     def _post_answer(self):
@@ -482,18 +847,18 @@ class PostActionScreen(BaseScreen):
         valid_inputs = ['Y', 'y', 'E', 'e', 'N', 'n']
         while True:
             answer_title, answer_body = self._get_new_answer_data()
-            print('\nAnswer Summary\nTitle: {}\nBody: {}\n'.format(answer_title, answer_body))
-            print('Please select one of the following actions:\n'
-                  '\t[Y/y] To confirm and post the answer above\n'
-                  '\t[E/e] To re-enter the answer title and body\n'
-                  '\t[N/n] To return to the main menu')
+            renderer.print('\nAnswer Summary\nTitle: {}\nBody: {}\n'.format(answer_title, answer_body))
+            renderer.print('Please select one of the following actions:\n'
+                           '\t[Y/y] To confirm and post the answer above\n'
+                           '\t[E/e] To re-enter the answer title and body\n'
+                           '\t[N/n] To return to the main menu')
             selection = select_from_menu(valid_inputs)
             if selection.lower() == 'y':
                 self.db_manager.new_post(answer_title, answer_body, self.current_user, True, self.pid)
                 clear_screen()
-                print('POST ACTION')
-                print('\nAnswer posted successfully - please enter any key to return to the main menu:')
-                input('> ')
+                renderer.print('POST ACTION')
+                renderer.print('\nAnswer posted successfully - please enter any key to return to the main menu:')
+                renderer.prompt()
                 break
             elif selection.lower() == 'n':
                 break
@@ -504,9 +869,9 @@ class PostActionScreen(BaseScreen):
         """
         self.db_manager.add_vote(self.pid, self.current_user)
         clear_screen()
-        print('POST ACTION')
-        print('\nA vote has been added to the post - please enter any key to return to the main menu:')
-        input('> ')
+        renderer.print('POST ACTION')
+        renderer.print('\nA vote has been added to the post - please enter any key to return to the main menu:')
+        renderer.prompt()
 
     def _mark_as_accepted(self):
         """
@@ -517,114 +882,95 @@ class PostActionScreen(BaseScreen):
         accepted_answer_exists = self.db_manager.check_for_accepted_answer(self.pid)
         if accepted_answer_exists:
             valid_inputs = ['Y', 'y', 'N', 'n']
-            print('\nThe question linked to this answer already has an accepted answer - would you like to change it?\n'
-                  '\t[Y/y] To change the accepted answer to this one\n'
-                  '\t[N/n] To leave the accepted answer unchanged and return to the main menu')
+            renderer.print('\nThe question linked to this answer already has an accepted answer - would you like to '
+                           'change it?\n'
+                           '\t[Y/y] To change the accepted answer to this one\n'
+                           '\t[N/n] To leave the accepted answer unchanged and return to the main menu')
             selection = select_from_menu(valid_inputs)
             if selection.lower() == 'n':
                 return
         self.db_manager.update_accepted_answer(self.pid)
         clear_screen()
-        print('POST ACTION')
-        print('\n{} has been marked as the accepted answer - please enter any key to return to the main menu:'
-              .format(self.pid))
-        input('> ')
+        renderer.print('POST ACTION')
+        renderer.print('\n{} has been marked as the accepted answer - please enter any key to return to the main menu:'
+                       .format(self.pid))
+        renderer.prompt()
 
     def _give_badge(self):
         """
         Allows the user to give a badge to the poster of the selected post by providing a badge name.
         """
-        bnames = self.db_manager.get_existing_badges()
-        print('\nThe names of the badges that currently exist are:')
-        for i in range(len(bnames)):
-            bnames[i] = bnames[i].lower()
-            print('\t- {}'.format(bnames[i]))
-        print('\nPlease enter the name of the badge that you would like to give to {}:'.format(self.poster))
-        badge_to_give = input('> ')
-        while badge_to_give.lower() not in bnames:
-            print('"{}" is an invalid selection, please enter a valid selection from the menu above.'
-                  .format(badge_to_give))
-            badge_to_give = input('> ')
+        badge_to_give = select_badge(self.db_manager, self.poster)
         self.db_manager.give_badge(badge_to_give, self.poster)
         clear_screen()
-        print('POST ACTION')
-        print('\n{} has successfully been given the badge - please enter any key to return to the main menu:'
-              .format(self.poster, badge_to_give))
-        input('> ')
+        renderer.print('POST ACTION')
+        renderer.print('\n{} has successfully been given the badge - please enter any key to return to the main menu:'
+                       .format(self.poster, badge_to_give))
+        renderer.prompt()
 
     def _add_tag(self):
         """
         Allows the user to add a tag to the post. Confirms that an identical tag has not already been added to the post.
         """
-        print('\nPlease enter the name of the tag that you would like to add to {}:'.format(self.pid))
-        tag_name = input('> ')
+        renderer.print('\nPlease enter the name of the tag that you would like to add to {}:'.format(self.pid))
+        tag_name = renderer.prompt()
         success = self.db_manager.add_tag_to_post(self.pid, tag_name)
         clear_screen()
-        print('POST ACTION')
+        renderer.print('POST ACTION')
         if success:
-            print('\nSuccessfully added tag "{}" to {} - please enter any key to return to the main menu:'
-                  .format(tag_name, self.pid))
+            renderer.print('\nSuccessfully added tag "{}" to {} - please enter any key to return to the main menu:'
+                           .format(tag_name, self.pid))
         else:
-            print('\nUnable to add tag "{}" to {} as it already exists - '
-                  'please enter any key to return to the main menu:'.format(tag_name, self.pid))
-        input('> ')
+            renderer.print('\nUnable to add tag "{}" to {} as it already exists - '
+                           'please enter any key to return to the main menu:'.format(tag_name, self.pid))
+        renderer.prompt()
 
     def _edit_post(self):
         """
         Allows the user to edit the title and/or the body of the post. Other fields are not updated when the selected
         post is edited.
         """
-        valid_inputs = ['1', '2', '3']
-        print('\nPlease select one of the following actions:\n'
-              '\t[1] Edit the title of the post\n'
-              '\t[2] Edit the body of the post\n'
-              '\t[3] Edit the title and the body of the post')
-        selection = select_from_menu(valid_inputs)
+        new_title, new_body = get_post_edit()
+        self.db_manager.update_post(self.pid, new_title=new_title, new_body=new_body)
         msg = '\n'
-        if selection == '2':
-            print('\nPlease enter the new body for the post:')
-            new_body = input('> ')
-            self.db_manager.update_post(self.pid, new_body=new_body)
+        if new_title is None:
             msg += 'Successfully updated the body of post {} - please enter any key to return to the main menu:'
-        elif selection == '1':
-            print('\nPlease enter the new title for the post:')
-            new_title = input('> ')
-            self.db_manager.update_post(self.pid, new_title=new_title)
+        elif new_body is None:
             msg += 'Successfully updated the title of post {} - please enter any key to return to the main menu:'
         else:
-            print('\nPlease enter the new title for the post:')
-            new_title = input('> ')
-            print('\nPlease enter the new body for the post:')
-            new_body = input('> ')
-            self.db_manager.update_post(self.pid, new_title=new_title, new_body=new_body)
             msg += 'Successfully updated the title and body of post {} - ' \
                    'please enter any key to return to the main menu:'
         clear_screen()
-        print('POST ACTION')
-        print(msg.format(self.pid))
-        input('> ')
+        renderer.print('POST ACTION')
+        renderer.print(msg.format(self.pid))
+        renderer.prompt()
 
     def run(self):
         """
         Displays a list of actions that the user can take based on a number of factors then carries out the selected
         action. The actions are as follows... Post an answer: available when the selected post is a question and to all
+        users. View the answers: available when the selected post is a question that has at least one answer and to all
         users. Vote for a post: available when the user has not already voted on the selected post and to all users.
         Mark as accepted: only available to privileged users when the selected post is an answer. Give a badge to the
         poster: only available to privileged users when the poster has not already been given a badge on the current
         day. Add tags to the post: only available to privileged users. Edit title and/or body of post: only available to
-        privileged users. After an action has been completed the user is directed back to the main menu.
+        privileged users. After an action has been completed the user is directed back to the main menu, unless they
+        chose to view the answers in which case they are directed to the thread screen.
+        :return: 'view thread' if the user chose to view the answers to the question, None otherwise
         """
         choices = self._display_options()
         if len(choices) == 0:
-            print('\t[ ] Return to main menu (you are not eligible to perform any actions on this post at this time) '
-                  '- press any key to return')
-            input('> ')
+            renderer.print('\t[ ] Return to main menu (you are not eligible to perform any actions on this post at '
+                           'this time) - press any key to return')
+            renderer.prompt()
             return
         valid_inputs = list(choices.keys())
         selection = select_from_menu(valid_inputs)
         action = choices[selection]
         if action == 'post answer':
             self._post_answer()
+        elif action == 'view thread':
+            return 'view thread'
         elif action == 'add vote':
             self._add_vote()
         elif action == 'mark accepted':
@@ -0,0 +1,524 @@
+import itertools
+import sys
+import time
+from collections import Counter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from body_store import full_body_sql
+from changelog import Changelog, ChangelogCompactedError
+from search_query import And, Not, Or, ascii_lower
+
+
+def _ascii_lower(text):
+    """
+    :return: text case-folded by search_query.ascii_lower, as the keywords searched for are ('' if text is None)
+    """
+    return '' if text is None else ascii_lower(text)
+
+
+def _date_key(pdate):
+    """
+    :return: the date pdate (YYYY-MM-DD) as the integer YYYYMMDD so that dates can be compared in arrays (0 if pdate is
+             not such a date)
+    """
+    try:
+        return int(pdate[:10].replace('-', ''))
+    except (TypeError, ValueError):
+        return 0
+
+
+class _Postings:
+    """
+    Class holding the postings of one field of the posts - for each distinct token, the array of the ids of the
+    documents that contain it. Postings are stored in two numpy arrays (the document ids of all of the tokens one after
+    the other and the offset of each token's postings) with the postings added since they were last compacted kept in
+    lists until there are enough of them to be worth merging in.
+    """
+
+    def __init__(self):
+        self.token_ids = {}
+        self.tokens = []
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.docs = np.zeros(0, dtype=np.int32)
+        self._delta = {}
+        self._delta_size = 0
+        self._vocabulary = None
+        self._containing = {}
+
+    def _token_id(self, token):
+        """
+        :return: the id of token, which is added to the vocabulary if it is not already in it
+        """
+        token_id = self.token_ids.get(token)
+        if token_id is None:
+            token_id = len(self.tokens)
+            self.token_ids[token] = token_id
+            self.tokens.append(token)
+            self._vocabulary = None
+            self._containing = {}
+        return token_id
+
+    def add(self, doc, tokens):
+        """
+        Adds doc to the postings of each of tokens.
+        :param doc: id of the document
+        :param tokens: set of the tokens that the document contains
+        """
+        for token in tokens:
+            self._delta.setdefault(self._token_id(token), []).append(doc)
+            self._delta_size += 1
+        if self._delta_size > max(4096, len(self.docs) // 8):
+            self.compact()
+
+    def add_many(self, docs, token_sets):
+        """
+        Adds many documents at once (e.g. when building an index) and then compacts the postings.
+        :param docs: list of the ids of the documents
+        :param token_sets: list of the sets of the tokens that each of the documents contains
+        """
+        tokens = list(itertools.chain.from_iterable(token_sets))
+        new_tokens = set(tokens).difference(self.token_ids)
+        if len(new_tokens) > 0:
+            self.token_ids.update(zip(new_tokens, itertools.count(len(self.tokens))))
+            self.tokens.extend(new_tokens)
+            self._vocabulary = None
+            self._containing = {}
+        new_token_ids = np.fromiter(map(self.token_ids.__getitem__, tokens), dtype=np.int32, count=len(tokens))
+        counts = np.fromiter((len(tokens) for tokens in token_sets), dtype=np.int64, count=len(token_sets))
+        self.compact(new_token_ids, np.repeat(np.asarray(docs, dtype=np.int32), counts))
+
+    def compact(self, new_token_ids=None, new_docs=None):
+        """
+        Merges the postings added since the last compaction into the arrays.
+        :param new_token_ids: array of the token ids of further postings to merge in (optional parameter)
+        :param new_docs: array of the document ids of further postings to merge in (optional parameter)
+        """
+        if new_token_ids is None:
+            new_token_ids = np.zeros(0, dtype=np.int32)
+            new_docs = np.zeros(0, dtype=np.int32)
+        if self._delta_size == 0 and len(new_docs) == 0:
+            return
+        base_token_ids = np.repeat(np.arange(len(self.offsets) - 1, dtype=np.int32), np.diff(self.offsets))
+        delta_token_ids = np.fromiter((token_id for token_id, docs in self._delta.items() for _ in docs),
+                                      dtype=np.int32, count=self._delta_size)
+        delta_docs = np.fromiter((doc for docs in self._delta.values() for doc in docs), dtype=np.int32,
+                                 count=self._delta_size)
+        token_ids = np.concatenate((base_token_ids, delta_token_ids, new_token_ids))
+        order = np.argsort(token_ids, kind='stable')
+        self.docs = np.concatenate((self.docs, delta_docs, new_docs))[order]
+        self.offsets = np.zeros(len(self.tokens) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(token_ids, minlength=len(self.tokens)), out=self.offsets[1:])
+        self._delta = {}
+        self._delta_size = 0
+
+    def exact(self, token):
+        """
+        :return: list of the id of token (empty if no document contains token)
+        """
+        token_id = self.token_ids.get(token)
+        return [] if token_id is None else [token_id]
+
+    def containing(self, text):
+        """
+        Finds the tokens that contain text using a vectorized search of the vocabulary. The result is cached until a
+        new token is added.
+        :return: array of the ids of the tokens that contain text
+        """
+        token_ids = self._containing.get(text)
+        if token_ids is None:
+            if self._vocabulary is None:
+                # Variable width strings (numpy 2) keep a single long token from inflating the whole vocabulary
+                if hasattr(np, 'strings'):
+                    self._vocabulary = np.array(self.tokens, dtype=np.dtypes.StringDType())
+                else:
+                    self._vocabulary = np.array(self.tokens, dtype=str)
+            find = np.strings.find if hasattr(np, 'strings') else np.char.find
+            token_ids = np.flatnonzero(find(self._vocabulary, text) >= 0) if len(self.tokens) > 0 else []
+            self._containing[text] = token_ids
+        return token_ids
+
+    def lookup(self, token_ids):
+        """
+        :return: array of the ids of the documents containing at least one of the tokens identified by token_ids (a
+                 document may appear more than once)
+        """
+        num_compacted = len(self.offsets) - 1
+        parts = [self.docs[self.offsets[token_id]:self.offsets[token_id + 1]] for token_id in token_ids
+                 if token_id < num_compacted]
+        parts += [np.array(self._delta[token_id], dtype=np.int32) for token_id in token_ids if token_id in self._delta]
+        if len(parts) == 0:
+            return np.zeros(0, dtype=np.int32)
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def memory_usage(self):
+        """
+        :return: tuple consisting of the approximate number of bytes used by the postings and by the vocabulary
+        """
+        postings = self.offsets.nbytes + self.docs.nbytes + sys.getsizeof(self._delta) + \
+            sum(sys.getsizeof(docs) for docs in self._delta.values()) + 28 * self._delta_size
+        vocabulary = sys.getsizeof(self.token_ids) + sys.getsizeof(self.tokens) + \
+            sum(sys.getsizeof(token) for token in self.tokens)
+        if self._vocabulary is not None:
+            vocabulary += self._vocabulary.nbytes
+        return postings, vocabulary
+
+
+class SearchIndex:
+    """
+    Class representing a RAM-resident snapshot of the posts of the main database that searches are evaluated against
+    instead of the database. Each post is given an integer document id; the tokens of the titles, bodies, tags, and
+    posters of the posts are held in postings arrays and the dates, vote counts, and answer counts of the posts in
+    arrays indexed by document id, so that a search is evaluated with vectorized array operations. Keyword matches have
+    the same semantics as the sql search (a keyword matches a post if it occurs anywhere in its title, body, or tags).
+
+    The snapshot is refreshed before each search by reading the changes logged in the changelog since the last refresh
+    (see changelog.Changelog) and the current rows of the posts that they affect. An edited post is given a new document
+    id. Posts that have been deleted (i.e. archived) cause the snapshot to be rebuilt.
+    """
+
+    # The tables whose changes affect the snapshot
+    TRACKED_TABLES = ('posts', 'questions', 'answers', 'votes', 'tags')
+
+    def __init__(self, connection):
+        """
+        Initializes an instance of this class and builds the snapshot.
+        :param connection: connection to the database - it must only be used by the thread that uses the index
+        """
+        if np is None:
+            raise ImportError('the search index requires numpy - please install it (pip install numpy)')
+        self.connection = connection
+        self.changelog = Changelog(connection)
+        self.build_seconds = 0
+        self.build()
+
+    def build(self):
+        """
+        Builds the snapshot from scratch. The rows of each table are loaded in bulk.
+        """
+        start = time.perf_counter()
+        tables = self._read_tables()
+        self.pids, self.pdates, self.titles, self.bodies, self.posters = \
+            (list(column) for column in zip(*tables['posts'])) if len(tables['posts']) > 0 else ([],) * 5
+        size = self.size = len(self.pids)
+        self.num_dead = 0
+        self.tags = [[] for _ in range(size)]
+        self.doc_of = dict(zip(self.pids, range(size)))
+        capacity = max(1024, size)
+        self.date_keys = np.array([_date_key(pdate) for pdate in self.pdates] + [0] * (capacity - size), dtype=np.int32)
+        self.num_votes = np.zeros(capacity, dtype=np.int32)
+        self.num_answers = np.zeros(capacity, dtype=np.int32)
+        # 1 for questions, 2 for answers, and 0 for posts that are neither (which are not shown in search results)
+        self.kinds = np.zeros(capacity, dtype=np.int8)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.alive[:size] = True
+
+        def docs_of(pids):
+            return np.array([self.doc_of[pid] for pid in pids if pid in self.doc_of], dtype=np.int64)
+
+        self.kinds[docs_of(pid for pid, in tables['questions'])] = 1
+        self.kinds[docs_of(pid for pid, _ in tables['answers'])] = 2
+        self.num_answers[:size] += np.bincount(docs_of(qid for _, qid in tables['answers']), minlength=size)
+        self.num_votes[:size] += np.bincount(docs_of(pid for pid, in tables['votes']), minlength=size)
+        tagged_docs = []
+        for pid, tag in tables['tags']:
+            if pid in self.doc_of:
+                tagged_docs.append(self.doc_of[pid])
+                self.tags[tagged_docs[-1]].append(tag)
+        self.postings = dict((field, _Postings()) for field in ('title', 'body', 'tag', 'poster'))
+        self.postings['title'].add_many(range(size), [set(_ascii_lower(title).split()) for title in self.titles])
+        self.postings['body'].add_many(range(size), [set(_ascii_lower(body).split()) for body in self.bodies])
+        self.postings['tag'].add_many(tagged_docs, [{_ascii_lower(tag)} for pid, tag in tables['tags']
+                                                    if pid in self.doc_of])
+        # Posts without a poster are never matched by a poster filter, as in the database
+        self.postings['poster'].add_many(range(size), [set() if poster is None else {_ascii_lower(poster)}
+                                                       for poster in self.posters])
+        self.build_seconds = time.perf_counter() - start
+
+    def _ensure_capacity(self, size):
+        """
+        Grows the arrays (by doubling them) so that they can hold size documents.
+        """
+        capacity = len(self.alive)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        for name in ('date_keys', 'num_votes', 'num_answers', 'kinds', 'alive'):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def _add_document(self, pid, pdate, title, body, poster, tags=(), kind=0, num_votes=0, num_answers=0):
+        """
+        Adds a post to the snapshot under a new document id.
+        :return: the document id of the post
+        """
+        doc = self.size
+        self._ensure_capacity(doc + 1)
+        self.size += 1
+        self.pids.append(pid)
+        self.pdates.append(pdate)
+        self.titles.append(title)
+        self.bodies.append(body)
+        self.posters.append(poster)
+        self.tags.append(list(tags))
+        self.doc_of[pid] = doc
+        self.date_keys[doc] = _date_key(pdate)
+        self.kinds[doc] = kind
+        self.num_votes[doc] = num_votes
+        self.num_answers[doc] = num_answers
+        self.alive[doc] = True
+        self.postings['title'].add(doc, set(_ascii_lower(title).split()))
+        self.postings['body'].add(doc, set(_ascii_lower(body).split()))
+        self.postings['tag'].add(doc, set(_ascii_lower(tag) for tag in tags))
+        self.postings['poster'].add(doc, set() if poster is None else {_ascii_lower(poster)})
+        return doc
+
+    def _read_tables(self):
+        """
+        Reads the rows of each tracked table, along with the sequence number of the last logged change (which becomes
+        the cursor of the snapshot), in a single read transaction. Compressed bodies are read decompressed.
+        :return: dictionary mapping each tracked table to its rows
+        """
+        columns = {'posts': 'pid, pdate, title, ' + full_body_sql('posts') + ', poster', 'questions': 'pid',
+                   'answers': 'pid, qid', 'votes': 'pid', 'tags': 'pid, tag'}
+        tables = {}
+        cursor = self.connection.cursor()
+        own_transaction = not self.connection.in_transaction
+        if own_transaction:
+            cursor.execute('begin;')
+        try:
+            self.changelog_cursor = self.changelog.latest_seq()
+            for table in self.TRACKED_TABLES:
+                # Posts are read in the order they were added so that document ids follow it
+                order = ' order by rowid' if table == 'posts' else ''
+                tables[table] = cursor.execute('select ' + columns[table] + ' from ' + table + order + ';').fetchall()
+        finally:
+            if own_transaction:
+                cursor.execute('commit;')
+        return tables
+
+    def _read_changes(self):
+        """
+        Reads the changes to the tracked tables logged since the last refresh and the current rows that they affect, in
+        a single read transaction. The cursor of the snapshot is advanced.
+        :return: dictionary mapping 'posts' to the rows of the added posts, 'edited' to a dictionary mapping the pid of
+                 each edited post to its current (pdate, title, body, poster), 'questions' and 'answers' to the pids
+                 (and qids) of the added questions and answers, 'votes' to a Counter of the pids of the posts voted on,
+                 and 'tags' to a dictionary mapping the pid of each post that was tagged to its current tags - or None
+                 if rows have been deleted or changes have been compacted before they were read (in which case the
+                 snapshot must be rebuilt)
+        """
+        cursor = self.connection.cursor()
+        own_transaction = not self.connection.in_transaction
+        if own_transaction:
+            cursor.execute('begin;')
+        try:
+            try:
+                log = self.changelog.read(self.changelog_cursor, tables=self.TRACKED_TABLES)
+            except ChangelogCompactedError:
+                return None
+            if any(change.op == 'delete' for change in log):
+                return None
+            if len(log) > 0:
+                self.changelog_cursor = log[-1].seq
+            keys = dict((table, []) for table in self.TRACKED_TABLES)
+            edited = set()
+            for change in log:
+                if change.op == 'insert':
+                    keys[change.table].append(change.key)
+                elif change.table == 'posts':
+                    edited.add(change.key)
+            post = 'select pid, pdate, title, ' + full_body_sql('posts') + ', poster from posts where pid=:pid;'
+            changes = {
+                'posts': [cursor.execute(post, {'pid': pid}).fetchone() for pid in keys['posts']],
+                'edited': {},
+                'questions': keys['questions'],
+                'answers': [cursor.execute('select pid, qid from answers where pid=:pid;', {'pid': pid}).fetchone()
+                            for pid in keys['answers']],
+                'votes': Counter(keys['votes']),
+                'tags': {}
+            }
+            # Posts added since the last refresh are read as they are now
+            for pid in edited.difference(keys['posts']):
+                changes['edited'][pid] = cursor.execute(post, {'pid': pid}).fetchone()[1:]
+            for pid in set(keys['tags']):
+                changes['tags'][pid] = [tag for tag, in cursor.execute('select tag from tags where pid=:pid;',
+                                                                       {'pid': pid}).fetchall()]
+        finally:
+            if own_transaction:
+                cursor.execute('commit;')
+        return changes
+
+    def _refresh(self):
+        """
+        Applies the changes made since the last refresh.
+        :return: boolean value corresponding to whether the snapshot must be rebuilt instead (e.g. posts were deleted)
+        """
+        changes = self._read_changes()
+        if changes is None:
+            return True
+        for pid, pdate, title, body, poster in changes['posts']:
+            self._add_document(pid, pdate, title, body, poster)
+        for pid in changes['questions']:
+            if pid in self.doc_of:
+                self.kinds[self.doc_of[pid]] = 1
+        for pid, qid in changes['answers']:
+            if pid in self.doc_of:
+                self.kinds[self.doc_of[pid]] = 2
+            if qid in self.doc_of:
+                self.num_answers[self.doc_of[qid]] += 1
+        for pid, num_votes in changes['votes'].items():
+            if pid in self.doc_of:
+                self.num_votes[self.doc_of[pid]] += num_votes
+        for pid, tags in changes['tags'].items():
+            if pid in self.doc_of:
+                doc = self.doc_of[pid]
+                new_tags = Counter(tags) - Counter(self.tags[doc])
+                self.tags[doc].extend(new_tags.elements())
+                self.postings['tag'].add(doc, set(_ascii_lower(tag) for tag in new_tags))
+        for pid, row in changes['edited'].items():
+            old = self.doc_of.get(pid)
+            if old is None:
+                continue
+            self.alive[old] = False
+            self.num_dead += 1
+            self._add_document(pid, *row, tags=self.tags[old], kind=self.kinds[old], num_votes=self.num_votes[old],
+                               num_answers=self.num_answers[old])
+        return False
+
+    def refresh(self):
+        """
+        Brings the snapshot up to date with the database. The snapshot is rebuilt if posts have been deleted or if most
+        of its documents are old versions of edited posts.
+        """
+        if self._refresh() or self.num_dead > max(1024, self.size // 2):
+            self.build()
+
+    def _term_docs(self, term):
+        """
+        :return: array of the ids of the documents matching term (a document may appear more than once)
+        """
+        text = ascii_lower(term.text)
+        if term.field in ('tag', 'poster'):
+            postings = self.postings[term.field]
+            return postings.lookup(postings.exact(text))
+        fields = ['title', 'body', 'tag'] if term.field is None else [term.field]
+        parts = []
+        for field in fields:
+            postings = self.postings[field]
+            if not term.is_phrase or field == 'tag':
+                # Tags are indexed in their entirety so a phrase is found in the same way as a keyword
+                parts.append(postings.lookup(postings.containing(text)))
+                continue
+            # Every word of a phrase is part of a token of a matching post, which narrows down the posts whose text
+            # has to be checked for the phrase
+            candidates = None
+            for word in text.split():
+                docs = np.unique(postings.lookup(postings.containing(word)))
+                candidates = docs if candidates is None else np.intersect1d(candidates, docs, assume_unique=True)
+            texts = self.titles if field == 'title' else self.bodies
+            parts.append(np.array([doc for doc in candidates if text in _ascii_lower(texts[doc])], dtype=np.int32))
+        return np.concatenate(parts)
+
+    def rank(self, search_query, date_from=None, date_to=None, poster=None):
+        """
+        Evaluates search_query against the snapshot (after refreshing it) - see DBManager.rank_search.
+        :param search_query: the SearchQuery to evaluate
+        :param date_from: only posts posted on or after this date (YYYY-MM-DD) are matched (optional parameter)
+        :param date_to: only posts posted on or before this date (YYYY-MM-DD) are matched (optional parameter)
+        :param poster: only posts posted by the user with this uid (case-insensitive) are matched (optional parameter)
+        :return: a list of tuples (pid, # of terms matched, 'main') of the posts that match search_query, sorted by the
+                 number of terms matched and then by date in descending order
+        """
+        self.refresh()
+        size = self.size
+        masks = {}
+
+        def term_mask(term):
+            key = (ascii_lower(term.text), term.field)
+            if key not in masks:
+                mask = np.zeros(size, dtype=bool)
+                mask[self._term_docs(term)] = True
+                masks[key] = mask
+            return masks[key]
+
+        def evaluate(node):
+            if isinstance(node, Not):
+                return ~evaluate(node.child)
+            elif isinstance(node, And):
+                return np.logical_and.reduce([evaluate(child) for child in node.children])
+            elif isinstance(node, Or):
+                return np.logical_or.reduce([evaluate(child) for child in node.children])
+            return term_mask(node)
+
+        matched = self.alive[:size].copy()
+        if poster is not None:
+            poster_mask = np.zeros(size, dtype=bool)
+            poster_mask[self.postings['poster'].lookup(self.postings['poster'].exact(_ascii_lower(poster)))] = True
+            matched &= poster_mask
+        if date_from is not None:
+            matched &= self.date_keys[:size] >= _date_key(date_from)
+        if date_to is not None:
+            matched &= self.date_keys[:size] <= _date_key(date_to)
+        score = np.zeros(size, dtype=np.int32)
+        if search_query.root is not None:
+            matched &= evaluate(search_query.root)
+            for key in set((ascii_lower(term.text), term.field) for term in search_query.positive_terms()):
+                score += masks[key]
+        docs = np.flatnonzero(matched)
+        order = np.lexsort((-self.date_keys[docs], -score[docs]))
+        return [(self.pids[doc], int(score[doc]), 'main') for doc in docs[order]]
+
+    def hydrate(self, ranked_pids):
+        """
+        Gets the details of posts from the snapshot - see DBManager.hydrate_posts.
+        :param ranked_pids: list of tuples (pid, # of terms matched, schema) of posts of the main database
+        :return: list of the tuples corresponding to the data-fields of the posts that are questions or answers
+        """
+        posts = []
+        for ranked in ranked_pids:
+            doc = self.doc_of.get(ranked[0])
+            if doc is None or self.kinds[doc] == 0:
+                continue
+            post = (self.pids[doc], self.pdates[doc], self.titles[doc], self.bodies[doc], self.posters[doc])
+            if self.kinds[doc] == 1:
+                posts.append(post + (int(self.num_answers[doc]), int(self.num_votes[doc])))
+            else:
+                posts.append(post + (int(self.num_votes[doc]),))
+        return posts
+
+    def memory_usage(self):
+        """
+        Gets the approximate memory footprint of the snapshot.
+        :return: list of tuples (component, number of bytes)
+        """
+        arrays = sum(getattr(self, name).nbytes for name in ('date_keys', 'num_votes', 'num_answers', 'kinds', 'alive'))
+        postings = 0
+        vocabulary = 0
+        for field_postings in self.postings.values():
+            field_postings_bytes, field_vocabulary_bytes = field_postings.memory_usage()
+            postings += field_postings_bytes
+            vocabulary += field_vocabulary_bytes
+        documents = sys.getsizeof(self.doc_of)
+        for values in (self.pids, self.pdates, self.titles, self.bodies, self.posters, self.tags):
+            documents += sys.getsizeof(values) + sum(sys.getsizeof(value) for value in values)
+        return [('arrays', arrays), ('postings', postings), ('vocabulary', vocabulary), ('documents', documents)]
+
+    def report(self):
+        """
+        :return: string describing the size of the snapshot, how long it took to build, and its memory footprint
+        """
+        lines = ['search index: {} documents ({} live), {} distinct tokens, built in {:.3f}s'
+                 .format(self.size, self.size - self.num_dead,
+                         sum(len(postings.tokens) for postings in self.postings.values()), self.build_seconds)]
+        usage = self.memory_usage()
+        for component, num_bytes in usage:
+            lines.append('\t{:<12}{:>12,} bytes'.format(component, num_bytes))
+        lines.append('\t{:<12}{:>12,} bytes'.format('total', sum(num_bytes for _, num_bytes in usage)))
+        return '\n'.join(lines)
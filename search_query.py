@@ -0,0 +1,453 @@
+from body_store import index_terms, terms_filter_sql
+
+FIELDS = ('title', 'body', 'tag', 'poster')
+OPERATORS = ('AND', 'OR', 'NOT')
+OPTIONS = ('archive',)
+# Words that match nearly every post so searching for them only makes the results larger
+STOPWORDS = frozenset(['a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'can', 'do', 'for', 'from', 'has',
+                       'have', 'how', 'i', 'if', 'in', 'is', 'it', 'its', 'my', 'not', 'of', 'on', 'or', 'so', 'that',
+                       'the', 'their', 'there', 'this', 'to', 'was', 'what', 'when', 'where', 'which', 'who', 'why',
+                       'will', 'with', 'you', 'your'])
+# Suffixes removed by the stemmer, longest first
+SUFFIXES = ('ing', 'ed', 'es', 's')
+
+# Only ASCII letters are case-folded, as is done by sqlite's lower() function, like operator, and nocase collation
+_ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+
+class SearchQueryError(ValueError):
+    """
+    Raised when a search string can not be parsed into a search query.
+    """
+    pass
+
+
+class Term:
+    """
+    Class representing a single keyword or quoted phrase of a search query, optionally restricted to one field of a
+    post.
+    """
+
+    def __init__(self, text, field=None, is_phrase=False):
+        """
+        Initializes an instance of this class.
+        :param text: the keyword or phrase to match (matches are case-insensitive)
+        :param field: one of FIELDS to restrict the match to or None to match the title, body, or tags of a post
+        :param is_phrase: True if the term was entered as a quoted phrase
+        """
+        self.text = text
+        self.field = field
+        self.is_phrase = is_phrase
+
+    def __eq__(self, other):
+        return isinstance(other, Term) and (self.text, self.field) == (other.text, other.field)
+
+    def __hash__(self):
+        return hash((self.text, self.field))
+
+    def __str__(self):
+        text = '"{}"'.format(self.text) if self.is_phrase else self.text
+        return text if self.field is None else '{}:{}'.format(self.field, text)
+
+
+class Not:
+    """
+    Class representing the negation of part of a search query.
+    """
+
+    def __init__(self, child):
+        self.child = child
+
+    def __str__(self):
+        return 'NOT {}'.format(self.child)
+
+
+class And:
+    """
+    Class representing a part of a search query that matches posts matching all of its children.
+    """
+
+    def __init__(self, children):
+        self.children = children
+
+    def __str__(self):
+        return '(' + ' AND '.join(str(child) for child in self.children) + ')'
+
+
+class Or:
+    """
+    Class representing a part of a search query that matches posts matching at least one of its children.
+    """
+
+    def __init__(self, children):
+        self.children = children
+
+    def __str__(self):
+        return '(' + ' OR '.join(str(child) for child in self.children) + ')'
+
+
+class SearchQuery:
+    """
+    Class representing a parsed search query. Posts are ranked by the number of (non-negated) terms of the query that
+    they match.
+    """
+
+    def __init__(self, root, options=None):
+        """
+        Initializes an instance of this class.
+        :param root: the root node (Term, Not, And, or Or) of the query or None if the query has no terms
+        :param options: set of the options (the values of OPTIONS given using "in:") of the query
+        """
+        self.root = root
+        self.options = set() if options is None else options
+
+    def positive_terms(self):
+        """
+        Gets the terms of the query that are not negated - these are the terms that count towards the rank of a post.
+        :return: list of the Term instances of the query that are not beneath a Not node
+        """
+        terms = []
+        nodes = [] if self.root is None else [self.root]
+        while len(nodes) > 0:
+            node = nodes.pop()
+            if isinstance(node, Term):
+                terms.append(node)
+            elif isinstance(node, (And, Or)):
+                nodes.extend(reversed(node.children))
+        return terms
+
+    def to_sql(self, alias='p', schema='main'):
+        """
+        Compiles the query into sql expressions over the posts table (aliased by alias) so that the filtering and the
+        ranking of posts are both done by the database in a single query.
+        :param alias: the alias of the posts table in the query that the expressions are to be used in
+        :param schema: the schema of the database (i.e. 'main' or 'archive') that the posts table belongs to
+        :return: tuple consisting of the condition that a post must satisfy to match the query, the expression giving
+                 the number of terms that a post matches, and a dictionary of the named parameters used by both
+        """
+        params = {}
+        term_sql = {}
+
+        def compile_node(node):
+            if isinstance(node, Term):
+                if node not in term_sql:
+                    term_sql[node] = _compile_term(node, alias, schema, params)
+                return term_sql[node]
+            elif isinstance(node, Not):
+                return '(not ' + compile_node(node.child) + ')'
+            joiner = ' and ' if isinstance(node, And) else ' or '
+            return '(' + joiner.join(compile_node(child) for child in node.children) + ')'
+
+        if self.root is None:
+            return '1', '0', params
+        condition = compile_node(self.root)
+        matched = []
+        for term in self.positive_terms():
+            if term_sql[term] not in matched:
+                matched.append(term_sql[term])
+        score = '0' if len(matched) == 0 else ' + '.join(matched)
+        return condition, score, params
+
+    def __str__(self):
+        return '' if self.root is None else str(self.root)
+
+
+class SearchNormalizer:
+    """
+    Class normalizing the keywords of search queries before they are searched for, so that each search only runs the
+    matches it needs: keywords are case-folded, duplicate keywords are removed, stopwords and keywords shorter than
+    min_length are dropped, and keywords are optionally stemmed. Quoted phrases and tag: and poster: filters (which
+    must match in their entirety) are only case-folded and deduplicated.
+    """
+
+    def __init__(self, stopwords=STOPWORDS, min_length=2, stem=False):
+        """
+        Initializes an instance of this class.
+        :param stopwords: set of the (lower case) keywords to drop
+        :param min_length: keywords with fewer characters than this are dropped
+        :param stem: whether keywords should be reduced to their stems (e.g. indexing and indexes both to index) - as
+                     keywords are matched anywhere in a post this also matches the other forms of the word
+        """
+        self.stopwords = stopwords
+        self.min_length = min_length
+        self.stem = stem
+
+    def _stem(self, text):
+        """
+        Removes the first suffix of SUFFIXES that text ends with, as long as at least 3 characters are left.
+        :param text: the (lower case) keyword to stem
+        :return: the stem of text
+        """
+        for suffix in SUFFIXES:
+            if text.endswith(suffix) and len(text) - len(suffix) >= 3:
+                return text[:-len(suffix)]
+        return text
+
+    def normalize(self, search_query):
+        """
+        Normalizes the terms of search_query. Operators left without operands by dropped terms are removed as well.
+        :param search_query: the SearchQuery to normalize
+        :return: tuple consisting of the normalized SearchQuery and a list of tuples (term, reason) of the terms that
+                 were dropped, where reason is one of 'duplicate', 'stopword', or 'too short'
+        :raise SearchQueryError: if every term of search_query was dropped
+        """
+        dropped = []
+
+        def normalize_node(node):
+            if isinstance(node, Term):
+                text = ascii_lower(node.text)
+                if node.is_phrase or node.field in ('tag', 'poster'):
+                    return Term(text, node.field, node.is_phrase)
+                if text in self.stopwords:
+                    dropped.append((str(node), 'stopword'))
+                    return None
+                elif len(text) < self.min_length:
+                    dropped.append((str(node), 'too short'))
+                    return None
+                return Term(self._stem(text) if self.stem else text, node.field)
+            elif isinstance(node, Not):
+                child = normalize_node(node.child)
+                return None if child is None else Not(child)
+            children = []
+            keys = set()
+            for child in node.children:
+                child = normalize_node(child)
+                if child is None:
+                    continue
+                key = child if isinstance(child, Term) else str(child)
+                if key in keys:
+                    dropped.append((str(child), 'duplicate'))
+                    continue
+                keys.add(key)
+                children.append(child)
+            if len(children) == 0:
+                return None
+            return children[0] if len(children) == 1 else type(node)(children)
+
+        root = None if search_query.root is None else normalize_node(search_query.root)
+        if root is None and search_query.root is not None:
+            raise SearchQueryError('every keyword was dropped ({}) - please use more specific keywords'
+                                   .format(', '.join('{}: {}'.format(term, reason) for term, reason in dropped)))
+        return SearchQuery(root, set(search_query.options)), dropped
+
+
+def ascii_lower(text):
+    """
+    Case-folds text in the same way as sqlite does (see _ASCII_LOWER), so that keywords are folded in the same way as
+    the posts that they are matched against, whether by the database or by the in-memory search index.
+    :return: text with its ASCII letters lower cased
+    """
+    # str.lower gives the same result for ASCII text and is much faster than str.translate
+    return text.lower() if text.isascii() else text.translate(_ASCII_LOWER)
+
+
+def _escape_like(text):
+    """
+    Escapes the characters of text that have a special meaning in a sql like pattern (using \\ as the escape character).
+    :param text: text to escape
+    :return: the escaped text
+    """
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _compile_term(term, alias, schema, params):
+    """
+    Compiles a single term into a sql condition, adding the parameters it uses to params. The body of a post whose body
+    is compressed (see body_store.BodyStore) only holds its preview, so its compressed body is also matched - in the
+    main database using the body index (only the bodies that have a term containing each word of a phrase are
+    decompressed to be checked for it), while archived compressed bodies are all decompressed to be checked.
+    :param term: the Term to compile
+    :param alias: the alias of the posts table in the query that the condition is to be used in
+    :param schema: the schema of the database that the posts table belongs to
+    :param params: dictionary of named parameters to add the parameters of the condition to
+    :return: the sql condition that is true for the posts matching term (and false, rather than null, for the others -
+             the tests of columns that may be null are made null-safe so that NOT and the score work on such posts)
+    """
+    name = 'k{}'.format(len(params))
+    if term.field in ('tag', 'poster'):
+        # Tags and posters are matched in their entirety
+        params[name] = ascii_lower(term.text)
+        if term.field == 'poster':
+            # Not wrapped in ifnull so that the posts_poster_pdate_idx index can still be used
+            return '({0}.poster is not null and {0}.poster=:{1} collate nocase)'.format(alias, name)
+        return '(exists(select 1 from {}.tags t where t.post_id={}.post_id and lower(t.tag)=:{}))' \
+            .format(schema, alias, name)
+    text = ascii_lower(term.text)
+    params[name] = '%' + _escape_like(text) + '%'
+    title = 'ifnull(lower({}.title) like :{} escape \'\\\', 0)'.format(alias, name)
+    body = 'ifnull(lower({}.body) like :{} escape \'\\\', 0)'.format(alias, name)
+    compressed = 'lower(decompress_body(b.body)) like :{} escape \'\\\''.format(name)
+    words = sorted(index_terms(text))
+    if schema == 'main' and words == [text]:
+        # The index finds the bodies that a single word is found in without decompressing them
+        params[name + 'w0'] = words[0]
+        compressed = terms_filter_sql(schema, name + 'w0', compressed)
+    elif schema == 'main':
+        # but only narrows down the bodies to check for a phrase
+        for i, word in enumerate(words):
+            params['{}w{}'.format(name, i)] = word
+        compressed = ' and '.join([terms_filter_sql(schema, '{}w{}'.format(name, i), '1') for i in range(len(words))] +
+                                  [compressed])
+    body = '{} or {}.post_id in (select b.post_id from {}.post_bodies b where {})' \
+        .format(body, alias, schema, compressed)
+    tags = 'exists(select 1 from {}.tags t where t.post_id={}.post_id and lower(t.tag) like :{} escape \'\\\')' \
+        .format(schema, alias, name)
+    if term.field == 'title':
+        return '(' + title + ')'
+    elif term.field == 'body':
+        return '(' + body + ')'
+    return '(' + title + ' or ' + body + ' or ' + tags + ')'
+
+
+def _tokenize(search_string):
+    """
+    Splits a search string into tokens. Tokens are tuples whose first element is one of 'lparen', 'rparen', 'op',
+    'option', or 'term'. Operator tokens carry the operator, option tokens carry the value following "in:", and term
+    tokens carry a tuple of (negated, field, text, is_phrase).
+    :param search_string: the search string as entered by the user
+    :return: list of tokens
+    """
+    tokens = []
+    i = 0
+    n = len(search_string)
+    while i < n:
+        char = search_string[i]
+        if char.isspace():
+            i += 1
+            continue
+        if char in '()':
+            tokens.append(('lparen' if char == '(' else 'rparen', None))
+            i += 1
+            continue
+        start = i
+        while i < n and not search_string[i].isspace() and search_string[i] not in '()"':
+            i += 1
+        word = search_string[start:i]
+        negated = False
+        if word.startswith('-') and (len(word) > 1 or (i < n and search_string[i] == '"')):
+            negated = True
+            word = word[1:]
+        field = None
+        if ':' in word:
+            prefix, rest = word.split(':', 1)
+            if prefix.lower() in FIELDS or prefix.lower() == 'in':
+                field = prefix.lower()
+                word = rest
+        if word == '' and i < n and search_string[i] == '"':
+            end = search_string.find('"', i + 1)
+            if end == -1:
+                raise SearchQueryError('unterminated quoted phrase: {}'.format(search_string[i:]))
+            text = search_string[i + 1:end].strip()
+            i = end + 1
+            if text == '':
+                raise SearchQueryError('quoted phrases can not be empty')
+            is_phrase = True
+        elif word == '':
+            raise SearchQueryError('"{}" must be followed by a keyword'.format(search_string[start:i]))
+        else:
+            text = word
+            is_phrase = False
+        if field == 'in':
+            if negated or is_phrase or text.lower() not in OPTIONS:
+                raise SearchQueryError('unknown option "{}"'.format(search_string[start:i]))
+            tokens.append(('option', text.lower()))
+        elif field is None and not negated and not is_phrase and text in OPERATORS:
+            tokens.append(('op', text))
+        else:
+            tokens.append(('term', (negated, field, text, is_phrase)))
+    return tokens
+
+
+class _Parser:
+    """
+    Recursive descent parser for search strings. In order of increasing precedence: OR, adjacency, AND, and NOT (or a
+    leading -). Adjacent keywords and phrases are combined with OR (so that a plain list of keywords finds all of the
+    posts matching at least one of them, as it always has) while adjacent field filters and negations restrict the
+    results that the rest of the adjacent terms match.
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def parse(self):
+        node = self._parse_or()
+        if self.pos < len(self.tokens):
+            kind, value = self._peek()
+            raise SearchQueryError('unexpected "{}"'.format(')' if kind == 'rparen' else value))
+        return node
+
+    def _parse_or(self):
+        children = [self._parse_sequence()]
+        while self._peek() == ('op', 'OR'):
+            self.pos += 1
+            children.append(self._parse_sequence())
+        return children[0] if len(children) == 1 else Or(children)
+
+    def _parse_sequence(self):
+        keywords = []
+        filters = []
+        while self._peek()[0] in ('term', 'lparen') or self._peek() == ('op', 'NOT'):
+            node = self._parse_and()
+            if isinstance(node, Not) or (isinstance(node, Term) and node.field is not None):
+                filters.append(node)
+            else:
+                keywords.append(node)
+        if len(keywords) + len(filters) == 0:
+            kind, value = self._peek()
+            raise SearchQueryError('expected a keyword but found "{}"'.format(
+                'end of search' if kind is None else ')' if kind == 'rparen' else value))
+        if len(keywords) > 1:
+            filters.append(Or(keywords))
+        elif len(keywords) == 1:
+            filters.append(keywords[0])
+        return filters[0] if len(filters) == 1 else And(filters)
+
+    def _parse_and(self):
+        children = [self._parse_unary()]
+        while self._peek() == ('op', 'AND'):
+            self.pos += 1
+            children.append(self._parse_unary())
+        return children[0] if len(children) == 1 else And(children)
+
+    def _parse_unary(self):
+        kind, value = self._peek()
+        if (kind, value) == ('op', 'NOT'):
+            self.pos += 1
+            return Not(self._parse_unary())
+        elif kind == 'lparen':
+            self.pos += 1
+            node = self._parse_or()
+            if self._peek()[0] != 'rparen':
+                raise SearchQueryError('missing ")"')
+            self.pos += 1
+            return node
+        elif kind == 'term':
+            self.pos += 1
+            negated, field, text, is_phrase = value
+            term = Term(text, field, is_phrase)
+            return Not(term) if negated else term
+        raise SearchQueryError('expected a keyword but found "{}"'.format(
+            'end of search' if kind is None else ')' if kind == 'rparen' else value))
+
+
+def parse_search_query(search_string):
+    """
+    Parses a search string into a SearchQuery. Search strings consist of keywords and "quoted phrases", which match
+    posts containing them in their title, body, or tags, combined with the AND, OR, and NOT operators (a leading - also
+    negates a keyword) and parentheses. Keywords can be restricted to a single field using title:, body:, tag:, or
+    poster: (tags and posters must match in their entirety). Keywords that are simply listed one after the other find
+    the posts matching at least one of them. in:archive can be given anywhere in the search string to also search the
+    posts that have been archived.
+    :param search_string: the search string as entered by the user
+    :return: the SearchQuery corresponding to search_string
+    """
+    tokens = _tokenize(search_string)
+    options = set(value for kind, value in tokens if kind == 'option')
+    tokens = [token for token in tokens if token[0] != 'option']
+    if len(tokens) == 0:
+        raise SearchQueryError('you must enter at least one keyword')
+    return SearchQuery(_Parser(tokens).parse(), options)
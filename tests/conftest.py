@@ -0,0 +1,54 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+USERS = [('u1', 'Ann', 'pw1', 'Edmonton', '2020-01-01'), ('U2', 'Bob', 'pw2', 'Calgary', '2020-01-02'),
+         ('Ünï', 'Una', 'pw3', 'Banff', '2020-01-03')]
+# Posts without a body and without a poster are allowed by the schema
+POSTS = [('q1', '2020-03-01', 'Apple pie recipe', 'How do I bake an apple pie?', 'u1'),
+         ('q2', '2020-03-02', 'Banana bread', None, 'U2'),
+         ('q3', '2020-03-03', 'Cherry tart', 'Cherries and more cherries', None),
+         ('q4', '2020-03-04', 'Ünïcode in titles', 'Does ünïcode work in a body?', 'Ünï'),
+         ('a1', '2020-03-05', 'Re: apple pie', 'Use sour apples and a hot oven', 'U2'),
+         ('a2', '2020-03-06', 'Re: apple pie', None, 'Ünï')]
+
+
+def create_database(path):
+    """
+    Creates a database at path from prj-tables.sql and fills it with a few users, questions, answers, votes, and tags.
+    :return: path
+    """
+    connection = sqlite3.connect(path)
+    with open(os.path.join(ROOT, 'prj-tables.sql')) as script:
+        connection.executescript(script.read())
+    connection.executemany('insert into users values (?, ?, ?, ?, ?);', USERS)
+    connection.execute('insert into privileged values (\'u1\');')
+    connection.execute('insert into badges values (\'helpful\', \'gold\');')
+    connection.executemany('insert into posts values (?, ?, ?, ?, ?);', POSTS)
+    connection.executemany('insert into questions values (?, null);', [('q1',), ('q2',), ('q3',), ('q4',)])
+    connection.executemany('insert into answers values (?, ?);', [('a1', 'q1'), ('a2', 'q1')])
+    connection.execute('update questions set theaid=\'a1\' where pid=\'q1\';')
+    connection.executemany('insert into votes values (?, ?, ?, ?);', [('q1', 1, '2020-03-07', 'U2'),
+                                                                     ('a1', 1, '2020-03-07', 'u1')])
+    connection.executemany('insert into tags values (?, ?);', [('q1', 'Baking'), ('q4', 'Ünïcode')])
+    connection.commit()
+    connection.close()
+    return path
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return create_database(str(tmp_path / 'pagebook.db'))
+
+
+@pytest.fixture
+def db_manager(db_path):
+    from db_manager import DBManager
+    manager = DBManager(db_path)
+    yield manager
+    manager.close_connection()
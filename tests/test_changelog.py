@@ -0,0 +1,80 @@
+import pytest
+
+from changelog import ChangelogCompactedError
+from db_manager import DBManager
+
+LONG_BODY = 'Cream the butter and sugar until pale, then fold in the flour a spoonful at a time. ' * 20
+
+# Each write path of DBManager, along with (some of) the changes (table, key, op) that it must log - the pids of new
+# posts are generated, so their key is None
+WRITES = {
+    'add_user': (lambda db: db.add_user('u9', 'Eve', 'pw9', 'Red Deer'), {('users', 'u9', 'insert')}),
+    'new_question': (lambda db: db.new_post('Plum jam', 'How long?', 'u1'),
+                     {('posts', None, 'insert'), ('questions', None, 'insert')}),
+    'new_answer': (lambda db: db.new_post('Re: apple pie', 'Bake it', 'u1', True, 'q1'),
+                   {('posts', None, 'insert'), ('answers', None, 'insert')}),
+    'add_vote': (lambda db: db.add_vote('q2', 'u1'), {('votes', 'q2', 'insert')}),
+    'add_votes': (lambda db: db.add_votes([('q3', 'U2', '2020-04-01')]), {('votes', 'q3', 'insert')}),
+    'update_accepted_answer': (lambda db: db.update_accepted_answer('a2'), {('questions', 'q1', 'update')}),
+    'give_badge': (lambda db: db.give_badge('helpful', 'U2'), {('ubadges', 'U2', 'insert')}),
+    'add_tag_to_post': (lambda db: db.add_tag_to_post('q2', 'Bread'), {('tags', 'q2', 'insert')}),
+    'update_post': (lambda db: db.update_post('q2', new_title='Banana loaf'), {('posts', 'q2', 'update')}),
+    'bulk_add_tag': (lambda db: db.bulk_add_tag(['q2', 'q3'], 'Fruit'),
+                     {('tags', 'q2', 'insert'), ('tags', 'q3', 'insert')}),
+    'bulk_give_badge': (lambda db: db.bulk_give_badge(['q1'], 'helpful'), {('ubadges', 'u1', 'insert')}),
+    'bulk_update_posts': (lambda db: db.bulk_update_posts(['q2', 'q3'], new_body='Updated'),
+                          {('posts', 'q2', 'update'), ('posts', 'q3', 'update')}),
+    'archive_posts': (lambda db: db.archive_posts('2020-03-03'),
+                      {('posts', 'q1', 'delete'), ('posts', 'a1', 'delete'), ('questions', 'q2', 'delete'),
+                       ('answers', 'a2', 'delete'), ('votes', 'q1', 'delete'), ('tags', 'q1', 'delete')}),
+    'enable_body_compression': (lambda db: db.update_post('q3', new_body=LONG_BODY) or db.enable_body_compression(),
+                                {('posts', 'q3', 'update')})
+}
+
+
+@pytest.mark.parametrize('name', sorted(WRITES))
+def test_writes_are_logged(db_path, tmp_path, name):
+    write, expected = WRITES[name]
+    db_manager = DBManager(db_path, str(tmp_path / 'archive.db'))
+    try:
+        cursor = db_manager.changelog.latest_seq()
+        write(db_manager)
+        changes = db_manager.changelog.read(cursor)
+        assert [change.seq for change in changes] == list(range(cursor + 1, cursor + len(changes) + 1))
+        logged = set((change.table, change.key, change.op) for change in changes)
+        logged.update([(table, None, op) for table, _, op in logged if table in ('posts', 'questions', 'answers')])
+        assert expected <= logged
+    finally:
+        db_manager.close_connection()
+
+
+def add_users(db_manager, first, num_users):
+    for i in range(first, first + num_users):
+        db_manager.add_user('n{}'.format(i), 'New', 'pw', 'Leduc')
+    return db_manager.changelog.latest_seq()
+
+
+def test_reading_compacted_changes_fails(db_manager):
+    changelog = db_manager.changelog
+    latest = add_users(db_manager, 0, 3)
+    assert changelog.compact(keep=1) == 2
+    assert [change.seq for change in changelog.read(latest - 1)] == [latest]
+    with pytest.raises(ChangelogCompactedError):
+        changelog.read(latest - 2)
+    changelog.compact(keep=0)
+    assert changelog.read(latest) == []
+    with pytest.raises(ChangelogCompactedError):
+        changelog.read(0)
+
+
+def test_saved_cursor_holds_back_compaction(db_manager):
+    changelog = db_manager.changelog
+    cursor = add_users(db_manager, 0, 2)
+    changelog.save_cursor('index', cursor)
+    latest = add_users(db_manager, 2, 3)
+    assert changelog.get_cursor('index') == cursor
+    assert changelog.compact(keep=0) == cursor
+    assert [change.key for change in changelog.read(cursor)] == ['n2', 'n3', 'n4']
+    changelog.remove_consumer('index')
+    assert changelog.compact(keep=0) == latest - cursor
+    assert changelog.read(latest) == []
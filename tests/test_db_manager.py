@@ -0,0 +1,124 @@
+import os
+import sqlite3
+
+import pytest
+
+from conftest import ROOT
+from db_manager import DBManager
+
+LONG_BODY = 'Knead the dough for ten minutes, then let it rise somewhere warm until it has doubled in size. ' * 20
+
+
+def find_pid(db_manager, title):
+    return db_manager.cursor.execute('select pid from posts where title=?;', (title,)).fetchone()[0]
+
+
+def test_sign_up(db_manager):
+    db_manager.add_user('u9', 'Eve', 'pw9', 'Red Deer')
+    assert db_manager.valid_login('U9', 'pw9')
+    assert db_manager.get_user_stats('u9') == (0, 0, 0, 0, 0, 0, 0)
+
+
+def test_post_question_and_answer(db_manager):
+    num_posts, num_questions, num_answers = db_manager.get_user_stats('u1')[:3]
+    db_manager.new_post('Plum jam', 'How long do plums need to cook?', 'u1')
+    qid = find_pid(db_manager, 'Plum jam')
+    db_manager.new_post('Re: plum jam', 'About an hour', 'U2', is_an_answer=True, associated_question=qid)
+    question, answers = db_manager.get_thread(qid.lower())
+    assert question[0] == qid and question[3] == 'How long do plums need to cook?' and question[5] == 1
+    assert [answer[3] for answer in answers] == ['About an hour']
+    assert db_manager.get_user_stats('u1')[:3] == (num_posts + 1, num_questions + 1, num_answers)
+
+
+def test_search(db_manager):
+    posts = db_manager.execute_search('apple')
+    assert set(post[0] for post in posts) == {'q1', 'a1', 'a2'}
+    # Questions are hydrated with their number of answers, answers without it - both end with the poster's reputation
+    assert sorted(len(post) for post in posts) == [7, 7, 8]
+    # Negations and field filters restrict the posts that match the plain keywords
+    assert set(pid for pid, _, _ in db_manager.rank_search('apple -body:oven')) == {'q1', 'a2'}
+    assert set(pid for pid, _, _ in db_manager.rank_search('apple -body:oven tag:baking')) == {'q1'}
+
+
+def test_archive(db_path, tmp_path):
+    db_manager = DBManager(db_path, str(tmp_path / 'archive.db'))
+    try:
+        # q1 and q2 are posted before the cutoff date and a1 and a2 answer q1
+        assert db_manager.archive_posts('2020-03-03') == 4
+        assert db_manager.post_is_archived('Q1') and not db_manager.post_is_archived('q3')
+        assert set(pid for pid, _, _ in db_manager.rank_search('apple')) == set()
+        assert set(pid for pid, _, _ in db_manager.rank_search('apple in:archive')) == {'q1', 'a1', 'a2'}
+        assert db_manager.get_post_body('a1') == 'Use sour apples and a hot oven'
+    finally:
+        db_manager.close_connection()
+
+
+def test_bulk_operations(db_manager):
+    result = db_manager.bulk_add_tag(['q1', 'Q2', 'zz99'], 'baking')
+    assert (result.applied, result.skipped, result.not_found) == (['q2'], ['q1'], ['zz99'])
+    result = db_manager.bulk_give_badge(['q1', 'a1', 'q2'], 'Helpful')
+    assert sorted(result.applied) == ['U2', 'u1'] and db_manager.get_user_stats('U2')[4] == 1
+    with pytest.raises(ValueError):
+        db_manager.bulk_update_posts(['q2'])
+    result = db_manager.bulk_update_posts(['q2', 'q3'], new_body='Updated')
+    assert sorted(result.applied) == ['q2', 'q3']
+    assert db_manager.get_post_body('q2') == db_manager.get_post_body('q3') == 'Updated'
+
+
+def test_body_compression_round_trip(db_manager):
+    db_manager.new_post('Bread', LONG_BODY, 'u1')
+    pid = find_pid(db_manager, 'Bread')
+    num_compressed, size_before, size_after, _ = db_manager.enable_body_compression()
+    assert num_compressed == 1 and size_after < size_before
+    db_manager.new_post('More bread', LONG_BODY, 'U2')
+    # Search results only hold the preview of a compressed body
+    posts = db_manager.execute_search('knead')
+    assert len(posts) == 2 and all(len(post[3]) < len(LONG_BODY) for post in posts)
+    assert db_manager.get_post_body(pid) == db_manager.get_post_body(find_pid(db_manager, 'More bread')) == LONG_BODY
+    assert db_manager.disable_body_compression()[0] == 2
+    assert db_manager.get_post_body(pid) == LONG_BODY
+
+
+def test_schema_reset(db_path):
+    db_manager = DBManager(db_path)
+    db_manager.enable_body_compression()
+    db_manager.close_connection()
+    connection = sqlite3.connect(db_path)
+    with open(os.path.join(ROOT, 'prj-tables.sql')) as script:
+        connection.executescript(script.read())
+    connection.execute('insert into users values (\'u1\', \'Ann\', \'pw1\', \'Edmonton\', \'2020-01-01\');')
+    connection.commit()
+    connection.close()
+    db_manager = DBManager(db_path)
+    try:
+        # The compressed bodies and the compression setting are dropped along with the posts
+        assert db_manager.body_store.preview_length is None
+        db_manager.new_post('Bread', LONG_BODY, 'u1')
+        pid = find_pid(db_manager, 'Bread')
+        assert db_manager.get_post_body(pid) == LONG_BODY
+        assert [post[0] for post in db_manager.execute_search('knead')] == [pid]
+    finally:
+        db_manager.close_connection()
+
+
+def test_user_stats_match_recount(db_manager):
+    # Ünï and ünï are different users as only ASCII letters are case-folded
+    db_manager.add_user('ünï', 'Uli', 'pw4', 'Jasper')
+    db_manager.new_post('Scones', 'Butter or cream?', 'ünï')
+    qid = find_pid(db_manager, 'Scones')
+    db_manager.new_post('Re: scones', 'Both', 'Ünï', is_an_answer=True, associated_question=qid)
+    db_manager.new_post('Re: scones again', 'Neither', 'u1', is_an_answer=True, associated_question=qid)
+    aid = find_pid(db_manager, 'Re: scones')
+    db_manager.add_vote(aid, 'ünï')
+    db_manager.add_vote('q4', 'U1')
+    db_manager.update_accepted_answer(aid)
+    db_manager.update_accepted_answer('a2')
+    db_manager.give_badge('helpful', 'Ünï')
+    db_manager.bulk_give_badge([qid, 'q1'], 'helpful')
+    assert db_manager.get_user_stats('Ünï')[:6] == (3, 1, 2, 2, 1, 2)
+    reputation = db_manager.get_user_stats('Ünï')[6]
+    assert set(post[-1] for post in db_manager.execute_search('poster:Ünï')) == {reputation}
+    maintained = db_manager.cursor.execute('select * from user_stats order by uid;').fetchall()
+    db_manager.cursor.execute('delete from user_stats;')
+    db_manager._create_user_stats()
+    assert db_manager.cursor.execute('select * from user_stats order by uid;').fetchall() == maintained
@@ -0,0 +1,85 @@
+import multiprocessing
+import sqlite3
+
+from conftest import create_database
+from db_manager import DBManager
+
+SCHEMA_VERSION = 7
+
+
+def open_database(db_path, barrier, results):
+    barrier.wait()
+    try:
+        DBManager(db_path).close_connection()
+        results.put(None)
+    except Exception as e:
+        results.put(repr(e))
+
+
+def test_concurrent_upgrades(tmp_path):
+    # Whether the processes race for the upgrade depends on their timing, so several databases are opened
+    num_processes = 6
+    for i in range(5):
+        db_path = create_database(str(tmp_path / 'pagebook{}.db'.format(i)))
+        barrier = multiprocessing.Barrier(num_processes)
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=open_database, args=(db_path, barrier, results))
+                     for _ in range(num_processes)]
+        for process in processes:
+            process.start()
+        errors = [results.get(timeout=60) for _ in processes]
+        for process in processes:
+            process.join()
+        assert errors == [None] * num_processes
+        connection = sqlite3.connect(db_path)
+        try:
+            assert connection.execute('pragma user_version;').fetchone()[0] == SCHEMA_VERSION
+            # The tables were only rebuilt once, by the first process to take the write lock
+            assert connection.execute('select count(*), min(post_id), max(post_id) from posts;').fetchone() == (6, 1, 6)
+        finally:
+            connection.close()
+
+
+def test_integer_keys_keep_orphans(db_path, capsys):
+    connection = sqlite3.connect(db_path)
+    # A vote on a post that does not exist, an answer without a post, and a privileged user who does not exist
+    connection.execute('insert into votes values (\'zz99\', 1, \'2020-03-08\', \'u1\');')
+    connection.execute('insert into answers values (\'a9\', \'q2\');')
+    connection.execute('insert into privileged values (\'zz98\');')
+    connection.execute('insert into ubadges values (\'U2\', \'2020-03-09\', \'helpful\');')
+    connection.commit()
+    tables = ['users', 'privileged', 'badges', 'ubadges', 'posts', 'tags', 'votes', 'questions', 'answers']
+    counts = dict((table, connection.execute('select count(*) from ' + table + ';').fetchone()[0]) for table in tables)
+    connection.close()
+    DBManager(db_path).close_connection()
+    assert 'main.answers_orphans' in capsys.readouterr().err
+    connection = sqlite3.connect(db_path)
+    try:
+        assert connection.execute('select * from answers_orphans;').fetchall() == [('a9', 'q2')]
+        assert connection.execute('select * from privileged_orphans;').fetchall() == [('zz98',)]
+        assert connection.execute('select count(*) from sqlite_master where name=\'questions_orphans\';').fetchone() \
+            == (0,)
+        counts['answers'] -= 1
+        counts['privileged'] -= 1
+        for table in tables:
+            assert connection.execute('select count(*) from ' + table + ';').fetchone()[0] == counts[table], table
+        # Each integer key must be that of the row that the char(4) id refers to
+        post_id = '(select post_id from posts p where p.pid={})'
+        user_id = '(select user_id from users u where u.uid={})'
+        mismatches = [
+            'select pid from votes v where v.post_id is not ' + post_id.format('v.pid') + ' '
+            'or v.user_id is not ' + user_id.format('v.uid'),
+            'select pid from tags t where t.post_id is not ' + post_id.format('t.pid'),
+            'select uid from ubadges b where b.user_id is not ' + user_id.format('b.uid'),
+            'select uid from privileged r where r.user_id is not ' + user_id.format('r.uid'),
+            'select pid from questions q where q.post_id is not ' + post_id.format('q.pid') + ' '
+            'or q.accepted_id is not ' + post_id.format('q.theaid'),
+            'select pid from answers a where a.post_id is not ' + post_id.format('a.pid') + ' '
+            'or a.question_id is not ' + post_id.format('a.qid')
+        ]
+        for query in mismatches:
+            assert connection.execute(query + ';').fetchall() == [], query
+        # The vote on the post that does not exist is kept, without a post_id
+        assert connection.execute('select pid, post_id from votes where pid=\'zz99\';').fetchall() == [('zz99', None)]
+    finally:
+        connection.close()
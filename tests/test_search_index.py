@@ -0,0 +1,43 @@
+import pytest
+
+from search_query import parse_search_query
+
+pytest.importorskip('numpy')
+
+QUERIES = ['apple', 'APPLE pie', '-apple', 'NOT banana', 'body:apple', '-body:apple', 'title:re', '"apple pie"',
+           'tag:baking', 'tag:Ünïcode', 'tag:ünïcode', 'poster:u2', 'poster:Ünï', 'poster:ünï', '-poster:u1',
+           'Ünïcode', 'ünïcode', 'cherry OR banana', '(apple OR cherry) -tart']
+
+
+@pytest.mark.parametrize('search', QUERIES)
+def test_index_matches_database(db_manager, search):
+    search_query = parse_search_query(search)
+    expected = sorted(db_manager.rank_search(search_query))
+    db_manager.enable_search_index()
+    assert sorted(db_manager.rank_search(search_query)) == expected
+
+
+@pytest.mark.parametrize('poster', ['u2', 'U2', 'Ünï', 'ünï'])
+def test_index_poster_filter_matches_database(db_manager, poster):
+    search_query = parse_search_query('apple OR banana OR ünïcode OR Ünïcode')
+    expected = sorted(db_manager.rank_search(search_query, poster=poster))
+    db_manager.enable_search_index()
+    assert sorted(db_manager.rank_search(search_query, poster=poster)) == expected
+
+
+def test_not_matches_posts_without_a_body(db_manager):
+    pids = set(pid for pid, _, _ in db_manager.rank_search(parse_search_query('-apple')))
+    assert pids == {'q2', 'q3', 'q4'}
+
+
+def test_non_ascii_keywords_are_folded_like_the_database(db_manager):
+    # Only ASCII letters are case-folded, so Ü and ü are different letters
+    assert set(pid for pid, _, _ in db_manager.rank_search(parse_search_query('poster:ÜNï'))) == {'q4', 'a2'}
+    assert set(pid for pid, _, _ in db_manager.rank_search(parse_search_query('poster:ünï'))) == set()
+
+
+def test_index_hydrates_the_reputation_of_posters(db_manager):
+    db_manager.give_badge('helpful', 'Ünï')
+    expected = sorted(db_manager.execute_search('apple OR ünïcode OR Ünïcode'))
+    db_manager.enable_search_index()
+    assert sorted(db_manager.execute_search('apple OR ünïcode OR Ünïcode')) == expected
@@ -0,0 +1,47 @@
+import json
+
+from vote_queue import VoteQueue
+
+
+def count_votes(db_manager, pid):
+    return db_manager.cursor.execute('select count(*) from votes where pid=?;', (pid,)).fetchone()[0]
+
+
+def test_journaled_vote_is_flushed_once(db_manager, tmp_path):
+    journal_path = str(tmp_path / 'votes.journal')
+    # The first queue never flushes or is closed, as if the process had crashed with the vote queued
+    VoteQueue(db_manager.clone, journal_path, flush_interval=3600).enqueue('q2', 'u1')
+    queue = VoteQueue(db_manager.clone, journal_path, flush_interval=3600)
+    assert queue.num_pending() == 1
+    queue.close()
+    assert count_votes(db_manager, 'q2') == 1
+    queue = VoteQueue(db_manager.clone, journal_path, flush_interval=3600)
+    assert queue.num_pending() == 0
+    queue.close()
+    assert count_votes(db_manager, 'q2') == 1
+
+
+def test_queued_vote_blocks_voting_again(db_manager, tmp_path):
+    db_manager.add_user('ünï', 'Uli', 'pw4', 'Jasper')
+    db_manager.enable_vote_queue(str(tmp_path / 'votes.journal'), flush_interval=3600)
+    db_manager.add_vote('q2', 'Ünï')
+    assert db_manager.get_vote_eligibility('Ünï', 'Q2') is False
+    # Only ASCII letters are case-folded, so ünï is a different user
+    assert db_manager.get_vote_eligibility('ünï', 'q2') is True
+    assert db_manager.vote_queue.flush(timeout=10)
+    assert db_manager.get_vote_eligibility('Ünï', 'q2') is False
+    assert count_votes(db_manager, 'q2') == 1
+
+
+def test_replaying_a_written_batch_adds_nothing(db_manager, tmp_path):
+    votes = [('q2', 'u1', '2020-04-01'), ('q2', 'U2', '2020-04-01'), ('q3', 'u1', '2020-04-01')]
+    assert db_manager.add_votes(votes) == 3
+    assert db_manager.add_votes(votes) == 0
+    # The same batch left in a journal, e.g. by a crash after the flush but before the journal was cleared
+    journal_path = str(tmp_path / 'votes.journal')
+    with open(journal_path, 'w') as journal:
+        journal.writelines(json.dumps(vote) + '\n' for vote in votes)
+    VoteQueue(db_manager.clone, journal_path, flush_interval=3600).close()
+    assert count_votes(db_manager, 'q2') == 2 and count_votes(db_manager, 'q3') == 1
+    # One vote was received before and two by the batch
+    assert db_manager.get_user_stats('U2')[3] == 3
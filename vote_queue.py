@@ -0,0 +1,201 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from datetime import date
+
+from search_query import ascii_lower
+
+
+def _vote_key(pid, uid):
+    """
+    Gets the key that identifies a vote in the queue - the pid and uid are case-folded in the same way as the database
+    compares them (see search_query.ascii_lower).
+    :return: tuple of the folded pid and uid
+    """
+    return ascii_lower(pid), ascii_lower(uid)
+
+
+class VoteQueue:
+    """
+    Class representing a write-behind queue of votes. Votes are held in memory and flushed to the database in batches
+    (each batch is a single transaction) by a background thread with its own connection, rather than each vote being
+    its own transaction. Every vote is appended to a local journal file before it is queued and the journal is only
+    cleared once the vote has been flushed, so queued votes survive a crash and are flushed the next time a queue is
+    opened on the same journal.
+    """
+
+    def __init__(self, connect, journal_path, batch_size=500, flush_interval=1.0, fsync=False):
+        """
+        Initializes an instance of this class, replays any votes left in the journal, and starts the background thread.
+        :param connect: function returning a new database manager (providing add_votes and close_connection) - it is
+                        called by the background thread so that it has its own connection
+        :param journal_path: path to the journal file that queued votes are appended to (created if it does not exist)
+        :param batch_size: number of queued votes that triggers a flush before flush_interval has elapsed
+        :param flush_interval: max number of seconds that a vote is queued for before it is flushed
+        :param fsync: whether each journal append should be synced to disk (so that queued votes also survive a power
+                      loss) rather than only being handed to the operating system
+        """
+        self.journal_path = journal_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.num_flushed = 0
+        # The last error that a flush failed with (None once a flush succeeds)
+        self.last_error = None
+        self._connect = connect
+        self._pending = []
+        self._pending_keys = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._flushed = threading.Condition(self._lock)
+        self._closing = False
+        if os.path.exists(journal_path):
+            self._replay_journal()
+        self._journal = open(journal_path, 'a')
+        self._thread = threading.Thread(target=self._run, name='vote-queue', daemon=True)
+        self._thread.start()
+
+    def _replay_journal(self):
+        """
+        Queues the votes in the journal that were not flushed before the last queue on it was closed. Lines that are not
+        votes (such as a partially written last line, from a crash during an append) are ignored.
+        """
+        with open(self.journal_path) as journal:
+            for line in journal:
+                try:
+                    vote = json.loads(line)
+                except ValueError:
+                    continue
+                if not isinstance(vote, list) or len(vote) != 3 or not all(isinstance(field, str) for field in vote):
+                    continue
+                pid, uid, vdate = vote
+                self._pending.append((pid, uid, vdate))
+                self._pending_keys.add(_vote_key(pid, uid))
+
+    def _rewrite_journal(self):
+        """
+        Replaces the journal with one containing only the votes that are still queued. Must be called with the lock
+        held.
+        """
+        self._journal.close()
+        temp_path = self.journal_path + '.tmp'
+        with open(temp_path, 'w') as journal:
+            for vote in self._pending:
+                journal.write(json.dumps(vote) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(temp_path, self.journal_path)
+        self._journal = open(self.journal_path, 'a')
+
+    def enqueue(self, pid, uid):
+        """
+        Queues a vote from the user identified by uid on the post identified by pid (dated today). The vote is appended
+        to the journal before this returns.
+        :param pid: pid of post to add a vote to
+        :param uid: uid of user who is adding a vote
+        """
+        vote = (pid, uid, date.today().isoformat())
+        with self._lock:
+            self._journal.write(json.dumps(vote) + '\n')
+            self._journal.flush()
+            if self.fsync:
+                os.fsync(self._journal.fileno())
+            self._pending.append(vote)
+            self._pending_keys.add(_vote_key(pid, uid))
+            if len(self._pending) >= self.batch_size:
+                self._wake.set()
+
+    def has_pending_vote(self, pid, uid):
+        """
+        Checks if a vote from the user identified by uid on the post identified by pid is queued (case-insensitive).
+        :param pid: pid of post to check
+        :param uid: uid of user to check
+        :return: boolean value corresponding to whether such a vote is queued but not yet flushed
+        """
+        with self._lock:
+            return _vote_key(pid, uid) in self._pending_keys
+
+    def num_pending(self):
+        """
+        :return: the number of votes that are queued but not yet flushed
+        """
+        with self._lock:
+            return len(self._pending)
+
+    def _flush(self, db_manager):
+        """
+        Writes the queued votes to the database using db_manager (see DBManager.add_votes) and then removes them from
+        the queue and the journal. If the write fails the votes stay queued so that they are retried on the next flush.
+        :param db_manager: database manager owned by the background thread
+        """
+        with self._lock:
+            batch = list(self._pending)
+        if len(batch) > 0:
+            db_manager.add_votes(batch)
+        with self._lock:
+            del self._pending[:len(batch)]
+            self._pending_keys = set(_vote_key(pid, uid) for pid, uid, vdate in self._pending)
+            if len(batch) > 0:
+                self._rewrite_journal()
+                self.num_flushed += len(batch)
+            self._flushed.notify_all()
+
+    def _run(self):
+        """
+        Flushes the queue every flush_interval seconds (or whenever batch_size votes are queued or a flush is
+        requested) until the queue is closed, after which a final flush is made.
+        """
+        db_manager = self._connect()
+        try:
+            while True:
+                self._wake.wait(self.flush_interval)
+                self._wake.clear()
+                closing = self._closing
+                try:
+                    self._flush(db_manager)
+                    self.last_error = None
+                except sqlite3.OperationalError:
+                    # e.g. the database is locked - the votes stay queued (and journaled) and are retried
+                    pass
+                except Exception as e:
+                    # Any other error must not stop the thread, or no vote would be flushed for the rest of the session
+                    # - the votes stay queued (and journaled) and are retried, and each new error is reported once
+                    if repr(e) != repr(self.last_error):
+                        sys.stderr.write('vote queue: flushing {} votes failed ({!r}) - they stay queued and are '
+                                         'retried\n'.format(self.num_pending(), e))
+                        sys.stderr.flush()
+                    self.last_error = e
+                if closing:
+                    break
+        finally:
+            db_manager.close_connection()
+            with self._lock:
+                self._flushed.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Requests an immediate flush and waits until every queued vote has been flushed.
+        :param timeout: max number of seconds to wait for (None waits indefinitely)
+        :return: boolean value corresponding to whether every queued vote has been flushed
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while len(self._pending) > 0 and self._thread.is_alive():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._wake.set()
+                self._flushed.wait(remaining)
+            return len(self._pending) == 0
+
+    def close(self):
+        """
+        Flushes the queued votes and stops the background thread. Votes that can not be flushed stay in the journal.
+        """
+        self._closing = True
+        self._wake.set()
+        self._thread.join()
+        self._journal.close()